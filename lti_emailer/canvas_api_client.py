@@ -4,12 +4,16 @@ Utility methods for working with canvas_python_sdk which add a caching layer to
 TODO: Incorporate this caching layer into canvas_python_sdk. Punting on this for now to limit collateral concerns.
 """
 
+import contextvars
+import hashlib
 import logging
+import time
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.core.cache import caches
 
-from canvas_sdk.methods import accounts, communication_channels
+from canvas_sdk.methods import accounts, communication_channels, enrollments
 from canvas_sdk.methods.users import list_users_in_account
 
 from canvas_sdk.utils import get_all_list_data
@@ -23,13 +27,30 @@ from canvas_api.helpers import (
 
 from lti_school_permissions.verification import is_allowed
 
+from lti_emailer.canvas_throttle import canvas_throttle, install_response_hook
+from lti_emailer.concurrency import call_concurrently, install_deadline_adapter
+
 
 cache = caches["shared"]
 logger = logging.getLogger(__name__)
 
 CACHE_KEY_COMM_CHANNELS_BY_CANVAS_USER_ID = "comm-channels-by-canvas-user-id_%s"
 CACHE_KEY_USER_IN_ACCOUNT_BY_SEARCH_TERM = "user-in-account-{}-by-search-term-{}"
+CACHE_KEY_ENROLLMENTS_IN_COURSE_BY_EMAIL = "enrollments-in-course-{}-by-email-{}"
+# search terms longer than this go into cache keys as a hash
+MAX_SEARCH_TERM_KEY_LENGTH = 64
+CACHE_KEY_USERS_IN_COURSE_FETCH_LOCK = "users-in-course-fetch-lock_%s"
+CACHE_KEY_USERS_IN_COURSE_FETCH_RESULT = "users-in-course-fetch-result_%s"
 SDK_CONTEXT = RequestContext(**settings.CANVAS_SDK_SETTINGS)
+# the canvas_api helpers make their calls through their own context
+for _request_context in (
+    SDK_CONTEXT,
+    getattr(canvas_api_helper_courses, "SDK_CONTEXT", None),
+    getattr(canvas_api_helper_sections, "SDK_CONTEXT", None),
+):
+    if _request_context is not None:
+        install_response_hook(_request_context)
+        install_deadline_adapter(_request_context)
 TEACHING_STAFF_ENROLLMENT_TYPES = [
     "TeacherEnrollment",
     "TaEnrollment",
@@ -37,9 +58,154 @@ TEACHING_STAFF_ENROLLMENT_TYPES = [
 ]
 USER_ATTRIBUTES_TO_COPY = ["email", "name", "sortable_name"]
 
+# rosters fetched within the current course_roster_scope(), by canvas course id
+_scoped_course_rosters = contextvars.ContextVar("scoped_course_rosters", default=None)
+
+
+class CourseRoster(object):
+    """
+    Snapshot of the users in a Canvas course, indexed in a single pass over
+    the get_users_in_course() payload so that member, teaching staff and
+    display name lookups for the same course don't each re-fetch and re-walk
+    the full user list.
+    """
+
+    def __init__(self, canvas_course_id, users):
+        self.canvas_course_id = canvas_course_id
+        self.names_by_email = {}
+        self._enrollments_by_email = {}
+        self._course_enrollments = []
+        self._enrollments_by_section_id = {}
+        self._enrollments_by_role = {}
+        self._teaching_staff_enrollments = None
+
+        for user in users:
+            self.names_by_email[user.get("email")] = user.get("name")
+            for i, enrollment in enumerate(user["enrollments"]):
+                _copy_user_attributes_to_enrollment(user, enrollment)
+                self._enrollments_by_email.setdefault(
+                    (user.get("email") or "").lower(), []
+                ).append(enrollment)
+                # the course-wide list only gets the first enrollment for
+                # each user
+                if i == 0:
+                    self._course_enrollments.append(enrollment)
+                self._enrollments_by_section_id.setdefault(
+                    enrollment["course_section_id"], []
+                ).append(enrollment)
+                self._enrollments_by_role.setdefault(enrollment["role"], []).append(
+                    enrollment
+                )
+
+    def get_enrollments(self, section_id=None):
+        if section_id:
+            return list(self._enrollments_by_section_id.get(int(section_id), []))
+        return list(self._course_enrollments)
+
+    def get_section_ids(self):
+        return list(self._enrollments_by_section_id)
+
+    def get_teaching_staff_enrollments(self):
+        if self._teaching_staff_enrollments is None:
+            self._teaching_staff_enrollments = [
+                enrollment
+                for role, enrollments in self._enrollments_by_role.items()
+                if is_teaching_staff_role(self.canvas_course_id, role)
+                for enrollment in enrollments
+            ]
+        return list(self._teaching_staff_enrollments)
+
+    def get_name_for_email(self, address):
+        return self.names_by_email.get(address, "")
+
+    def get_enrollments_for_email(self, address):
+        return list(self._enrollments_by_email.get(address.lower(), []))
+
+
+@contextmanager
+def course_roster_scope():
+    """
+    Within this context, get_course_roster() builds each course's roster at
+    most once; the route handler wraps each incoming message in a scope so
+    that all of the lookups for that message share one Canvas fetch.
+    """
+    token = _scoped_course_rosters.set({})
+    try:
+        yield
+    finally:
+        _scoped_course_rosters.reset(token)
+
+
+def get_course_roster(canvas_course_id):
+    rosters = _scoped_course_rosters.get()
+    if rosters is not None and canvas_course_id in rosters:
+        return rosters[canvas_course_id]
+
+    roster = CourseRoster(canvas_course_id, get_users_in_course(canvas_course_id))
+    if rosters is not None:
+        rosters[canvas_course_id] = roster
+    return roster
+
+
+def is_teaching_staff_role(canvas_course_id, role):
+    return is_allowed(
+        [role], settings.PERMISSION_LTI_EMAILER_SEND_ALL, canvas_course_id
+    )
+
+
+def get_enrollments_for_email(canvas_course_id, email_address):
+    """
+    The enrollments in a course of the Canvas users with the given email
+    address, for checking a sender's role without the course's whole roster.
+    Taken from the roster if the current course_roster_scope() already has
+    it; otherwise found with a user search and a lookup of just those users'
+    enrollments, which is cached for CANVAS_SENDER_ENROLLMENTS_CACHE_TIMEOUT
+    seconds (or CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT, if there are none).
+    """
+    email_address = email_address.lower().strip()
+    rosters = _scoped_course_rosters.get()
+    if rosters is not None and canvas_course_id in rosters:
+        return rosters[canvas_course_id].get_enrollments_for_email(email_address)
+
+    cache_key = CACHE_KEY_ENROLLMENTS_IN_COURSE_BY_EMAIL.format(
+        canvas_course_id, _cache_key_search_term(email_address)
+    )
+    result = cache.get(cache_key)
+    if result is None:
+        result = []
+        for user in _get_users_by_email(email_address):
+            if (user.get("email") or "").lower() != email_address:
+                continue
+            try:
+                with canvas_throttle.slot():
+                    user_enrollments = get_all_list_data(
+                        SDK_CONTEXT,
+                        enrollments.list_enrollments_courses,
+                        canvas_course_id,
+                        user_id=user["id"],
+                    )
+            except CanvasAPIError:
+                logger.error(
+                    "Unable to get enrollments in course {} for Canvas user {}".format(
+                        canvas_course_id, user["id"]
+                    )
+                )
+                raise
+            for enrollment in user_enrollments:
+                _copy_user_attributes_to_enrollment(user, enrollment)
+                result.append(enrollment)
+        timeout = (
+            settings.CANVAS_SENDER_ENROLLMENTS_CACHE_TIMEOUT
+            if result
+            else settings.CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT
+        )
+        cache.set(cache_key, result, timeout=timeout)
+    return result
+
 
 def get_course(canvas_course_id):
-    return canvas_api_helper_courses.get_course(canvas_course_id)
+    with canvas_throttle.slot():
+        return canvas_api_helper_courses.get_course(canvas_course_id)
 
 
 def get_courses_for_account_in_term(
@@ -53,9 +219,10 @@ def get_courses_for_account_in_term(
         kwargs["include"] = "sections"
 
     try:
-        result = get_all_list_data(
-            SDK_CONTEXT, accounts.list_active_courses_in_account, **kwargs
-        )
+        with canvas_throttle.slot():
+            result = get_all_list_data(
+                SDK_CONTEXT, accounts.list_active_courses_in_account, **kwargs
+            )
     except CanvasAPIError:
         logger.error(
             "Unable to get courses for account {}, term {}".format(
@@ -74,23 +241,7 @@ def get_enrollments(canvas_course_id, section_id=None):
     :param section_id:
     :return enrollments list:
     """
-    users = get_users_in_course(canvas_course_id)
-    enrollments = []
-    for user in users:
-        for enrollment in user["enrollments"]:
-            if section_id:
-                if enrollment["course_section_id"] == int(section_id):
-                    _copy_user_attributes_to_enrollment(user, enrollment)
-                    enrollments.append(enrollment)
-            else:
-                # if the user has any enrollment in the course
-                # we add them to the list and then stop (break)
-                # on to the next user.
-                _copy_user_attributes_to_enrollment(user, enrollment)
-                enrollments.append(enrollment)
-                break
-
-    return enrollments
+    return get_course_roster(canvas_course_id).get_enrollments(section_id)
 
 
 def _filter_student_view_enrollments(enrollments):
@@ -99,44 +250,85 @@ def _filter_student_view_enrollments(enrollments):
 
 
 def get_name_for_email(canvas_course_id, address):
-    users = get_users_in_course(canvas_course_id)
-    names_by_email = {u["email"]: u["name"] for u in users}
-    return names_by_email.get(address, "")
+    return get_course_roster(canvas_course_id).get_name_for_email(address)
 
 
 def get_section(canvas_course_id, section_id):
     if section_id:
-        section = canvas_api_helper_sections.get_section(canvas_course_id, section_id)
-        return section
+        with canvas_throttle.slot():
+            return canvas_api_helper_sections.get_section(canvas_course_id, section_id)
     return None
 
 
 def get_sections(canvas_course_id, fetch_enrollments=True):
-    return canvas_api_helper_sections.get_sections(
-        canvas_course_id, fetch_enrollments=fetch_enrollments
-    )
+    with canvas_throttle.slot():
+        return canvas_api_helper_sections.get_sections(
+            canvas_course_id, fetch_enrollments=fetch_enrollments
+        )
 
 
 def get_teaching_staff_enrollments(canvas_course_id):
-    users = get_users_in_course(canvas_course_id)
-    enrollments = []
-    roles_allowed = {}
-    for user in users:
-        for enrollment in user["enrollments"]:
-            role = enrollment["role"]
-            if role not in roles_allowed:
-                roles_allowed[enrollment["role"]] = is_allowed(
-                    [role], settings.PERMISSION_LTI_EMAILER_SEND_ALL, canvas_course_id
-                )
-            if roles_allowed[role]:
-                _copy_user_attributes_to_enrollment(user, enrollment)
-                enrollments.append(enrollment)
-    return enrollments
+    return get_course_roster(canvas_course_id).get_teaching_staff_enrollments()
 
 
 def get_users_in_course(canvas_course_id):
+    """
+    Concurrent calls for the same course, from any process, are coalesced:
+    the first one fetches the users from Canvas and publishes them in the
+    shared cache for CANVAS_ROSTER_FETCH_RESULT_TIMEOUT seconds, and the rest
+    wait for that result rather than making their own requests.
+    """
+    lock_key = CACHE_KEY_USERS_IN_COURSE_FETCH_LOCK % canvas_course_id
+    result_key = CACHE_KEY_USERS_IN_COURSE_FETCH_RESULT % canvas_course_id
+
+    users = cache.get(result_key)
+    if users is not None:
+        return users
+
+    if not cache.add(
+        lock_key, True, timeout=settings.CANVAS_ROSTER_FETCH_LOCK_TIMEOUT
+    ):
+        users = _wait_for_users_in_course(lock_key, result_key)
+        if users is not None:
+            return users
+        logger.info(
+            "Gave up waiting on another fetch of the users in canvas course "
+            "id %s, fetching them again",
+            canvas_course_id,
+        )
+        return _fetch_users_in_course(canvas_course_id)
+
     try:
-        return canvas_api_helper_courses.get_users_in_course(canvas_course_id)
+        users = _fetch_users_in_course(canvas_course_id)
+        cache.set(
+            result_key, users, timeout=settings.CANVAS_ROSTER_FETCH_RESULT_TIMEOUT
+        )
+        return users
+    finally:
+        cache.delete(lock_key)
+
+
+def _wait_for_users_in_course(lock_key, result_key):
+    """
+    Polls for the result of a fetch another caller holds the lock for.
+    :return: the users, or None if the fetch failed or didn't finish within
+        CANVAS_ROSTER_FETCH_LOCK_TIMEOUT seconds
+    """
+    deadline = time.monotonic() + settings.CANVAS_ROSTER_FETCH_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(settings.CANVAS_ROSTER_FETCH_POLL_INTERVAL)
+        found = cache.get_many([lock_key, result_key])
+        if result_key in found:
+            return found[result_key]
+        if lock_key not in found:
+            return None
+    return None
+
+
+def _fetch_users_in_course(canvas_course_id):
+    try:
+        with canvas_throttle.slot():
+            return canvas_api_helper_courses.get_users_in_course(canvas_course_id)
     except:
         logger.exception(
             "failure in canvas_api.helpers.courses.get_users_in_course(): canvas_course_id {}".format(
@@ -156,7 +348,7 @@ def _copy_user_attributes_to_enrollment(user, enrollment):
         )  # Use empty string as default if attribute is missing
 
 
-def get_alternate_emails_for_user_email(email_address):
+def get_alternate_emails_for_user_email(email_address, use_cache=False):
     if not email_address or not email_address.strip():
         return []
 
@@ -176,13 +368,31 @@ def get_alternate_emails_for_user_email(email_address):
         "{}".format(email_address, users)
     )
 
+    # shared and departmental addresses can match several users; fetch their
+    # channels at the same time, going ahead with whichever users' channels
+    # have arrived by the deadline
+    if len(users) == 1:
+        comm_channels_by_user_id = {
+            users[0].get("id"): _list_user_comm_channels(
+                users[0].get("id"), use_cache=use_cache
+            )
+        }
+    else:
+        comm_channels_by_user_id = call_concurrently(
+            {
+                user.get("id"): (_list_user_comm_channels, user.get("id"), use_cache)
+                for user in users
+            },
+            timeout=settings.CANVAS_COMM_CHANNELS_DEADLINE,
+            partial=True,
+        )
+
     all_comm_channels = list()
-    for user in users:
-        user_comm_channels = _list_user_comm_channels(user.get("id"))
+    for user_id, user_comm_channels in comm_channels_by_user_id.items():
         all_comm_channels += user_comm_channels if user_comm_channels else []
         logger.debug(
             "Communication channels for user {}: {}".format(
-                user.get("id"), user_comm_channels
+                user_id, user_comm_channels
             )
         )
 
@@ -206,19 +416,22 @@ def get_alternate_emails_for_user_email(email_address):
 def _get_users_by_email(email_address, account_id=None, use_cache=True):
     if not email_address or not email_address.strip():
         return []
+    # Canvas matches the search term case-insensitively, so every variant of
+    # an address shares one search and one cache entry
+    email_address = email_address.lower().strip()
 
     if account_id is None:
         account_id = "1"  # account ID for root account in Canvas
-    cache_key = CACHE_KEY_USER_IN_ACCOUNT_BY_SEARCH_TERM.format(
-        account_id, email_address
-    )
+    cache_key = _user_search_cache_key(account_id, email_address)
     result = cache.get(cache_key) if use_cache else None
-    if not result:
+    # an empty list is a cached "no such user", which is still a hit
+    if result is None:
         kwargs = {"search_term": email_address, "include": "email"}
         try:
-            result = get_all_list_data(
-                SDK_CONTEXT, list_users_in_account, account_id, **kwargs
-            )
+            with canvas_throttle.slot():
+                result = get_all_list_data(
+                    SDK_CONTEXT, list_users_in_account, account_id, **kwargs
+                )
         except CanvasAPIError:
             logger.error(
                 "Unable to lookup users in account {} for email address {}".format(
@@ -232,32 +445,60 @@ def _get_users_by_email(email_address, account_id=None, use_cache=True):
             )
         )
         if use_cache:
-            cache.set(cache_key, result)
+            # unknown senders (mostly spam and bounces) are remembered for
+            # less time, so a newly created user isn't turned away for long
+            timeout = (
+                settings.CANVAS_USER_SEARCH_CACHE_TIMEOUT
+                if result
+                else settings.CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT
+            )
+            cache.set(cache_key, result, timeout=timeout)
     return result
 
 
+def _user_search_cache_key(account_id, search_term):
+    return CACHE_KEY_USER_IN_ACCOUNT_BY_SEARCH_TERM.format(
+        account_id, _cache_key_search_term(search_term)
+    )
+
+
+def _cache_key_search_term(search_term):
+    """
+    Search terms are lowercased, so the key is the same whatever the case of
+    the address; long ones are hashed, keeping the key within cache key
+    limits.
+    """
+    search_term = search_term.lower().strip()
+    if len(search_term) > MAX_SEARCH_TERM_KEY_LENGTH or not search_term.isprintable():
+        search_term = hashlib.sha256(search_term.encode("utf-8")).hexdigest()
+    return search_term
+
+
 def _list_user_comm_channels(user_id, use_cache=False):
     """
-    Note: we don't want to cache by default because we want to immediately
-    pick up changes in user communication channels if they change them, e.g.
-    if they're notified they need to update their communication channels and
-    they attempt to email a list immediately afterwards, we want to pick up
-    that change. Caching can still be done at the level of the mailgun route
-    handler event trigger.
+    Note: we don't read from the cache by default because we want to
+    immediately pick up changes in user communication channels if they change
+    them, e.g. if they're notified they need to update their communication
+    channels and they attempt to email a list immediately afterwards, we want
+    to pick up that change.  Fresh results are still stored, for
+    CANVAS_COMM_CHANNELS_CACHE_TIMEOUT seconds, for callers that pass
+    use_cache=True and re-check on a mismatch (see the mailgun route
+    handler's CommChannelCache).
     """
     if not user_id:
         return []
 
     cache_key = CACHE_KEY_COMM_CHANNELS_BY_CANVAS_USER_ID % user_id
     result = cache.get(cache_key) if use_cache else None
-    if not result:
+    if result is None:
         kwargs = {"user_id": user_id}
         try:
-            result = get_all_list_data(
-                SDK_CONTEXT,
-                communication_channels.list_user_communication_channels,
-                **kwargs,
-            )
+            with canvas_throttle.slot():
+                result = get_all_list_data(
+                    SDK_CONTEXT,
+                    communication_channels.list_user_communication_channels,
+                    **kwargs,
+                )
         except CanvasAPIError:
             logger.error(
                 "Unable to get communication channels for Canvas user {}".format(
@@ -270,6 +511,27 @@ def _list_user_comm_channels(user_id, use_cache=False):
                 user_id, result
             )
         )
-        if use_cache:
-            cache.set(cache_key, result)
+        if settings.CANVAS_COMM_CHANNELS_CACHE_TIMEOUT:
+            cache.set(
+                cache_key, result, timeout=settings.CANVAS_COMM_CHANNELS_CACHE_TIMEOUT
+            )
     return result
+
+
+def purge_cached_comm_channels(email_address=None, canvas_user_ids=()):
+    """
+    Drops the cached Canvas user search for `email_address` and the cached
+    communication channels of the users it matches, plus those of any
+    `canvas_user_ids`.
+    :return: the set of canvas user ids purged
+    """
+    canvas_user_ids = set(canvas_user_ids)
+    if email_address:
+        canvas_user_ids.update(
+            u["id"] for u in _get_users_by_email(email_address) if u.get("id")
+        )
+        cache.delete(_user_search_cache_key("1", email_address))
+    cache.delete_many(
+        [CACHE_KEY_COMM_CHANNELS_BY_CANVAS_USER_ID % i for i in canvas_user_ids]
+    )
+    return canvas_user_ids
@@ -0,0 +1,202 @@
+"""
+Client-side governor for Canvas API calls.
+
+Canvas meters API use with a per-token leaky bucket; every response carries
+the bucket's remaining quota in the X-Rate-Limit-Remaining header, and once
+it runs out requests fail with 403 Forbidden (Rate Limit Exceeded).  The
+throttle watches those responses and, as the quota gets low, both slows
+callers down and lets fewer calls run at once, rather than letting them run
+into the wall.
+
+The quota and any backoff pause are kept in the shared Redis cache, so the
+webhook, the bulk management commands and every worker process see the same
+picture.  Processes that do bulk work call set_background(), which makes
+them give way well before interactive callers do.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_REMAINING_HEADER = "X-Rate-Limit-Remaining"
+CACHE_KEY_REMAINING = "canvas-throttle:remaining"
+CACHE_KEY_PAUSE_UNTIL = "canvas-throttle:pause-until"
+
+# a reading of the remaining quota is only trusted for this long, since the
+# bucket refills when nobody is calling
+REMAINING_TIMEOUT = 60
+
+
+class CanvasThrottle(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+        self._in_flight = 0
+        # process-local copies, used if the shared cache is unavailable
+        self._remaining = None
+        self._pause_until = 0
+        self.background = False
+
+    @property
+    def cache(self):
+        return caches["shared"]
+
+    def set_background(self, background=True):
+        """
+        Marks this process as doing bulk work, which backs off at
+        CANVAS_THROTTLE_BACKGROUND_FACTOR times the low water mark so there's
+        quota left for the webhook.
+        """
+        self.background = background
+
+    def observe(self, response, *args, **kwargs):
+        """
+        Records the rate limit state from a Canvas response.  Can be used as
+        a requests response hook.
+        """
+        remaining = response.headers.get(RATE_LIMIT_REMAINING_HEADER)
+        if remaining is not None:
+            try:
+                self.set_remaining(float(remaining))
+            except ValueError:
+                pass
+        if response.status_code == 403 and "Rate Limit Exceeded" in response.text:
+            self.backoff()
+        return response
+
+    def set_remaining(self, remaining):
+        with self._lock:
+            self._remaining = remaining
+        try:
+            self.cache.set(CACHE_KEY_REMAINING, remaining, timeout=REMAINING_TIMEOUT)
+        except Exception:
+            logger.warning("Unable to share the Canvas rate limit state", exc_info=True)
+
+    def backoff(self):
+        """
+        Pauses all callers for CANVAS_THROTTLE_BACKOFF seconds, e.g. after
+        Canvas has refused a request for exceeding the rate limit.
+        """
+        logger.warning(
+            "Canvas rate limit exceeded, pausing Canvas calls for %ss",
+            settings.CANVAS_THROTTLE_BACKOFF,
+        )
+        pause_until = time.time() + settings.CANVAS_THROTTLE_BACKOFF
+        with self._lock:
+            self._pause_until = max(self._pause_until, pause_until)
+        try:
+            self.cache.set(
+                CACHE_KEY_PAUSE_UNTIL,
+                pause_until,
+                timeout=settings.CANVAS_THROTTLE_BACKOFF,
+            )
+        except Exception:
+            logger.warning("Unable to share the Canvas rate limit state", exc_info=True)
+        self.set_remaining(0)
+
+    def _state(self):
+        """
+        :return: (remaining, pause_until), preferring the shared values
+        """
+        try:
+            shared = self.cache.get_many([CACHE_KEY_REMAINING, CACHE_KEY_PAUSE_UNTIL])
+        except Exception:
+            shared = {}
+        with self._lock:
+            remaining = shared.get(CACHE_KEY_REMAINING, self._remaining)
+            pause_until = max(
+                shared.get(CACHE_KEY_PAUSE_UNTIL, 0) or 0, self._pause_until
+            )
+        return remaining, pause_until
+
+    def _low_water(self):
+        low_water = settings.CANVAS_THROTTLE_LOW_WATER
+        if self.background:
+            low_water *= settings.CANVAS_THROTTLE_BACKGROUND_FACTOR
+        return low_water
+
+    def _shortfall(self, remaining):
+        """
+        :return: 0 while the remaining quota is above the low water mark,
+            rising to 1 as it runs out
+        """
+        low_water = self._low_water()
+        if remaining is None or remaining >= low_water:
+            return 0
+        return (low_water - max(remaining, 0)) / low_water
+
+    def delay(self, state=None):
+        """
+        :param state: (remaining, pause_until) already read with _state()
+        :return: seconds to wait before the next Canvas call
+        """
+        remaining, pause_until = state or self._state()
+        pause = pause_until - time.time()
+        if pause > 0:
+            return pause
+        return settings.CANVAS_THROTTLE_MAX_DELAY * self._shortfall(remaining)
+
+    def concurrency(self, state=None):
+        """
+        :param state: (remaining, pause_until) already read with _state()
+        :return: how many Canvas calls this process may have in flight;
+            CANVAS_THROTTLE_MAX_CONCURRENCY with plenty of quota, down to 1
+        """
+        remaining, _ = state or self._state()
+        max_concurrency = settings.CANVAS_THROTTLE_MAX_CONCURRENCY
+        return max(1, round(max_concurrency * (1 - self._shortfall(remaining))))
+
+    def wait(self, state=None):
+        delay = self.delay(state)
+        if delay > 0:
+            logger.debug("Throttling Canvas calls for %.2fs", delay)
+            time.sleep(delay)
+
+    @contextmanager
+    def slot(self):
+        """
+        Wraps a Canvas call: waits for the throttle's delay, then for a free
+        slot under the current concurrency limit.  The shared state is read
+        once up front, and again only after waiting for a slot.
+        """
+        state = self._state()
+        self.wait(state)
+        while True:
+            limit = self.concurrency(state)
+            with self._slots:
+                if self._in_flight < limit:
+                    self._in_flight += 1
+                    break
+                self._slots.wait(timeout=1)
+            # the quota may have recovered while we waited; read it unlocked
+            state = self._state()
+        try:
+            yield
+        finally:
+            with self._slots:
+                self._in_flight -= 1
+                self._slots.notify()
+
+
+canvas_throttle = CanvasThrottle()
+
+
+def install_response_hook(request_context):
+    """
+    Has the throttle observe every response made through a canvas_sdk
+    RequestContext.
+    """
+    session = getattr(request_context, "session", None)
+    if session is None:
+        logger.error(
+            "%r has no session, so the Canvas throttle won't see its responses",
+            request_context,
+        )
+        return
+    session.hooks["response"].append(canvas_throttle.observe)
@@ -0,0 +1,168 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# shared by all requests in the process, so the number of Canvas calls in
+# flight at once stays bounded
+_executor = ThreadPoolExecutor(
+    max_workers=settings.CANVAS_MAX_CONCURRENT_REQUESTS,
+    thread_name_prefix="canvas-api",
+)
+# calls submitted to _executor and not yet finished, including ones their
+# caller has given up on.  once it's used up we fail fast instead of queueing
+# behind calls that are stuck on a slow Canvas.
+_pending = threading.BoundedSemaphore(settings.CANVAS_MAX_PENDING_REQUESTS)
+
+# time.monotonic() by which the call_concurrently() call running on this
+# thread has to be done
+_deadline = contextvars.ContextVar("canvas_call_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ExecutorBusy(DeadlineExceeded):
+    """
+    Raised instead of queueing calls when the shared pool is already full of
+    pending calls, since they'd only run into the deadline.
+    """
+
+
+def get_remaining_time():
+    """
+    :return: seconds left until the deadline of the call_concurrently() call
+        this is running under, or None outside of one
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def _call_with_deadline(deadline, func, *args):
+    token = _deadline.set(deadline)
+    try:
+        return func(*args)
+    finally:
+        _deadline.reset(token)
+
+
+def call_concurrently(calls, timeout=None, partial=False):
+    """
+    Runs independent calls (e.g. Canvas API lookups) at the same time, so the
+    caller waits for the slowest of them rather than all of them in turn.
+    The deadline is passed down to Canvas requests made through a session
+    with install_deadline_adapter(), so calls still running at the deadline
+    stop soon after.
+
+    :param calls: dict of name to (func, arg, ...) tuples
+    :param timeout: seconds to wait for all of them; defaults to
+        settings.CANVAS_REQUEST_DEADLINE
+    :param partial: if True, calls still running at the deadline, or that
+        couldn't be started because the pool was full, are logged and left
+        out of the result, rather than raising DeadlineExceeded
+    :return: dict of name to the return value of the call
+    :raises ExecutorBusy: if the pool is too full to start all of the calls
+    :raises DeadlineExceeded: if any call is still running at the deadline
+    :raises: the exception raised by a call, if one failed
+    """
+    if timeout is None:
+        timeout = settings.CANVAS_REQUEST_DEADLINE
+    deadline = time.monotonic() + timeout
+
+    pending_calls = _pending
+    futures = {}
+    not_started = []
+    for name, call in calls.items():
+        if not pending_calls.acquire(blocking=False):
+            not_started.append(name)
+            continue
+        future = _executor.submit(_call_with_deadline, deadline, *call)
+        # released when the call finishes or is cancelled, even if we've
+        # stopped waiting for it by then
+        future.add_done_callback(lambda _: pending_calls.release())
+        futures[name] = future
+    if not_started and not partial:
+        for future in futures.values():
+            future.cancel()
+        raise ExecutorBusy(
+            "Too many Canvas calls pending to start {}".format(
+                ", ".join(sorted(str(name) for name in not_started))
+            )
+        )
+
+    _, not_done = wait(futures.values(), timeout=timeout)
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        pending = sorted(str(name) for name, f in futures.items() if f in not_done)
+        if not partial:
+            raise DeadlineExceeded(
+                "{} still running after {}s".format(", ".join(pending), timeout)
+            )
+        logger.warning(
+            "Going ahead without %s, still running after %ss",
+            ", ".join(pending),
+            timeout,
+        )
+    if not_started:
+        logger.warning(
+            "Going ahead without %s, too many Canvas calls pending to start them",
+            ", ".join(sorted(str(name) for name in not_started)),
+        )
+    return {
+        name: future.result()
+        for name, future in futures.items()
+        if future not in not_done
+    }
+
+
+def _cap_timeout(timeout, remaining):
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(remaining if t is None else min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+class DeadlineAdapter(HTTPAdapter):
+    """
+    Caps the timeout of each request at the time left before the deadline of
+    the call_concurrently() call it's made under.
+    """
+
+    def send(self, request, timeout=None, **kwargs):
+        remaining = get_remaining_time()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded(
+                    "Deadline passed before requesting {}".format(request.url)
+                )
+            timeout = _cap_timeout(timeout, remaining)
+        return super(DeadlineAdapter, self).send(request, timeout=timeout, **kwargs)
+
+
+def install_deadline_adapter(request_context):
+    """
+    Has requests made through a canvas_sdk RequestContext honor the deadline
+    of the call_concurrently() call they're made under.
+    """
+    session = getattr(request_context, "session", None)
+    if session is None:
+        logger.error(
+            "%r has no session, so its Canvas calls won't be cut off at the "
+            "call_concurrently() deadline",
+            request_context,
+        )
+        return
+    adapter = DeadlineAdapter()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
@@ -4,3 +4,14 @@ class ListservApiError(Exception):
 
     def __str__(self):
         return repr(self.message)
+
+
+class ListservBatchError(ListservApiError):
+    """
+    Raised when some or all of the batches of a batched send failed.  The
+    BatchSendResult is available as `result`.
+    """
+
+    def __init__(self, message, result):
+        super(ListservBatchError, self).__init__(message)
+        self.result = result
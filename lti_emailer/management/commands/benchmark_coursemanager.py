@@ -0,0 +1,78 @@
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.signals import request_finished, request_started
+from django.db import connections
+
+from mailing_list.utils import get_section_sis_enrollment_status
+
+
+class Command(BaseCommand):
+    help = """
+        Times simulated requests that look up the SIS enrollment status of the
+        given sections in the coursemanager database, first with a new Oracle
+        connection per request (CONN_MAX_AGE 0), then with persistent
+        connections, to show what settings.COURSEMANAGER_CONN_MAX_AGE buys.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "sis_section_ids", nargs="+", help="SIS section ids to look up"
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=50,
+            help="Number of requests to simulate per mode (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--conn-max-age",
+            type=int,
+            default=settings.COURSEMANAGER_CONN_MAX_AGE or 300,
+            help="CONN_MAX_AGE to use for the persistent mode (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        for label, conn_max_age in (
+            ("per-request connections", 0),
+            ("persistent connections", options["conn_max_age"]),
+        ):
+            timings = self._run(
+                options["sis_section_ids"], options["requests"], conn_max_age
+            )
+            self.stdout.write(
+                "{} (CONN_MAX_AGE={}): mean {:.1f}ms, median {:.1f}ms, "
+                "p95 {:.1f}ms, max {:.1f}ms".format(
+                    label,
+                    conn_max_age,
+                    statistics.mean(timings),
+                    statistics.median(timings),
+                    statistics.quantiles(timings, n=20)[-1]
+                    if len(timings) > 1
+                    else timings[0],
+                    max(timings),
+                )
+            )
+
+    def _run(self, sis_section_ids, num_requests, conn_max_age):
+        connection = connections[settings.COURSE_SCHEMA_DB_NAME]
+        connection.close()
+        connection.settings_dict["CONN_MAX_AGE"] = conn_max_age
+        connection.settings_dict["CONN_HEALTH_CHECKS"] = conn_max_age != 0
+
+        timings = []
+        try:
+            for _ in range(num_requests):
+                # the request signals are what open/close connections per
+                # CONN_MAX_AGE, so simulate them around each "request"
+                start = time.perf_counter()
+                request_started.send(sender=self.__class__)
+                for sis_section_id in sis_section_ids:
+                    get_section_sis_enrollment_status(sis_section_id)
+                request_finished.send(sender=self.__class__)
+                timings.append((time.perf_counter() - start) * 1000)
+        finally:
+            connection.close()
+        return timings
@@ -0,0 +1,46 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lti_emailer.canvas_api_client import purge_cached_comm_channels
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = """
+        Drops the cached Canvas communication channels (and user search) for
+        the given email addresses and/or Canvas user ids, e.g. for a sender
+        who has just updated their email address in Canvas.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "email_addresses", nargs="*", help="Email addresses to purge"
+        )
+        parser.add_argument(
+            "--canvas-user-id",
+            dest="canvas_user_ids",
+            action="append",
+            default=[],
+            help="Canvas user id to purge; may be given more than once",
+        )
+
+    def handle(self, *args, **options):
+        if not options["email_addresses"] and not options["canvas_user_ids"]:
+            raise CommandError("Give at least one email address or --canvas-user-id")
+
+        purged = purge_cached_comm_channels(
+            canvas_user_ids=options["canvas_user_ids"]
+        )
+        for email_address in options["email_addresses"]:
+            purged |= purge_cached_comm_channels(email_address=email_address)
+        logger.info(
+            "Purged cached communication channels for canvas user id(s) %s",
+            sorted(purged, key=str),
+        )
+        self.stdout.write(
+            "Purged cached communication channels for {} Canvas user(s)".format(
+                len(purged)
+            )
+        )
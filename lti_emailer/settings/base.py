@@ -102,6 +102,13 @@ WSGI_APPLICATION = "lti_emailer.wsgi.application"
 
 DATABASE_ROUTERS = ["coursemanager.routers.CourseSchemaDatabaseRouter"]
 
+# How long, in seconds, to keep coursemanager (Oracle) connections open
+# between requests.  The default of 0 opens a new Oracle session for every
+# request; setting it to a positive value (or None, for unlimited) keeps one
+# persistent connection per worker thread, which Django health checks before
+# reusing.  See the benchmark_coursemanager command.
+COURSEMANAGER_CONN_MAX_AGE = SECURE_SETTINGS.get("db_coursemanager_conn_max_age", 0)
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.postgresql",
@@ -118,7 +125,8 @@ DATABASES = {
         "PASSWORD": SECURE_SETTINGS.get("db_coursemanager_password"),
         "HOST": SECURE_SETTINGS.get("db_coursemanager_host"),
         "PORT": str(SECURE_SETTINGS.get("db_coursemanager_port")),
-        "CONN_MAX_AGE": 0,
+        "CONN_MAX_AGE": COURSEMANAGER_CONN_MAX_AGE,
+        "CONN_HEALTH_CHECKS": COURSEMANAGER_CONN_MAX_AGE != 0,
     },
 }
 
@@ -175,6 +183,12 @@ USE_L10N = True
 
 USE_TZ = True
 
+# Always spool uploaded files (i.e. Mailgun attachments) to disk so they're
+# streamed back out to Mailgun instead of being held in worker memory
+FILE_UPLOAD_HANDLERS = [
+    "django.core.files.uploadhandler.TemporaryFileUploadHandler",
+]
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.2/howto/static-files/
 
@@ -328,6 +342,80 @@ CANVAS_SDK_SETTINGS = {
     "per_page": 40,
 }
 
+# Independent Canvas API calls made while handling a request are run in a
+# shared pool of this many threads (see lti_emailer.concurrency), and given
+# up on after CANVAS_REQUEST_DEADLINE seconds
+CANVAS_MAX_CONCURRENT_REQUESTS = SECURE_SETTINGS.get(
+    "canvas_max_concurrent_requests", 10
+)
+# Once this many calls are running or queued in that pool, new ones fail
+# right away instead of waiting behind them
+CANVAS_MAX_PENDING_REQUESTS = SECURE_SETTINGS.get(
+    "canvas_max_pending_requests", CANVAS_MAX_CONCURRENT_REQUESTS * 3
+)
+CANVAS_REQUEST_DEADLINE = SECURE_SETTINGS.get("canvas_request_deadline_secs", 20)
+# when a sender's address matches several Canvas users, their communication
+# channels are fetched concurrently, and whichever haven't arrived after this
+# many seconds are left out
+CANVAS_COMM_CHANNELS_DEADLINE = SECURE_SETTINGS.get(
+    "canvas_comm_channels_deadline_secs", 10
+)
+
+# Canvas calls are slowed down (by up to CANVAS_THROTTLE_MAX_DELAY seconds
+# each) once X-Rate-Limit-Remaining drops below CANVAS_THROTTLE_LOW_WATER, and
+# paused for CANVAS_THROTTLE_BACKOFF seconds if the rate limit is exceeded.
+# The state is shared between processes through the "shared" cache.  See
+# lti_emailer/canvas_throttle.py.
+CANVAS_THROTTLE_LOW_WATER = SECURE_SETTINGS.get("canvas_throttle_low_water", 200)
+CANVAS_THROTTLE_MAX_DELAY = SECURE_SETTINGS.get("canvas_throttle_max_delay_secs", 2)
+CANVAS_THROTTLE_BACKOFF = SECURE_SETTINGS.get("canvas_throttle_backoff_secs", 30)
+# Canvas calls a process may have in flight while quota is plentiful; this
+# shrinks towards 1 below the low water mark
+CANVAS_THROTTLE_MAX_CONCURRENCY = SECURE_SETTINGS.get(
+    "canvas_throttle_max_concurrency", 8
+)
+# bulk commands back off at this multiple of the low water mark, leaving the
+# rest of the quota to the webhook
+CANVAS_THROTTLE_BACKGROUND_FACTOR = SECURE_SETTINGS.get(
+    "canvas_throttle_background_factor", 2
+)
+
+# Concurrent fetches of the same course's users are coalesced into one (see
+# canvas_api_client.get_users_in_course).  The fetch's result is kept for
+# CANVAS_ROSTER_FETCH_RESULT_TIMEOUT seconds for callers waiting on it, and
+# they give up and fetch for themselves after CANVAS_ROSTER_FETCH_LOCK_TIMEOUT.
+CANVAS_ROSTER_FETCH_LOCK_TIMEOUT = SECURE_SETTINGS.get(
+    "canvas_roster_fetch_lock_timeout_secs", 30
+)
+CANVAS_ROSTER_FETCH_RESULT_TIMEOUT = SECURE_SETTINGS.get(
+    "canvas_roster_fetch_result_timeout_secs", 10
+)
+CANVAS_ROSTER_FETCH_POLL_INTERVAL = 0.1
+
+# Canvas user searches by email address are cached for
+# CANVAS_USER_SEARCH_CACHE_TIMEOUT seconds.  Searches that find nobody are
+# cached for CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT seconds.
+CANVAS_USER_SEARCH_CACHE_TIMEOUT = SECURE_SETTINGS.get(
+    "canvas_user_search_cache_timeout_secs", 60 * 5
+)
+CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT = SECURE_SETTINGS.get(
+    "canvas_user_search_miss_cache_timeout_secs", 60
+)
+
+# A user's Canvas communication channels are cached for this long when
+# checking whether a sender may post on behalf of a list member; a sender
+# that doesn't match the cached channels is always re-checked against Canvas.
+# Set to 0 to turn the cache off.
+CANVAS_COMM_CHANNELS_CACHE_TIMEOUT = SECURE_SETTINGS.get(
+    "canvas_comm_channels_cache_timeout_secs", 60
+)
+
+# A sender's enrollments in a course, looked up to check whether they may
+# post to its lists without fetching the whole roster, are cached this long
+CANVAS_SENDER_ENROLLMENTS_CACHE_TIMEOUT = SECURE_SETTINGS.get(
+    "canvas_sender_enrollments_cache_timeout_secs", 60 * 5
+)
+
 REPORT_DIR = SECURE_SETTINGS.get("report_dir", BASE_DIR)
 
 LISTSERV_DOMAIN = SECURE_SETTINGS.get("listserv_domain")
@@ -335,6 +423,22 @@ LISTSERV_API_URL = SECURE_SETTINGS.get("listserv_api_url")
 LISTSERV_API_USER = SECURE_SETTINGS.get("listserv_api_user")
 LISTSERV_API_KEY = str(SECURE_SETTINGS.get("listserv_api_key"))
 
+# Mailgun accepts at most 1,000 recipients per batch send; larger lists are
+# split into batches of this size, up to LISTSERV_BATCH_CONCURRENCY of which
+# are sent at once
+LISTSERV_BATCH_SIZE = SECURE_SETTINGS.get("listserv_batch_size", 1000)
+LISTSERV_BATCH_CONCURRENCY = SECURE_SETTINGS.get("listserv_batch_concurrency", 4)
+
+# (connect, read) timeouts in seconds, and the retry policy for 429s and 5xxs,
+# for calls to the Mailgun API
+LISTSERV_API_TIMEOUT = (
+    SECURE_SETTINGS.get("listserv_api_connect_timeout", 5),
+    SECURE_SETTINGS.get("listserv_api_read_timeout", 60),
+)
+LISTSERV_API_MAX_RETRIES = SECURE_SETTINGS.get("listserv_api_max_retries", 3)
+LISTSERV_API_BACKOFF_FACTOR = SECURE_SETTINGS.get("listserv_api_backoff_factor", 0.5)
+LISTSERV_API_BACKOFF_MAX = SECURE_SETTINGS.get("listserv_api_backoff_max", 10)
+
 LISTSERV_SECTION_ADDRESS_RE = re.compile(
     r"^canvas-(?P<canvas_course_id>\d+)-(?P<section_id>\d+)@%s$" % LISTSERV_DOMAIN
 )
@@ -357,14 +461,63 @@ LTI_SCHOOL_PERMISSIONS_TOOL_PERMISSIONS = (
 
 MAILGUN_CALLBACK_TIMEOUT = 30 * 1000  # 30 seconds
 
+# When set, the Mailgun route handler spools incoming mail to this queue and
+# returns immediately; the process_route_queue command does the delivery.
+# See mailgun/queues.py for the available backends.
+MAILGUN_ROUTE_QUEUE = SECURE_SETTINGS.get("mailgun_route_queue", None)
+
+# Number of messages the async (ASGI) route handler delivers at once, per process
+MAILGUN_ASYNC_MAX_CONCURRENCY = SECURE_SETTINGS.get(
+    "mailgun_async_max_concurrency", 32
+)
+
 IGNORE_WHITELIST = SECURE_SETTINGS.get("ignore_whitelist", False)
 
 CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID = "mailing_lists_by_canvas_course_id-%s"
+CACHE_KEY_LISTS_REFRESH_LOCK = "mailing_lists_refresh_lock-%s"
+# bumped whenever a course's cached lists are invalidated
+CACHE_KEY_LISTS_GENERATION = "mailing_lists_generation-%s"
+# The lists API payload for a course is served from the cache for
+# LISTS_CACHE_TIMEOUT seconds.  For LISTS_CACHE_STALE_TIMEOUT seconds after
+# that it's still served, while it's recomputed in the background.
+LISTS_CACHE_TIMEOUT = SECURE_SETTINGS.get("lists_cache_timeout_secs", 60 * 5)
+LISTS_CACHE_STALE_TIMEOUT = SECURE_SETTINGS.get(
+    "lists_cache_stale_timeout_secs", 60 * 60
+)
+
+# Max age, in seconds, of a course's locally stored roster before list
+# membership lookups fall back to Canvas.  Off (0) by default, so lookups
+# always go to Canvas.  When set, it is also how long a dropped enrollment can
+# keep receiving list mail, and live roster fetches in the route handler write
+# their changes to the stored roster.  Run refresh_roster_index (or
+# sync_listserv) periodically to keep the stored rosters fresh.
+ROSTER_INDEX_MAX_AGE = SECURE_SETTINGS.get("roster_index_max_age_secs", 0)
 
 CACHE_KEY_MESSAGE_HANDLED_BY_MESSAGE_ID_AND_RECIPIENT = (
     "lti_emailer:message-handled:%s:%s"
 )
 CACHE_KEY_MESSAGE_HANDLED_TIMEOUT = 60 * 60 * 8  # 8 hours
+# Seconds a message claimed for a list can go undelivered before a retry may
+# take it over, i.e. the longest we expect delivery to one list to take.
+# Keep it under the route queue's visibility timeout (10 minutes by default)
+# so redelivered messages aren't dropped.
+HANDLED_MESSAGE_LEASE = SECURE_SETTINGS.get("handled_message_lease_secs", 60 * 5)
+
+# canvas_course_id -> (short_title, school_id) of its primary course instance
+CACHE_KEY_PRIMARY_COURSE_BY_CANVAS_COURSE_ID = "lti_emailer:primary-course:%s"
+CACHE_KEY_PRIMARY_COURSE_TIMEOUT = SECURE_SETTINGS.get(
+    "primary_course_cache_timeout_secs", 60 * 60
+)
+# courses without a primary course instance are re-checked sooner
+CACHE_KEY_PRIMARY_COURSE_MISSING_TIMEOUT = 60 * 5
+
+# school_id -> super sender addresses; invalidated when a SuperSender changes
+CACHE_KEY_SUPER_SENDERS_BY_SCHOOL_ID = "lti_emailer:super-senders:%s"
+CACHE_KEY_SUPER_SENDERS_TIMEOUT = 60 * 60 * 24
+
+# version stamp of the EmailWhitelist, which each process keeps in memory;
+# bumped whenever an EmailWhitelist entry is saved or deleted
+CACHE_KEY_EMAIL_WHITELIST_VERSION = "lti_emailer:email-whitelist-version"
 
 NO_REPLY_ADDRESS = SECURE_SETTINGS.get(
     "no_reply_address", "no-reply@coursemail.harvard.edu"
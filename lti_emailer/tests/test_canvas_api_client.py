@@ -1,7 +1,26 @@
+import threading
+
+from django.core.cache.backends.locmem import LocMemCache
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import patch
 
-from lti_emailer.canvas_api_client import get_alternate_emails_for_user_email
+from lti_emailer.canvas_api_client import (
+    CACHE_KEY_COMM_CHANNELS_BY_CANVAS_USER_ID,
+    CACHE_KEY_USER_IN_ACCOUNT_BY_SEARCH_TERM,
+    CACHE_KEY_USERS_IN_COURSE_FETCH_LOCK,
+    CACHE_KEY_USERS_IN_COURSE_FETCH_RESULT,
+    course_roster_scope,
+    get_alternate_emails_for_user_email,
+    get_enrollments,
+    get_enrollments_for_email,
+    get_name_for_email,
+    get_teaching_staff_enrollments,
+    get_users_in_course,
+    purge_cached_comm_channels,
+    _get_users_by_email,
+    _list_user_comm_channels,
+)
 
 
 @patch("lti_emailer.canvas_api_client._get_users_by_email")
@@ -51,6 +70,35 @@ class GetAlternateEmailsForUserEmailTests(TestCase):
         self.assertIn(test_address_a, emails)
         self.assertIn(test_address_b, emails)
 
+    @override_settings(CANVAS_COMM_CHANNELS_DEADLINE=0.5)
+    def test_multiple_user_matches_partial_at_deadline(
+        self, mock_comm_channels, mock_users
+    ):
+        """
+        a user whose channels don't arrive by the deadline is left out
+        """
+        test_address = "a@b.c"
+        slow = threading.Event()
+        self.addCleanup(slow.set)
+
+        def list_user_comm_channels(user_id, use_cache):
+            if user_id == 2:
+                slow.wait(5)
+                address = "late@b.c"
+            else:
+                address = test_address
+            return [{"address": address, "type": "email", "workflow_state": "active"}]
+
+        mock_users.return_value = [
+            {"id": 1, "email": test_address},
+            {"id": 2, "email": test_address},
+        ]
+        mock_comm_channels.side_effect = list_user_comm_channels
+
+        emails = get_alternate_emails_for_user_email(test_address)
+
+        self.assertEqual(emails, [test_address])
+
     def test_valid_channel_filter(self, mock_comm_channels, mock_users):
         """
         should only return addresses for active email communication channels
@@ -105,3 +153,332 @@ class GetAlternateEmailsForUserEmailTests(TestCase):
         self.assertIsNotNone(emails)
         self.assertEqual(len(emails), 1)
         self.assertIn(test_address_a, emails)
+
+
+@patch("lti_emailer.canvas_api_client.is_allowed")
+@patch("lti_emailer.canvas_api_client.get_users_in_course")
+class CourseRosterTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.canvas_course_id = 123
+        self.users = [
+            {
+                "email": "student@example.edu",
+                "name": "Student",
+                "sortable_name": "Student",
+                "enrollments": [
+                    {"course_section_id": 1, "role": "StudentEnrollment"},
+                    {"course_section_id": 2, "role": "StudentEnrollment"},
+                ],
+            },
+            {
+                "email": "teacher@example.edu",
+                "name": "Teacher",
+                "sortable_name": "Teacher",
+                "enrollments": [{"course_section_id": 2, "role": "TeacherEnrollment"}],
+            },
+        ]
+
+    def _set_up_mocks(self, mock_get_users, mock_is_allowed):
+        mock_get_users.return_value = self.users
+        mock_is_allowed.side_effect = lambda roles, *args: roles == [
+            "TeacherEnrollment"
+        ]
+
+    def test_lookups_share_one_fetch_within_scope(self, mock_get_users, mock_is_allowed):
+        """
+        member, staff and display name lookups for the same course within a
+        roster scope should only fetch the course's users once
+        """
+        self._set_up_mocks(mock_get_users, mock_is_allowed)
+
+        with course_roster_scope():
+            course_enrollments = get_enrollments(self.canvas_course_id)
+            section_enrollments = get_enrollments(self.canvas_course_id, 2)
+            staff_enrollments = get_teaching_staff_enrollments(self.canvas_course_id)
+            name = get_name_for_email(self.canvas_course_id, "teacher@example.edu")
+
+        self.assertEqual(mock_get_users.call_count, 1)
+        # one enrollment per user for the whole course
+        self.assertEqual(
+            [e["email"] for e in course_enrollments],
+            ["student@example.edu", "teacher@example.edu"],
+        )
+        self.assertEqual(
+            {e["email"] for e in section_enrollments},
+            {"student@example.edu", "teacher@example.edu"},
+        )
+        self.assertEqual([e["email"] for e in staff_enrollments], ["teacher@example.edu"])
+        self.assertEqual(name, "Teacher")
+
+    def test_lookups_fetch_each_time_outside_scope(self, mock_get_users, mock_is_allowed):
+        self._set_up_mocks(mock_get_users, mock_is_allowed)
+
+        get_enrollments(self.canvas_course_id, 1)
+        get_name_for_email(self.canvas_course_id, "student@example.edu")
+
+        self.assertEqual(mock_get_users.call_count, 2)
+
+
+@override_settings(
+    CANVAS_ROSTER_FETCH_LOCK_TIMEOUT=5,
+    CANVAS_ROSTER_FETCH_RESULT_TIMEOUT=10,
+    CANVAS_ROSTER_FETCH_POLL_INTERVAL=0.01,
+)
+@patch("lti_emailer.canvas_api_client.canvas_api_helper_courses.get_users_in_course")
+class GetUsersInCourseTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.canvas_course_id = 123
+        self.users = [{"email": "student@example.edu", "enrollments": []}]
+        self.cache = LocMemCache("users-in-course-tests", {})
+        self.cache.clear()
+        patcher = patch("lti_emailer.canvas_api_client.cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.lock_key = CACHE_KEY_USERS_IN_COURSE_FETCH_LOCK % self.canvas_course_id
+        self.result_key = (
+            CACHE_KEY_USERS_IN_COURSE_FETCH_RESULT % self.canvas_course_id
+        )
+
+    def test_fetch_publishes_result_and_releases_lock(self, mock_get_users):
+        mock_get_users.return_value = self.users
+
+        self.assertEqual(get_users_in_course(self.canvas_course_id), self.users)
+        self.assertEqual(get_users_in_course(self.canvas_course_id), self.users)
+
+        self.assertEqual(
+            mock_get_users.call_count, 1, "the second call should reuse the result"
+        )
+        self.assertIsNone(self.cache.get(self.lock_key))
+
+    def test_waits_for_fetch_in_flight(self, mock_get_users):
+        self.cache.add(self.lock_key, True)
+
+        def finish_fetch():
+            self.cache.set(self.result_key, self.users)
+            self.cache.delete(self.lock_key)
+
+        timer = threading.Timer(0.05, finish_fetch)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(get_users_in_course(self.canvas_course_id), self.users)
+        mock_get_users.assert_not_called()
+
+    def test_fetches_itself_if_fetch_in_flight_fails(self, mock_get_users):
+        mock_get_users.return_value = self.users
+        self.cache.add(self.lock_key, True)
+
+        timer = threading.Timer(0.05, self.cache.delete, args=[self.lock_key])
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(get_users_in_course(self.canvas_course_id), self.users)
+        self.assertEqual(mock_get_users.call_count, 1)
+
+    def test_failed_fetch_releases_lock(self, mock_get_users):
+        mock_get_users.side_effect = RuntimeError("Canvas is down")
+
+        with self.assertRaises(RuntimeError):
+            get_users_in_course(self.canvas_course_id)
+
+        self.assertIsNone(self.cache.get(self.lock_key))
+        self.assertIsNone(self.cache.get(self.result_key))
+
+
+@override_settings(
+    CANVAS_USER_SEARCH_CACHE_TIMEOUT=300,
+    CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT=60,
+)
+@patch("lti_emailer.canvas_api_client.get_all_list_data")
+class GetUsersByEmailTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.cache = LocMemCache("users-by-email-tests", {})
+        self.cache.clear()
+        patcher = patch("lti_emailer.canvas_api_client.cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_users_found_are_cached(self, mock_get_all_list_data):
+        users = [{"id": 1, "email": "a@b.c"}]
+        mock_get_all_list_data.return_value = users
+
+        with patch.object(self.cache, "set", wraps=self.cache.set) as mock_set:
+            self.assertEqual(_get_users_by_email("a@b.c"), users)
+        self.assertEqual(_get_users_by_email("a@b.c"), users)
+
+        self.assertEqual(mock_get_all_list_data.call_count, 1)
+        self.assertEqual(mock_set.call_args[1]["timeout"], 300)
+
+    def test_no_users_found_is_cached_for_less_time(self, mock_get_all_list_data):
+        mock_get_all_list_data.return_value = []
+
+        with patch.object(self.cache, "set", wraps=self.cache.set) as mock_set:
+            self.assertEqual(_get_users_by_email("spam@example.com"), [])
+        self.assertEqual(_get_users_by_email("spam@example.com"), [])
+
+        self.assertEqual(
+            mock_get_all_list_data.call_count,
+            1,
+            "an unknown sender shouldn't be searched for on every message",
+        )
+        self.assertEqual(mock_set.call_args[1]["timeout"], 60)
+
+    def test_long_search_terms_are_hashed(self, mock_get_all_list_data):
+        mock_get_all_list_data.return_value = []
+        address = "{}@example.com".format("x" * 300)
+
+        _get_users_by_email(address)
+
+        self.assertIsNone(
+            self.cache.get(CACHE_KEY_USER_IN_ACCOUNT_BY_SEARCH_TERM.format("1", address))
+        )
+        self.assertEqual(_get_users_by_email(address), [])
+        self.assertEqual(mock_get_all_list_data.call_count, 1)
+
+    def test_search_term_case_is_normalized(self, mock_get_all_list_data):
+        users = [{"id": 1, "email": "a@b.c"}]
+        mock_get_all_list_data.return_value = users
+
+        self.assertEqual(_get_users_by_email(" A@B.c "), users)
+        self.assertEqual(_get_users_by_email("a@b.C"), users)
+
+        self.assertEqual(mock_get_all_list_data.call_count, 1)
+        self.assertEqual(mock_get_all_list_data.call_args[1]["search_term"], "a@b.c")
+
+    def test_purge_drops_the_search_for_any_case(self, mock_get_all_list_data):
+        mock_get_all_list_data.return_value = [{"id": 1, "email": "a@b.c"}]
+        _get_users_by_email("a@b.c")
+
+        purge_cached_comm_channels("A@B.C")
+
+        self.assertIsNone(
+            self.cache.get(CACHE_KEY_USER_IN_ACCOUNT_BY_SEARCH_TERM.format("1", "a@b.c"))
+        )
+
+
+@override_settings(CANVAS_COMM_CHANNELS_CACHE_TIMEOUT=60)
+@patch("lti_emailer.canvas_api_client.get_all_list_data")
+class ListUserCommChannelsTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.cache = LocMemCache("comm-channels-tests", {})
+        self.cache.clear()
+        patcher = patch("lti_emailer.canvas_api_client.cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channels = [{"type": "email", "address": "a@b.c"}]
+
+    def test_not_read_from_cache_by_default(self, mock_get_all_list_data):
+        mock_get_all_list_data.return_value = self.channels
+
+        _list_user_comm_channels(1)
+        _list_user_comm_channels(1)
+
+        self.assertEqual(mock_get_all_list_data.call_count, 2)
+
+    def test_opt_in_cache_is_filled_by_fresh_fetches(self, mock_get_all_list_data):
+        mock_get_all_list_data.return_value = self.channels
+
+        _list_user_comm_channels(1)
+        self.assertEqual(_list_user_comm_channels(1, use_cache=True), self.channels)
+
+        self.assertEqual(mock_get_all_list_data.call_count, 1)
+
+    @override_settings(CANVAS_COMM_CHANNELS_CACHE_TIMEOUT=0)
+    def test_cache_can_be_turned_off(self, mock_get_all_list_data):
+        mock_get_all_list_data.return_value = self.channels
+
+        _list_user_comm_channels(1, use_cache=True)
+        _list_user_comm_channels(1, use_cache=True)
+
+        self.assertEqual(mock_get_all_list_data.call_count, 2)
+
+    @patch("lti_emailer.canvas_api_client._get_users_by_email")
+    def test_purge(self, mock_get_users, mock_get_all_list_data):
+        mock_get_users.return_value = [{"id": 1}, {"id": 2}]
+        for user_id in (1, 2, 3):
+            self.cache.set(CACHE_KEY_COMM_CHANNELS_BY_CANVAS_USER_ID % user_id, [])
+
+        purged = purge_cached_comm_channels("a@b.c", canvas_user_ids=[3])
+
+        self.assertEqual(purged, {1, 2, 3})
+        for user_id in (1, 2, 3):
+            self.assertIsNone(
+                self.cache.get(CACHE_KEY_COMM_CHANNELS_BY_CANVAS_USER_ID % user_id)
+            )
+
+
+@override_settings(
+    CANVAS_SENDER_ENROLLMENTS_CACHE_TIMEOUT=300,
+    CANVAS_USER_SEARCH_MISS_CACHE_TIMEOUT=60,
+)
+@patch("lti_emailer.canvas_api_client.get_all_list_data")
+@patch("lti_emailer.canvas_api_client._get_users_by_email")
+class GetEnrollmentsForEmailTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.cache = LocMemCache("enrollments-for-email-tests", {})
+        self.cache.clear()
+        patcher = patch("lti_emailer.canvas_api_client.cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_looks_up_matching_users_enrollments(
+        self, mock_get_users, mock_get_all_list_data
+    ):
+        mock_get_users.return_value = [
+            {"id": 1, "email": "Student@Example.edu", "name": "Student"},
+            {"id": 2, "email": "student@example.edu.other", "name": "Other"},
+        ]
+        mock_get_all_list_data.return_value = [
+            {"course_section_id": 5, "role": "StudentEnrollment"}
+        ]
+
+        enrollments = get_enrollments_for_email(123, "student@example.edu")
+        self.assertEqual(
+            get_enrollments_for_email(123, "student@example.edu"), enrollments
+        )
+
+        self.assertEqual(
+            mock_get_all_list_data.call_count,
+            1,
+            "only the exact match's enrollments should be fetched, and only once",
+        )
+        self.assertEqual(mock_get_all_list_data.call_args[1], {"user_id": 1})
+        self.assertEqual(enrollments[0]["name"], "Student")
+
+    @patch("lti_emailer.canvas_api_client.is_allowed")
+    @patch("lti_emailer.canvas_api_client.get_users_in_course")
+    def test_uses_scoped_roster(
+        self,
+        mock_get_users_in_course,
+        mock_is_allowed,
+        mock_get_users,
+        mock_get_all_list_data,
+    ):
+        mock_is_allowed.return_value = False
+        mock_get_users_in_course.return_value = [
+            {
+                "email": "student@example.edu",
+                "name": "Student",
+                "enrollments": [
+                    {"course_section_id": 5, "role": "StudentEnrollment"}
+                ],
+            }
+        ]
+
+        with course_roster_scope():
+            get_enrollments(123)
+            enrollments = get_enrollments_for_email(123, "Student@example.edu")
+
+        self.assertEqual([e["course_section_id"] for e in enrollments], [5])
+        mock_get_users.assert_not_called()
+        mock_get_all_list_data.assert_not_called()
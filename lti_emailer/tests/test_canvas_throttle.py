@@ -0,0 +1,107 @@
+from django.core.cache import caches
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import MagicMock, patch
+
+from lti_emailer.canvas_throttle import CanvasThrottle, install_response_hook
+
+
+@override_settings(
+    CANVAS_THROTTLE_LOW_WATER=200,
+    CANVAS_THROTTLE_MAX_DELAY=2,
+    CANVAS_THROTTLE_BACKOFF=30,
+    CANVAS_THROTTLE_MAX_CONCURRENCY=8,
+    CANVAS_THROTTLE_BACKGROUND_FACTOR=2,
+    CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        "shared": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "canvas-throttle-tests",
+        },
+    },
+)
+class CanvasThrottleTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        caches["shared"].clear()
+
+    def _response(self, remaining=None, status_code=200, text=""):
+        headers = {}
+        if remaining is not None:
+            headers["X-Rate-Limit-Remaining"] = str(remaining)
+        return MagicMock(headers=headers, status_code=status_code, text=text)
+
+    def test_no_delay_with_plenty_of_quota(self):
+        throttle = CanvasThrottle()
+        self.assertEqual(throttle.delay(), 0)
+        throttle.observe(self._response(remaining=650.5))
+        self.assertEqual(throttle.delay(), 0)
+
+    def test_delay_grows_as_quota_runs_out(self):
+        throttle = CanvasThrottle()
+        throttle.observe(self._response(remaining=150))
+        self.assertAlmostEqual(throttle.delay(), 0.5)
+        throttle.observe(self._response(remaining=0))
+        self.assertAlmostEqual(throttle.delay(), 2)
+
+    def test_rate_limit_exceeded_pauses_calls(self):
+        throttle = CanvasThrottle()
+        throttle.observe(
+            self._response(status_code=403, text="403 Forbidden (Rate Limit Exceeded)")
+        )
+        self.assertGreater(throttle.delay(), 29)
+
+    def test_state_is_shared_between_throttles(self):
+        CanvasThrottle().observe(self._response(remaining=100))
+        self.assertAlmostEqual(
+            CanvasThrottle().delay(),
+            1,
+            "another process should see the quota reported to this one",
+        )
+
+    def test_backoff_is_shared_between_throttles(self):
+        CanvasThrottle().backoff()
+        self.assertGreater(CanvasThrottle().delay(), 29)
+
+    def test_concurrency_shrinks_as_quota_runs_out(self):
+        throttle = CanvasThrottle()
+        self.assertEqual(throttle.concurrency(), 8)
+        throttle.observe(self._response(remaining=100))
+        self.assertEqual(throttle.concurrency(), 4)
+        throttle.observe(self._response(remaining=0))
+        self.assertEqual(throttle.concurrency(), 1)
+
+    def test_background_work_gives_way_first(self):
+        interactive = CanvasThrottle()
+        background = CanvasThrottle()
+        background.set_background()
+        interactive.observe(self._response(remaining=300))
+        self.assertEqual(interactive.delay(), 0)
+        self.assertAlmostEqual(background.delay(), 0.5)
+        self.assertEqual(background.concurrency(), 6)
+
+    def test_slot_tracks_calls_in_flight(self):
+        throttle = CanvasThrottle()
+        with throttle.slot():
+            with throttle.slot():
+                self.assertEqual(throttle._in_flight, 2)
+        self.assertEqual(throttle._in_flight, 0)
+
+    def test_slot_reads_the_shared_state_once(self):
+        throttle = CanvasThrottle()
+        throttle.observe(self._response(remaining=650))
+        with patch.object(throttle, "_state", wraps=throttle._state) as mock_state:
+            with throttle.slot():
+                pass
+        self.assertEqual(mock_state.call_count, 1)
+
+    def test_response_hook_is_installed_on_the_session(self):
+        request_context = MagicMock(session=MagicMock(hooks={"response": []}))
+        install_response_hook(request_context)
+        self.assertEqual(len(request_context.session.hooks["response"]), 1)
+
+    @patch("lti_emailer.canvas_throttle.logger")
+    def test_missing_session_is_logged(self, mock_logger):
+        install_response_hook(object())
+        self.assertEqual(mock_logger.error.call_count, 1)
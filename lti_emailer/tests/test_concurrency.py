@@ -0,0 +1,85 @@
+import threading
+
+from django.test import TestCase
+from mock import patch
+
+from lti_emailer.concurrency import (
+    DeadlineExceeded,
+    ExecutorBusy,
+    _cap_timeout,
+    call_concurrently,
+    get_remaining_time,
+)
+
+
+class CallConcurrentlyTests(TestCase):
+    longMessage = True
+
+    def test_results_are_keyed_by_name(self):
+        results = call_concurrently({"a": (lambda x: x * 2, 2), "b": (str.upper, "b")})
+        self.assertEqual(results, {"a": 4, "b": "B"})
+
+    def test_calls_run_at_the_same_time(self):
+        # each call waits for the other, so this deadlocks if run serially
+        barrier = threading.Barrier(2, timeout=5)
+        results = call_concurrently(
+            {"a": (barrier.wait,), "b": (barrier.wait,)}, timeout=10
+        )
+        self.assertEqual(sorted(results.values()), [0, 1])
+
+    def test_deadline(self):
+        event = threading.Event()
+        try:
+            with self.assertRaises(DeadlineExceeded):
+                call_concurrently({"slow": (event.wait, 5)}, timeout=0.1)
+        finally:
+            event.set()
+
+    def test_exceptions_are_raised(self):
+        with self.assertRaises(ZeroDivisionError):
+            call_concurrently({"a": (divmod, 1, 0)})
+
+    def test_partial_results_at_deadline(self):
+        event = threading.Event()
+        try:
+            results = call_concurrently(
+                {"fast": (str.upper, "a"), "slow": (event.wait, 5)},
+                timeout=0.5,
+                partial=True,
+            )
+        finally:
+            event.set()
+        self.assertEqual(results, {"fast": "A"})
+
+    def test_calls_know_their_deadline(self):
+        results = call_concurrently({"remaining": (get_remaining_time,)}, timeout=10)
+        self.assertTrue(0 < results["remaining"] <= 10)
+        self.assertIsNone(get_remaining_time())
+
+    @patch(
+        "lti_emailer.concurrency._pending", new_callable=lambda: threading.Semaphore(1)
+    )
+    def test_busy_pool_fails_fast(self, mock_pending):
+        event = threading.Event()
+        try:
+            with self.assertRaises(ExecutorBusy):
+                call_concurrently({"a": (event.wait, 5), "b": (event.wait, 5)})
+        finally:
+            event.set()
+
+    @patch(
+        "lti_emailer.concurrency._pending", new_callable=lambda: threading.Semaphore(1)
+    )
+    def test_busy_pool_partial_results(self, mock_pending):
+        results = call_concurrently(
+            {"a": (str.upper, "a"), "b": (str.upper, "b")}, partial=True
+        )
+        self.assertEqual(len(results), 1)
+
+
+class CapTimeoutTests(TestCase):
+    def test_timeouts_are_capped_at_the_time_remaining(self):
+        self.assertEqual(_cap_timeout(None, 5), 5)
+        self.assertEqual(_cap_timeout(30, 5), 5)
+        self.assertEqual(_cap_timeout(3, 5), 3)
+        self.assertEqual(_cap_timeout((3, 30), 5), (3, 5))
@@ -0,0 +1,59 @@
+import os
+import threading
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Only statuses where Mailgun is known not to have accepted the message; a
+# 500/502/504 or a read timeout may follow a send that went through, so those
+# are left to Mailgun's webhook retry, which the HandledMessage and
+# PartialDelivery ledgers keep from double-sending.
+RETRY_STATUS_CODES = (429, 503)
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def _build_session():
+    retry = Retry(
+        total=settings.LISTSERV_API_MAX_RETRIES,
+        backoff_factor=settings.LISTSERV_API_BACKOFF_FACTOR,
+        backoff_max=settings.LISTSERV_API_BACKOFF_MAX,
+        read=0,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(["GET", "POST"]),
+        respect_retry_after_header=True,
+        # hand the last response back rather than raising, so callers report
+        # Mailgun's error body
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=max(settings.LISTSERV_BATCH_CONCURRENCY, 10),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Returns the process-wide requests Session for the Mailgun API, which
+    keeps TLS connections alive between calls and retries connect errors,
+    429s and 503s with exponential backoff, honoring Retry-After.  Rebuilt
+    after a fork so worker processes don't share sockets.  Pass
+    settings.LISTSERV_API_TIMEOUT as the timeout on each request; requests
+    has no session-wide timeout.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
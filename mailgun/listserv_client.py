@@ -1,18 +1,41 @@
 import logging
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 
 from harvard_django_utils.utils import ApiRequestTimer
 
-from lti_emailer.exceptions import ListservApiError
-from mailgun.utils import replace_non_ascii
+from lti_emailer.exceptions import ListservApiError, ListservBatchError
+from mailgun.api_session import get_session
+from mailgun.utils import MultipartStream, replace_non_ascii
 
 
 logger = logging.getLogger(__name__)
 
 
+class BatchSendResult(object):
+    """
+    The outcome of a send_mail call.  `sent` holds the recipients of the
+    batches Mailgun accepted, and `failed` a (recipients, error) tuple for
+    each batch it didn't.
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.failed = []
+
+    @property
+    def ok(self):
+        return not self.failed
+
+    def __repr__(self):
+        return "<BatchSendResult sent={} failed={}>".format(
+            len(self.sent), sum(len(r) for r, _ in self.failed)
+        )
+
+
 class MailgunClient(object):
     """
     Listserv client for the Mailgun API
@@ -41,7 +64,13 @@ class MailgunClient(object):
         inlines=None,
         encapsulated_msg_att=None,
         message_id=None,
+        recipient_list_addresses=None,
     ):
+        """
+        Sends a message from list_address to to_address.  When one send
+        covers several lists, recipient_list_addresses maps each recipient to
+        the list it's getting the message from, for its List-Id header.
+        """
         api_url = "%s%s/messages" % (
             settings.LISTSERV_API_URL,
             settings.LISTSERV_DOMAIN,
@@ -61,9 +90,13 @@ class MailgunClient(object):
             "html": html,
             "subject": subject,
             "text": text,
-            "to": to_address,
         }
 
+        # Mailgun fills in each recipient's own list from the recipient
+        # variables _send_batch() passes along
+        if recipient_list_addresses and not isinstance(to_address, str):
+            payload["h:List-Id"] = "<%recipient.list_address%>"
+
         # mailgun rejects emails with empty text and html bodies.  if both
         # are empty, use a single space as the text body to work around that.
         if not html and not text:
@@ -91,16 +124,6 @@ class MailgunClient(object):
         if cc_list:
             payload["h:cc"] = ",".join(cc_list)
 
-        # we accept a single address or a list of addresses in to_address.
-        # if it's a list, add in recipient_variables to make sure mailgun
-        # doesn't include the whole list in the to: field, per
-        #   https://documentation.mailgun.com/user_manual.html#batch-sending
-        if not isinstance(to_address, str):
-            # the recipient variables aren't actually used, so we just send a fake dict
-            recip_var_dict = {"k": "v"}
-            recipient_variables = {e: recip_var_dict for e in to_address}
-            payload["recipient-variables"] = json.dumps(recipient_variables)
-
         # We need to replace non-ascii characters in attachment filenames
         # because Mailgun does not support RFC 2231
         # See http://stackoverflow.com/questions/24397418/python-requests-issues-with-non-ascii-file-names
@@ -122,21 +145,122 @@ class MailgunClient(object):
         if encapsulated_msg_att:
             files.extend(
                 [
-                    ("attachment", (replace_non_ascii(value[0] + ".eml"), value[1]))
+                    (
+                        "attachment",
+                        (
+                            replace_non_ascii(value[0] + ".eml"),
+                            value[1],
+                            "message/rfc822",
+                        ),
+                    )
                     for key, value in encapsulated_msg_att.items()
                 ]
             )
 
-        with ApiRequestTimer(logger, "POST", api_url, payload) as timer:
-            response = requests.post(
-                api_url, auth=(self.api_user, self.api_key), data=payload, files=files
+        # we accept a single address or a list of addresses in to_address.
+        # lists are split into batches no bigger than Mailgun allows, which
+        # are sent concurrently.
+        if isinstance(to_address, str):
+            batches = [to_address]
+        else:
+            to_address = list(to_address)
+            batch_size = settings.LISTSERV_BATCH_SIZE
+            batches = [
+                to_address[i : i + batch_size]
+                for i in range(0, len(to_address), batch_size)
+            ]
+
+        result = BatchSendResult()
+        if len(batches) <= 1:
+            # the common case; no need for a thread pool
+            for batch in batches:
+                self._send_batch(
+                    api_url, payload, files, batch, recipient_list_addresses
+                )
+                result.sent.extend([batch] if isinstance(batch, str) else batch)
+            return result
+
+        workers = min(settings.LISTSERV_BATCH_CONCURRENCY, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (
+                    batch,
+                    executor.submit(
+                        self._send_batch,
+                        api_url,
+                        payload,
+                        files,
+                        batch,
+                        recipient_list_addresses,
+                    ),
+                )
+                for batch in batches
+            ]
+            for batch, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    result.failed.append((batch, e))
+                else:
+                    result.sent.extend(batch)
+
+        if result.failed:
+            logger.error(
+                "Failed to send %d of %d batches of email from %s to list %s: %s",
+                len(result.failed),
+                len(batches),
+                from_address,
+                list_address,
+                result,
+            )
+            raise ListservBatchError(
+                "; ".join(str(e) for _, e in result.failed), result
+            )
+        return result
+
+    def _send_batch(
+        self, api_url, payload, files, to_address, recipient_list_addresses=None
+    ):
+        payload = dict(payload, to=to_address)
+
+        # if to_address is a list, add in recipient_variables to make sure
+        # mailgun doesn't include the whole list in the to: field, per
+        #   https://documentation.mailgun.com/user_manual.html#batch-sending
+        if not isinstance(to_address, str):
+            if recipient_list_addresses:
+                recipient_variables = {
+                    e: {"list_address": recipient_list_addresses[e]} for e in to_address
+                }
+            else:
+                # the recipient variables aren't used, so we just send a fake dict
+                recip_var_dict = {"k": "v"}
+                recipient_variables = {e: recip_var_dict for e in to_address}
+            payload["recipient-variables"] = json.dumps(recipient_variables)
+
+        # stream the body from the (temp-file backed) uploads instead of
+        # letting requests build the whole multipart body in memory
+        body = MultipartStream(list(payload.items()), files)
+
+        try:
+            with ApiRequestTimer(logger, "POST", api_url, payload) as timer:
+                response = get_session().post(
+                    api_url,
+                    auth=(self.api_user, self.api_key),
+                    data=body,
+                    headers={"Content-Type": body.content_type},
+                    timeout=settings.LISTSERV_API_TIMEOUT,
+                )
+                timer.status_code = response.status_code
+        except requests.exceptions.RequestException as e:
+            logger.exception(
+                "Failed to POST email from %s to %s", payload["h:Reply-To"], to_address
             )
-            timer.status_code = response.status_code
+            raise ListservApiError(str(e))
 
         if response.status_code != 200:
             logger.error(
                 "Failed to POST email from %s to %s.  Status code was %s, body was %s",
-                from_address,
+                payload["h:Reply-To"],
                 to_address,
                 response.status_code,
                 response.text,
@@ -3,6 +3,9 @@ import requests
 
 from django.conf import settings
 from django.core.management.base import CommandError
+from harvard_django_utils.utils import ApiRequestTimer
+
+from mailgun.api_session import get_session
 
 
 DATE_FORMAT = "%a, %d %b %Y %H:%M:%S %z"
@@ -11,6 +14,16 @@ EVENTS_MAX_PAGE_SIZE = 300
 logger = logging.getLogger(__name__)
 
 
+def _get(url, auth, params=None):
+    with ApiRequestTimer(logger, "GET", url, params) as timer:
+        resp = get_session().get(
+            url, auth=auth, params=params, timeout=settings.LISTSERV_API_TIMEOUT
+        )
+        timer.status_code = resp.status_code
+    resp.raise_for_status()
+    return resp
+
+
 def get_events(begin, end, event_types, **filter_kwargs):
     # prime the pump
     url = "{}{}/events".format(settings.LISTSERV_API_URL, settings.LISTSERV_DOMAIN)
@@ -22,16 +35,17 @@ def get_events(begin, end, event_types, **filter_kwargs):
         "event": " OR ".join(event_types),
     }
     params.update(filter_kwargs)
-    resp = requests.get(url, auth=auth, params=params)
-    resp.raise_for_status()
+    try:
+        resp = _get(url, auth, params)
+    except requests.exceptions.RequestException as e:
+        raise CommandError(str(e))
     events = resp.json()["items"]
 
     # follow 'next' links until we get a blank page
     while True:
         url = resp.json()["paging"]["next"]
         try:
-            resp = requests.get(url, auth=auth)
-            resp.raise_for_status()
+            resp = _get(url, auth)
         except requests.exceptions.RequestException as e:
             raise CommandError(str(e))
         page = resp.json()["items"]
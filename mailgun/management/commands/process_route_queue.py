@@ -0,0 +1,73 @@
+import json
+import logging
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailgun.exceptions import HttpResponseException
+from mailgun.queues import get_route_queue
+from mailgun.route_handlers import handle_message
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delivers Mailgun route POSTs spooled to the MAILGUN_ROUTE_QUEUE"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            default=False,
+            help="Exit once the queue is empty instead of polling for new messages",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between polls of an empty queue (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        route_queue = get_route_queue()
+        if route_queue is None:
+            raise CommandError("settings.MAILGUN_ROUTE_QUEUE is not configured")
+
+        logger.info("Starting route queue worker for %s", type(route_queue).__name__)
+        while True:
+            message = route_queue.claim()
+            if message is None:
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+            self.process_message(route_queue, message)
+
+    def process_message(self, route_queue, message):
+        logger.info(
+            "Processing queued route message %s, attempt %d",
+            message.queue_id,
+            message.attempts,
+        )
+        try:
+            handle_message(message)
+        except HttpResponseException as e:
+            # the handler has already dealt with the sender (e.g. bounced a
+            # message with missing attachments), so don't retry it
+            logger.exception(
+                "HttpResponseException thrown by route handler for queued "
+                "message %s, dropping it.  Response: %s.  POST data: %s",
+                message.queue_id,
+                e.response,
+                json.dumps(message.POST, sort_keys=True),
+            )
+        except Exception:
+            logger.exception(
+                "Unhandled exception processing queued message %s; will retry. "
+                "POST data:\n%s\n",
+                message.queue_id,
+                json.dumps(message.POST, sort_keys=True),
+            )
+            route_queue.nack(message)
+            return
+        route_queue.ack(message)
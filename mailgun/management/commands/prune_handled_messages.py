@@ -0,0 +1,30 @@
+import datetime
+import logging
+
+from django.core.management.base import BaseCommand
+
+from mailgun.models import HandledMessage, PartialDelivery
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes old entries from the handled message (de-duplication) ledger "
+        "and the record of partly delivered messages"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=7,
+            help="Delete entries older than this many days (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        max_age = datetime.timedelta(days=options["days"])
+        deleted = HandledMessage.objects.delete_expired(max_age)
+        deleted += PartialDelivery.objects.delete_expired(max_age)
+        logger.info("Pruned %d handled message ledger entries", deleted)
+        self.stdout.write("Deleted {} ledger entries".format(deleted))
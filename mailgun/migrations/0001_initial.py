@@ -0,0 +1,65 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="QueuedRouteMessage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("post_data", models.JSONField()),
+                (
+                    "status",
+                    models.CharField(db_index=True, default="new", max_length=16),
+                ),
+                ("attempts", models.IntegerField(default=0)),
+                ("date_created", models.DateTimeField(auto_now_add=True)),
+                ("date_claimed", models.DateTimeField(null=True)),
+            ],
+            options={
+                "db_table": "mg_queued_route_message",
+            },
+        ),
+        migrations.CreateModel(
+            name="QueuedRouteAttachment",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("field_name", models.CharField(max_length=64)),
+                ("name", models.CharField(max_length=255)),
+                ("content_type", models.CharField(max_length=255, null=True)),
+                ("content", models.BinaryField()),
+                (
+                    "message",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="attachments",
+                        to="mailgun.queuedroutemessage",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "mg_queued_route_attachment",
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailgun", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HandledMessage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("message_id", models.CharField(max_length=998)),
+                ("list_address", models.CharField(max_length=254)),
+                (
+                    "date_created",
+                    models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+            ],
+            options={
+                "db_table": "mg_handled_message",
+                "unique_together": {("message_id", "list_address")},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailgun", "0002_handledmessage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PartialDelivery",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("message_id", models.CharField(max_length=998)),
+                ("list_address", models.CharField(max_length=254)),
+                ("sent_addresses", models.JSONField(default=list)),
+                (
+                    "date_created",
+                    models.DateTimeField(auto_now_add=True, db_index=True),
+                ),
+            ],
+            options={
+                "db_table": "mg_partial_delivery",
+                "unique_together": {("message_id", "list_address")},
+            },
+        ),
+    ]
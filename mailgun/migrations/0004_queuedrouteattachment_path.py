@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailgun", "0003_partialdelivery"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="queuedrouteattachment",
+            name="content",
+        ),
+        migrations.AddField(
+            model_name="queuedrouteattachment",
+            name="path",
+            field=models.CharField(default="", max_length=255),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailgun", "0004_queuedrouteattachment_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="handledmessage",
+            name="status",
+            # existing entries keep blocking retries, as they did before
+            field=models.CharField(default="done", max_length=16),
+        ),
+        migrations.AlterField(
+            model_name="handledmessage",
+            name="status",
+            field=models.CharField(default="in_progress", max_length=16),
+        ),
+        migrations.AddField(
+            model_name="handledmessage",
+            name="date_leased",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,238 @@
+import datetime
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class HandledMessageManager(models.Manager):
+    """
+    Idempotency ledger for the route handler.  A message is claimed for a list
+    in the cache (an atomic add) and then durably in the database, so Mailgun
+    retries are dropped even if the cache entry has been evicted.
+
+    A claim is a lease of settings.HANDLED_MESSAGE_LEASE seconds until it's
+    marked done.  If the claimant dies mid-delivery without releasing it (a
+    worker timeout, OOM kill or deploy), the next retry takes it over once
+    the lease has run out instead of dropping the message as a duplicate.
+    """
+
+    def _cache_key(self, message_id, list_address):
+        return settings.CACHE_KEY_MESSAGE_HANDLED_BY_MESSAGE_ID_AND_RECIPIENT % (
+            message_id,
+            list_address,
+        )
+
+    def claim(self, message_id, list_address):
+        """
+        Records that we're handling message_id for list_address.
+        :return: False if the message was already handled for that list, or
+            is being handled under a lease that hasn't expired
+        """
+        if not cache.add(
+            self._cache_key(message_id, list_address),
+            True,
+            timeout=settings.HANDLED_MESSAGE_LEASE,
+        ):
+            return False
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                _, created = self.get_or_create(
+                    message_id=message_id,
+                    list_address=list_address,
+                    defaults={"date_leased": now},
+                )
+        except IntegrityError:
+            # lost a race with a concurrent claim
+            created = False
+        if created:
+            return True
+
+        # take over a claim whose claimant died before finishing.  the
+        # conditional update means only one retry can win it.
+        expired = now - datetime.timedelta(seconds=settings.HANDLED_MESSAGE_LEASE)
+        taken_over = self.filter(
+            message_id=message_id,
+            list_address=list_address,
+            status=HandledMessage.STATUS_IN_PROGRESS,
+            date_leased__lt=expired,
+        ).update(date_leased=now)
+        if taken_over:
+            logger.warning(
+                "Lease on Message-Id %s for %s expired before it was "
+                "delivered, taking it over",
+                message_id,
+                list_address,
+            )
+        return bool(taken_over)
+
+    def mark_done(self, message_id, list_address):
+        """
+        Records that message_id has been delivered (or bounced) for
+        list_address, so retries are dropped for good.
+        """
+        self.filter(message_id=message_id, list_address=list_address).update(
+            status=HandledMessage.STATUS_DONE
+        )
+        cache.set(
+            self._cache_key(message_id, list_address),
+            True,
+            timeout=settings.CACHE_KEY_MESSAGE_HANDLED_TIMEOUT,
+        )
+
+    def release(self, message_id, list_address):
+        """
+        Forgets a claim, e.g. because delivery failed and we want Mailgun's
+        retry to be processed.
+        """
+        cache.delete(self._cache_key(message_id, list_address))
+        self.filter(message_id=message_id, list_address=list_address).delete()
+
+    def delete_expired(self, max_age):
+        """
+        Deletes ledger entries older than max_age (a timedelta), after which
+        Mailgun will have stopped retrying.
+        """
+        cutoff = timezone.now() - max_age
+        deleted, _ = self.filter(date_created__lt=cutoff).delete()
+        return deleted
+
+
+class HandledMessage(models.Model):
+    """
+    A Message-Id that has been handled for a mailing list address.
+    """
+
+    STATUS_IN_PROGRESS = "in_progress"
+    STATUS_DONE = "done"
+
+    message_id = models.CharField(max_length=998)
+    list_address = models.CharField(max_length=254)
+    status = models.CharField(max_length=16, default=STATUS_IN_PROGRESS)
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+    date_leased = models.DateTimeField(default=timezone.now)
+
+    objects = HandledMessageManager()
+
+    class Meta:
+        db_table = "mg_handled_message"
+        unique_together = ("message_id", "list_address")
+
+    def __unicode__(self):
+        return "message_id: {}, list_address: {}, status: {}".format(
+            self.message_id, self.list_address, self.status
+        )
+
+
+class PartialDeliveryManager(models.Manager):
+    """
+    Custom Manager for PartialDelivery, which lets a retry of a message whose
+    delivery partly failed skip the recipients it already went to.
+    """
+
+    def get_sent_addresses(self, message_id):
+        """
+        The addresses message_id has been sent to, via any of its lists.
+        """
+        sent = set()
+        for addresses in self.filter(message_id=message_id).values_list(
+            "sent_addresses", flat=True
+        ):
+            sent.update(addresses)
+        return sent
+
+    def record_sent(self, message_id, list_address, addresses):
+        """
+        Adds addresses to those message_id has been sent to via list_address.
+        """
+        with transaction.atomic():
+            delivery, _ = self.select_for_update().get_or_create(
+                message_id=message_id,
+                list_address=list_address,
+                defaults={"sent_addresses": []},
+            )
+            delivery.sent_addresses = sorted(
+                set(delivery.sent_addresses).union(addresses)
+            )
+            delivery.save()
+
+    def delete_expired(self, max_age):
+        cutoff = timezone.now() - max_age
+        deleted, _ = self.filter(date_created__lt=cutoff).delete()
+        return deleted
+
+
+class PartialDelivery(models.Model):
+    """
+    The recipients a message was sent to via a mailing list before another
+    part of its delivery failed.
+    """
+
+    message_id = models.CharField(max_length=998)
+    list_address = models.CharField(max_length=254)
+    sent_addresses = models.JSONField(default=list)
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = PartialDeliveryManager()
+
+    class Meta:
+        db_table = "mg_partial_delivery"
+        unique_together = ("message_id", "list_address")
+
+    def __unicode__(self):
+        return "message_id: {}, list_address: {}, sent: {}".format(
+            self.message_id, self.list_address, len(self.sent_addresses)
+        )
+
+
+class QueuedRouteMessage(models.Model):
+    """
+    A Mailgun route POST accepted by the webhook and waiting to be delivered
+    by the route queue worker.  Used by mailgun.queues.DatabaseQueue.
+    """
+
+    STATUS_NEW = "new"
+    STATUS_CLAIMED = "claimed"
+    STATUS_FAILED = "failed"
+
+    post_data = models.JSONField()
+    status = models.CharField(max_length=16, default=STATUS_NEW, db_index=True)
+    attempts = models.IntegerField(default=0)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_claimed = models.DateTimeField(null=True)
+
+    class Meta:
+        db_table = "mg_queued_route_message"
+
+    def __unicode__(self):
+        return "id: {}, status: {}, attempts: {}".format(
+            self.id, self.status, self.attempts
+        )
+
+
+class QueuedRouteAttachment(models.Model):
+    """
+    A file uploaded along with a queued Mailgun route POST.
+    """
+
+    message = models.ForeignKey(
+        QueuedRouteMessage, related_name="attachments", on_delete=models.CASCADE
+    )
+    field_name = models.CharField(max_length=64)
+    name = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=255, null=True)
+    # relative to the DatabaseQueue's location
+    path = models.CharField(max_length=255)
+
+    class Meta:
+        db_table = "mg_queued_route_attachment"
+
+    def __unicode__(self):
+        return "message: {}, field_name: {}, name: {}".format(
+            self.message_id, self.field_name, self.name
+        )
@@ -0,0 +1,384 @@
+"""
+Queues used to accept Mailgun route POSTs in the webhook and deliver them from
+a separate worker process (see the process_route_queue management command).
+
+The backend is selected with settings.MAILGUN_ROUTE_QUEUE, e.g.
+
+    MAILGUN_ROUTE_QUEUE = {
+        "BACKEND": "mailgun.queues.FileSystemQueue",
+        "OPTIONS": {"location": "/var/spool/lti_emailer"},
+    }
+
+or, to keep the queue itself in the database,
+
+    MAILGUN_ROUTE_QUEUE = {
+        "BACKEND": "mailgun.queues.DatabaseQueue",
+        "OPTIONS": {"location": "/var/spool/lti_emailer/attachments"},
+    }
+
+Either way the location has to be shared by the webhook and the workers.
+When MAILGUN_ROUTE_QUEUE is not set, the route handler delivers mail inline.
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.db.models import Q
+from django.http import QueryDict
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+from django.utils.module_loading import import_string
+
+from mailgun.models import QueuedRouteAttachment, QueuedRouteMessage
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_VISIBILITY_TIMEOUT = 60 * 10  # 10 minutes
+
+
+def get_route_queue():
+    """
+    Returns the configured route queue, or None if the route handler should
+    deliver mail inline.
+    """
+    config = getattr(settings, "MAILGUN_ROUTE_QUEUE", None)
+    if not config:
+        return None
+    backend = import_string(config["BACKEND"])
+    return backend(**config.get("OPTIONS", {}))
+
+
+def _post_to_pairs(post):
+    return [[key, value] for key, values in post.lists() for value in values]
+
+
+def _pairs_to_post(pairs):
+    post = QueryDict(mutable=True)
+    for key, value in pairs:
+        post.appendlist(key, value)
+    post._mutable = False
+    return post
+
+
+def _spool_uploaded_file(uploaded, path):
+    """
+    Streams an uploaded file to path a chunk at a time, so attachments never
+    have to fit in memory.
+    """
+    with open(path, "wb") as fp:
+        for chunk in uploaded.chunks():
+            fp.write(chunk)
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def _open_spooled_file(path, name, content_type):
+    return UploadedFile(
+        file=open(path, "rb"),
+        name=name,
+        content_type=content_type,
+        size=os.path.getsize(path),
+    )
+
+
+class QueuedMessage(object):
+    """
+    A Mailgun route POST pulled off a queue.  Exposes POST and FILES the same
+    way a django.http.HttpRequest does, so the route handler can process it
+    exactly like the original webhook request.
+    """
+
+    def __init__(self, queue_id, post, files, attempts=0):
+        self.queue_id = queue_id
+        self.POST = post
+        self.FILES = files
+        self.attempts = attempts
+
+    def close(self):
+        for _, files in self.FILES.lists():
+            for f in files:
+                f.close()
+
+
+class BaseQueue(object):
+    def __init__(
+        self,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        visibility_timeout=DEFAULT_VISIBILITY_TIMEOUT,
+    ):
+        self.max_attempts = max_attempts
+        self.visibility_timeout = visibility_timeout
+
+    def enqueue(self, post, files):
+        """
+        Durably stores the POST data and uploaded files, returning the id of
+        the queued message.
+        """
+        raise NotImplementedError
+
+    def claim(self):
+        """
+        Returns the oldest available QueuedMessage, or None if the queue is
+        empty.  Claimed messages that are neither acked nor nacked within
+        visibility_timeout seconds become available again.
+        """
+        raise NotImplementedError
+
+    def ack(self, message):
+        """Removes a successfully processed message from the queue."""
+        raise NotImplementedError
+
+    def nack(self, message):
+        """
+        Returns a message that failed to process to the queue, or parks it as
+        failed once it has used up max_attempts.
+        """
+        raise NotImplementedError
+
+
+class FileSystemQueue(BaseQueue):
+    """
+    Maildir-style on-disk spool.  Messages are written under tmp/ and renamed
+    into new/ once complete; workers claim a message by renaming it into cur/,
+    so a message is only ever handed to one worker.
+    """
+
+    def __init__(self, location, **kwargs):
+        super(FileSystemQueue, self).__init__(**kwargs)
+        self.location = location
+        for subdir in ("tmp", "new", "cur", "failed"):
+            os.makedirs(self._path(subdir), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.location, *parts)
+
+    def enqueue(self, post, files):
+        queue_id = "{}-{}".format(time.time_ns(), uuid.uuid4().hex)
+        tmp_dir = self._path("tmp", queue_id)
+        os.makedirs(os.path.join(tmp_dir, "files"))
+
+        file_entries = []
+        for field_name, uploaded_files in files.lists():
+            for uploaded in uploaded_files:
+                path = os.path.join("files", str(len(file_entries)))
+                _spool_uploaded_file(uploaded, os.path.join(tmp_dir, path))
+                file_entries.append(
+                    {
+                        "field_name": field_name,
+                        "name": uploaded.name,
+                        "content_type": uploaded.content_type,
+                        "path": path,
+                    }
+                )
+
+        self._write_metadata(
+            tmp_dir,
+            {"post": _post_to_pairs(post), "files": file_entries, "attempts": 0},
+        )
+        os.rename(tmp_dir, self._path("new", queue_id))
+        return queue_id
+
+    def claim(self):
+        self._release_expired_claims()
+        for queue_id in sorted(os.listdir(self._path("new"))):
+            claimed_dir = self._path("cur", queue_id)
+            try:
+                os.rename(self._path("new", queue_id), claimed_dir)
+            except FileNotFoundError:
+                # another worker got to it first
+                continue
+            # the mtime of the claimed directory records when it was claimed
+            os.utime(claimed_dir)
+            return self._load(queue_id, claimed_dir)
+        return None
+
+    def ack(self, message):
+        message.close()
+        shutil.rmtree(self._path("cur", message.queue_id), ignore_errors=True)
+
+    def nack(self, message):
+        message.close()
+        claimed_dir = self._path("cur", message.queue_id)
+        metadata = self._read_metadata(claimed_dir)
+        metadata["attempts"] = message.attempts
+        self._write_metadata(claimed_dir, metadata)
+        if message.attempts >= self.max_attempts:
+            logger.error(
+                "Queued route message %s failed %d times, moving it to %s",
+                message.queue_id,
+                message.attempts,
+                self._path("failed"),
+            )
+            os.rename(claimed_dir, self._path("failed", message.queue_id))
+        else:
+            os.rename(claimed_dir, self._path("new", message.queue_id))
+
+    def _load(self, queue_id, message_dir):
+        metadata = self._read_metadata(message_dir)
+        files = MultiValueDict()
+        for entry in metadata["files"]:
+            files.appendlist(
+                entry["field_name"],
+                _open_spooled_file(
+                    os.path.join(message_dir, entry["path"]),
+                    entry["name"],
+                    entry["content_type"],
+                ),
+            )
+        return QueuedMessage(
+            queue_id,
+            _pairs_to_post(metadata["post"]),
+            files,
+            attempts=metadata["attempts"] + 1,
+        )
+
+    def _release_expired_claims(self):
+        cutoff = time.time() - self.visibility_timeout
+        for queue_id in os.listdir(self._path("cur")):
+            claimed_dir = self._path("cur", queue_id)
+            try:
+                if os.path.getmtime(claimed_dir) < cutoff:
+                    logger.warning(
+                        "Claim on queued route message %s expired, requeueing it",
+                        queue_id,
+                    )
+                    os.rename(claimed_dir, self._path("new", queue_id))
+            except FileNotFoundError:
+                continue
+
+    def _read_metadata(self, message_dir):
+        with open(os.path.join(message_dir, "message.json")) as fp:
+            return json.load(fp)
+
+    def _write_metadata(self, message_dir, metadata):
+        tmp_path = os.path.join(message_dir, "message.json.tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(metadata, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, os.path.join(message_dir, "message.json"))
+
+
+class DatabaseQueue(BaseQueue):
+    """
+    Queue backed by the default database.  Workers claim messages with
+    SELECT ... FOR UPDATE SKIP LOCKED, so several workers can drain the queue
+    concurrently on Postgres.  Attachments are streamed to files under
+    location rather than stored in the database, so neither the webhook nor
+    the worker has to hold them in memory.
+    """
+
+    def __init__(self, location, **kwargs):
+        super(DatabaseQueue, self).__init__(**kwargs)
+        self.location = location
+        os.makedirs(location, exist_ok=True)
+
+    def enqueue(self, post, files):
+        attachments = []
+        files_dir = None
+        for field_name, uploaded_files in files.lists():
+            for uploaded in uploaded_files:
+                if files_dir is None:
+                    files_dir = uuid.uuid4().hex
+                    os.makedirs(os.path.join(self.location, files_dir))
+                path = os.path.join(files_dir, str(len(attachments)))
+                _spool_uploaded_file(uploaded, os.path.join(self.location, path))
+                attachments.append(
+                    QueuedRouteAttachment(
+                        field_name=field_name,
+                        name=uploaded.name,
+                        content_type=uploaded.content_type,
+                        path=path,
+                    )
+                )
+
+        try:
+            with transaction.atomic():
+                queued = QueuedRouteMessage.objects.create(
+                    post_data=_post_to_pairs(post)
+                )
+                for attachment in attachments:
+                    attachment.message = queued
+                QueuedRouteAttachment.objects.bulk_create(attachments)
+        except Exception:
+            self._remove_files(files_dir)
+            raise
+        return queued.id
+
+    def claim(self):
+        now = timezone.now()
+        expired = now - datetime.timedelta(seconds=self.visibility_timeout)
+        with transaction.atomic():
+            queued = (
+                QueuedRouteMessage.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(status=QueuedRouteMessage.STATUS_NEW)
+                    | Q(
+                        status=QueuedRouteMessage.STATUS_CLAIMED,
+                        date_claimed__lt=expired,
+                    )
+                )
+                .order_by("id")
+                .first()
+            )
+            if queued is None:
+                return None
+            queued.status = QueuedRouteMessage.STATUS_CLAIMED
+            queued.date_claimed = now
+            queued.attempts += 1
+            queued.save(update_fields=["status", "date_claimed", "attempts"])
+
+        files = MultiValueDict()
+        for attachment in queued.attachments.all():
+            files.appendlist(
+                attachment.field_name,
+                _open_spooled_file(
+                    os.path.join(self.location, attachment.path),
+                    attachment.name,
+                    attachment.content_type,
+                ),
+            )
+        return QueuedMessage(
+            queued.id,
+            _pairs_to_post(queued.post_data),
+            files,
+            attempts=queued.attempts,
+        )
+
+    def ack(self, message):
+        message.close()
+        paths = QueuedRouteAttachment.objects.filter(
+            message_id=message.queue_id
+        ).values_list("path", flat=True)
+        files_dirs = {os.path.dirname(path) for path in paths}
+        QueuedRouteMessage.objects.filter(id=message.queue_id).delete()
+        for files_dir in files_dirs:
+            self._remove_files(files_dir)
+
+    def nack(self, message):
+        message.close()
+        if message.attempts >= self.max_attempts:
+            logger.error(
+                "Queued route message %s failed %d times, marking it failed",
+                message.queue_id,
+                message.attempts,
+            )
+            status = QueuedRouteMessage.STATUS_FAILED
+        else:
+            status = QueuedRouteMessage.STATUS_NEW
+        QueuedRouteMessage.objects.filter(id=message.queue_id).update(
+            status=status, date_claimed=None
+        )
+
+    def _remove_files(self, files_dir):
+        if files_dir:
+            shutil.rmtree(os.path.join(self.location, files_dir), ignore_errors=True)
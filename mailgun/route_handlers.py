@@ -1,26 +1,34 @@
-import sys
+import asyncio
 import json
 import logging
+import os
 import re
-from functools import wraps
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
 
 from django.conf import settings
-from django.core.cache import cache
-from django.http import JsonResponse
+from django.db import close_old_connections
+from django.http import HttpResponseNotAllowed, JsonResponse
 from django.template.loader import get_template
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from flanker.addresslib import address as addresslib_address
-from coursemanager.models import CourseInstance
 
 from lti_emailer.canvas_api_client import (
+    course_roster_scope,
     get_alternate_emails_for_user_email,
     get_name_for_email,
 )
+from lti_emailer.exceptions import ListservBatchError
 from mailgun.decorators import authenticate
 from mailgun.exceptions import HttpResponseException
 from mailgun.listserv_client import MailgunClient as ListservClient
+from mailgun.models import HandledMessage, PartialDelivery
+from mailgun.queues import get_route_queue
 from mailing_list.models import CourseSettings, MailingList, SuperSender
+from mailing_list.utils import get_primary_course_info
 
 logger = logging.getLogger(__name__)
 
@@ -63,6 +71,71 @@ def handle_exceptions():
 def handle_mailing_list_email_route(request):
     """
     Handles the Mailgun route action when email is sent to a Mailgun mailing list.
+    If a route queue is configured the POST is spooled for the queue worker and
+    we return right away, otherwise the message is delivered inline.
+    :param request:
+    :return JsonResponse:
+    """
+    return _handle_route(request)
+
+
+# the async route handler delivers messages on these threads, so that one
+# ASGI process can have up to MAILGUN_ASYNC_MAX_CONCURRENCY messages in flight
+_async_delivery_executor = ThreadPoolExecutor(
+    max_workers=settings.MAILGUN_ASYNC_MAX_CONCURRENCY,
+    thread_name_prefix="mailgun-route",
+)
+
+
+@authenticate()
+async def handle_mailing_list_email_route_async(request):
+    """
+    ASGI version of handle_mailing_list_email_route.  The Canvas, database
+    and Mailgun work is blocking, so each message is handed to a thread from a
+    bounded pool while the event loop goes on accepting others.
+    :param request:
+    :return JsonResponse:
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _async_delivery_executor, partial(_handle_route_in_thread, request)
+    )
+
+
+handle_mailing_list_email_route_async.csrf_exempt = True
+
+
+def _handle_route_in_thread(request):
+    # these threads live outside of Django's request cycle, so clean up
+    # database connections ourselves
+    close_old_connections()
+    try:
+        return handle_exceptions()(_handle_route)(request)
+    finally:
+        close_old_connections()
+
+
+def _handle_route(request):
+    route_queue = get_route_queue()
+    if route_queue is not None:
+        queue_id = route_queue.enqueue(request.POST, request.FILES)
+        logger.info(
+            "Queued Mailgun mailing list email to %s, message id %s, as %s",
+            request.POST.get("recipient"),
+            request.POST.get("Message-Id"),
+            queue_id,
+        )
+        return JsonResponse({"success": True})
+
+    return handle_message(request)
+
+
+def handle_message(request):
+    """
+    Delivers a Mailgun route POST to each of its recipient lists.  `request`
+    can be the webhook request itself or a mailgun.queues.QueuedMessage.
     :param request:
     :return JsonResponse:
     """
@@ -96,28 +169,74 @@ def handle_mailing_list_email_route(request):
         )
         return JsonResponse({"success": True})
 
-    for recipient in recipients:
-        # shortcut if we've already handled this message for this recipient
-        if message_id:
-            cache_key = (
-                settings.CACHE_KEY_MESSAGE_HANDLED_BY_MESSAGE_ID_AND_RECIPIENT
-                % (message_id, recipient)
-            )
-            if cache.get(cache_key):
-                logger.warning(
-                    "Message-Id %s was posted to the route handler "
-                    "for %s, but we've already handled that.  "
-                    "Skipping.",
-                    recipient,
-                    message_id,
+    # list addresses we've claimed in the ledger, but not yet delivered to
+    pending_list_addresses = set()
+    # encapsulated message attachments spooled to temp files, by attachment
+    # name, shared by all of the lists the message was addressed to
+    spooled_files = {}
+    try:
+        # share one Canvas roster fetch per course across all of the member,
+        # staff and display name lookups for this message
+        with course_roster_scope():
+            deliveries = []
+            for recipient in recipients:
+                list_address = recipient.address.lower()
+                # shortcut if we've already handled this message for this
+                # list.  claiming it up front also keeps a concurrent Mailgun
+                # retry from delivering it a second time.
+                if message_id and not HandledMessage.objects.claim(
+                    message_id, list_address
+                ):
+                    logger.warning(
+                        "Message-Id %s was posted to the route handler "
+                        "for %s, but we've already handled that.  "
+                        "Skipping.",
+                        message_id,
+                        list_address,
+                        extra={
+                            "duplicate_message": True,
+                            "message_id": message_id,
+                            "list_address": list_address,
+                        },
+                    )
+                    continue
+                pending_list_addresses.add(list_address)
+                delivery = _handle_recipient(
+                    request, recipient, user_alt_email_cache, spooled_files
                 )
-                continue
-        _handle_recipient(request, recipient, user_alt_email_cache)
+                if delivery:
+                    delivery["list_addresses"] = {list_address}
+                    deliveries.append(delivery)
+                else:
+                    # bounced, nothing more to do for this list
+                    pending_list_addresses.discard(list_address)
+                    if message_id:
+                        HandledMessage.objects.mark_done(message_id, list_address)
+
+        sends = _merge_deliveries(deliveries)
+        for delivery in sends:
+            # with more than one send, a retry after a later one fails has to
+            # know who the earlier ones reached
+            _send_delivery(delivery, record_sent=len(sends) > 1)
+            pending_list_addresses -= delivery["list_addresses"]
+            if message_id:
+                for list_address in delivery["list_addresses"]:
+                    HandledMessage.objects.mark_done(message_id, list_address)
+    except Exception:
+        # let Mailgun's retry of this message through for the lists we didn't
+        # get to
+        if message_id:
+            for list_address in pending_list_addresses:
+                HandledMessage.objects.release(message_id, list_address)
+        raise
+    finally:
+        for _, spooled_file in spooled_files.values():
+            spooled_file.close()
 
     return JsonResponse({"success": True})
 
 
-def _handle_recipient(request, recipient, user_alt_email_cache):
+def _handle_recipient(request, recipient, user_alt_email_cache, spooled_files):
     """
     The logic behind whether an email will be forwarded to list members or
     trigger a bounce email can be complicated.  A (hopefully simpler to follow)
@@ -135,7 +254,14 @@ def _handle_recipient(request, recipient, user_alt_email_cache):
 
     attachments, inlines, encapsulated_msg_att, attachments_size = (
         _get_attachments_inlines(
-            request, sender, recipient, subject, body_plain, body_html, message_id
+            request,
+            sender,
+            recipient,
+            subject,
+            body_plain,
+            body_html,
+            message_id,
+            spooled_files,
         )
     )
 
@@ -199,12 +325,10 @@ def _handle_recipient(request, recipient, user_alt_email_cache):
     logger.debug("Got the MailingList object: {}".format(ml))
 
     # try to determine the course instance, and from there the school
-    school_id = None
-    ci = CourseInstance.objects.get_primary_course_by_canvas_course_id(
-        ml.canvas_course_id
-    )
-    if ci:
-        school_id = ci.course.school_id
+    short_title = school_id = None
+    course_info = get_primary_course_info(ml.canvas_course_id)
+    if course_info:
+        short_title, school_id = course_info
     else:
         logger.warning(
             "Could not determine the primary course instance for Canvas "
@@ -213,171 +337,32 @@ def _handle_recipient(request, recipient, user_alt_email_cache):
             ml.canvas_course_id,
         )
 
-    member_addresses = set([m["address"].lower() for m in ml.members])
-    logger.debug("Got member_addresses: %d", len(member_addresses))
-
-    # conditionally include staff addresses in the members list. If
-    # always_mail_staff is true all staff will receive the email
-    teaching_staff_addresses = ml.teaching_staff_addresses
-    logger.debug("Got teaching_staff_addresses: %d", len(teaching_staff_addresses))
-
-    # if the course settings object does not exist create it to initialize the
-    # defaults
-    if ml.course_settings is None:
-        # we need to call get or create here as there might already be a setting
-        # for the course in question that has not been applied to this list yet
-        course_settings, created = CourseSettings.objects.get_or_create(
-            canvas_course_id=ml.canvas_course_id
-        )
-        ml.course_settings = course_settings
-        ml.save()
-
-    # for non-full-course mailing lists, only include teachers from other
-    # sections if the course settings say to do so
-    if ml.section_id is not None and ml.course_settings.always_mail_staff:
-        member_addresses = member_addresses.union(teaching_staff_addresses)
-
-    # create a list of staff plus members to use to check permissions against
-    # so all staff can email all lists
-    staff_plus_members = teaching_staff_addresses.union(member_addresses)
-
     # if we can, grab the list of super senders
     super_senders = set()
     if school_id:
-        # use iexact here to be able to match on COLGSAS or colgsas
-        query = SuperSender.objects.filter(school_id__iexact=school_id)
-
-        # lowercase all addresses in the supersenders list
-        super_senders = {addr.lower() for addr in query.values_list("email", flat=True)}
+        super_senders = SuperSender.objects.get_email_set_for_school(school_id)
 
     # if we want to check email addresses against the sender, we need to parse
     # out the address from the display name.
     parsed_sender = addresslib_address.parse(sender)
-    sender_address = parsed_sender.address.lower()
-    from_address = parsed_from.address.lower() if parsed_from else None
+
+    # the list's member and staff addresses are only looked up if the
+    # permission checks (or the delivery) need them
+    list_addresses = _ListAddresses(ml)
 
     # email to use as reply-to / sender; defaults to sender address, but if the
     # from address is the actual list member and the sender address is an active
     # communication channel in Canvas for said member we will use the from
-    # address instead (see logic below)
-    parsed_reply_to = None
-
-    # any validation that fails will set the bounce template
-    bounce_back_email_template = None
-
-    # is sender or from_address a supersender?
-    if from_address != sender_address and from_address in super_senders:
-        alt_emails = user_alt_email_cache.get_for(from_address)
-        if sender_address in alt_emails:
-            parsed_reply_to = parsed_from
-    elif sender_address in super_senders:
-        parsed_reply_to = parsed_sender
-    is_super_sender = bool(parsed_reply_to)
-
-    # is the mailing list open to everyone?
-    if not parsed_reply_to and ml.access_level == MailingList.ACCESS_LEVEL_EVERYONE:
-        parsed_reply_to = parsed_sender
-        if from_address != sender_address and from_address in staff_plus_members:
-            alt_emails = user_alt_email_cache.get_for(from_address)
-            if sender_address in alt_emails:
-                parsed_reply_to = parsed_from
-
-    if not parsed_reply_to:
-        if ml.access_level == MailingList.ACCESS_LEVEL_STAFF:
-            if (
-                from_address != sender_address
-                and from_address in teaching_staff_addresses
-            ):
-                # check if email is being sent on behalf of a list member by an
-                # alternate email account
-                alt_emails = user_alt_email_cache.get_for(from_address)
-                if sender_address in alt_emails:
-                    parsed_reply_to = parsed_from
-                else:
-                    # the from address matches a teaching staff list member, but
-                    # the sender address is not a valid communication channel
-                    # for that member in Canvas
-                    # * note that alternate emails are not cached by default, so
-                    # changes to a user's alternate emails in Canvas should be
-                    # recognized immediately by this handler logic
-                    logger.info(
-                        "Sending mailing list bounce back email to sender for "
-                        "mailing list %s because the sender address %s is not "
-                        "one of the active email communication channels for "
-                        "the list member matching the from address %s",
-                        recipient,
-                        sender_address,
-                        from_address,
-                    )
-                    bounce_back_email_template = (
-                        "mailgun/email/bounce_back_no_comm_channel_match.html"
-                    )
-            elif sender_address in teaching_staff_addresses:
-                parsed_reply_to = parsed_sender
-            else:
-                logger.info(
-                    "Sending mailing list bounce back email to sender for "
-                    "mailing list %s because neither the sender address %s "
-                    "nor the from address %s was a staff member",
-                    recipient,
-                    sender_address,
-                    from_address,
-                )
-                bounce_back_email_template = (
-                    "mailgun/email/bounce_back_access_denied.html"
-                )
-
-    if not parsed_reply_to and not bounce_back_email_template:
-        # is sender or from_ a member of the list?
-        if from_address != sender_address and from_address in staff_plus_members:
-            # check if email is being sent on behalf of a list member by an
-            # alternate email account
-            alt_emails = user_alt_email_cache.get_for(from_address)
-            if sender_address in alt_emails:
-                parsed_reply_to = parsed_from
-            else:
-                # the from address matches a list member, but the sender address
-                # is not a valid communication channel for that member in Canvas
-                # * note that alternate emails are not cached by default, so
-                # changes to a user's alternate emails in Canvas should be
-                # recognized immediately by this handler logic
-                logger.info(
-                    "Sending mailing list bounce back email to sender for "
-                    "mailing list %s because the sender address %s is not one "
-                    "of the active email communication channels for the list "
-                    "member matching the from address %s",
-                    recipient,
-                    sender_address,
-                    from_address,
-                )
-                bounce_back_email_template = (
-                    "mailgun/email/bounce_back_no_comm_channel_match.html"
-                )
-        elif sender_address in staff_plus_members:
-            parsed_reply_to = parsed_sender
-        else:
-            # neither of the possible sender addresses matches a list member
-            logger.info(
-                "Sending mailing list bounce back email to sender for "
-                "mailing list %s because neither the sender address %s "
-                "nor the from address %s was a member",
-                recipient,
-                sender_address,
-                from_address,
-            )
-            bounce_back_email_template = "mailgun/email/bounce_back_not_subscribed.html"
-
-    if not is_super_sender and not bounce_back_email_template:
-        if ml.access_level == MailingList.ACCESS_LEVEL_READONLY:
-            logger.info(
-                "Sending mailing list bounce back email to sender "
-                "address %s (from address %s) for mailing list %s because "
-                "the list is readonly",
-                sender_address,
-                from_address,
-                recipient,
-            )
-            bounce_back_email_template = "mailgun/email/bounce_back_readonly_list.html"
+    # address instead (see _authorize_sender())
+    parsed_reply_to, bounce_back_email_template = _authorize_sender(
+        ml,
+        list_addresses,
+        super_senders,
+        parsed_sender,
+        parsed_from,
+        recipient,
+        user_alt_email_cache,
+    )
 
     # bounce and return if they don't have the correct permissions
     if bounce_back_email_template:
@@ -391,6 +376,8 @@ def _handle_recipient(request, recipient, user_alt_email_cache):
         )
         return
 
+    member_addresses = set(list_addresses.members)
+
     # always send the email to the sender. Add 'parsed_reply_to to the
     # member_addresses set(tlt-2960)
     logger.debug(
@@ -404,8 +391,8 @@ def _handle_recipient(request, recipient, user_alt_email_cache):
     logger.debug("Full list of recipients: %s", member_addresses)
 
     # if we found the course instance, insert [SHORT TITLE] into the subject
-    if ci and ci.short_title:
-        title_prefix = "[{}]".format(ci.short_title)
+    if short_title:
+        title_prefix = "[{}]".format(short_title)
         if title_prefix not in subject:
             subject = title_prefix + " " + subject
 
@@ -443,44 +430,355 @@ def _handle_recipient(request, recipient, user_alt_email_cache):
     original_to_list = [a.full_spec() for a in to_list]
     original_cc_list = [a.full_spec() for a in cc_list]
 
-    # and send it off
+    # hand the delivery back to handle_message(), which sends it along with
+    # the deliveries for any other lists this message was addressed to
+    return {
+        "mailing_list": ml,
+        "sender_display_name": reply_to_display_name,
+        "sender_address": parsed_reply_to.address.lower(),
+        "sender_full_spec": parsed_reply_to.full_spec(),
+        "member_addresses": member_addresses,
+        "subject": subject,
+        "text": body_plain,
+        "html": body_html,
+        "original_to_address": original_to_list,
+        "original_cc_address": original_cc_list,
+        "attachments": attachments,
+        "inlines": inlines,
+        "encapsulated_msg_att": encapsulated_msg_att,
+        "message_id": message_id,
+    }
+
+
+class _ListAddresses(object):
+    """
+    The member and teaching staff addresses of a mailing list, looked up when
+    first needed, since they can mean fetching the course roster from Canvas.
+    Until they are, checks on a single address ask the list about just that
+    address (see MailingList.is_member_address()), so a bounced message
+    never needs the full roster.
+    """
+
+    def __init__(self, ml):
+        self.ml = ml
+        self._teaching_staff = None
+        self._members = None
+
+    @property
+    def teaching_staff(self):
+        if self._teaching_staff is None:
+            self._teaching_staff = self.ml.teaching_staff_addresses
+            logger.debug("Got teaching_staff_addresses: %d", len(self._teaching_staff))
+        return self._teaching_staff
+
+    @property
+    def members(self):
+        if self._members is None:
+            members = set([m["address"].lower() for m in self.ml.members])
+            logger.debug("Got member_addresses: %d", len(members))
+
+            # if the course settings object does not exist create it to
+            # initialize the defaults
+            if self.ml.course_settings is None:
+                # we need to call get or create here as there might already be
+                # a setting for the course in question that has not been
+                # applied to this list yet
+                course_settings, created = CourseSettings.objects.get_or_create(
+                    canvas_course_id=self.ml.canvas_course_id
+                )
+                self.ml.course_settings = course_settings
+                self.ml.save()
+
+            # for non-full-course mailing lists, only include teachers from
+            # other sections if the course settings say to do so
+            if (
+                self.ml.section_id is not None
+                and self.ml.course_settings.always_mail_staff
+            ):
+                members = members.union(self.teaching_staff)
+            self._members = members
+        return self._members
+
+    def is_staff(self, address):
+        if not address:
+            return False
+        if self._teaching_staff is not None:
+            return address in self._teaching_staff
+        return self.ml.is_teaching_staff_address(address)
+
+    def is_staff_or_member(self, address):
+        if not address:
+            return False
+        # all staff can email all lists
+        if self.is_staff(address):
+            return True
+        if self._members is not None:
+            return address in self._members
+        return self.ml.is_member_address(address)
+
+
+def _authorize_sender(
+    ml,
+    list_addresses,
+    super_senders,
+    parsed_sender,
+    parsed_from,
+    recipient,
+    user_alt_email_cache,
+):
+    """
+    Decides whether the sender may post to the list.  The checks run
+    cheapest first: super senders and the list's access level are already
+    at hand, the list's staff and members may mean a roster fetch, and a
+    sender's alternate addresses mean a Canvas user lookup, so each is only
+    consulted when the outcome depends on it.
+
+    :return: (parsed_reply_to, bounce_back_email_template), exactly one of
+        which is set
+    """
+    sender_address = parsed_sender.address.lower()
+    from_address = parsed_from.address.lower() if parsed_from else None
+    on_behalf_of = from_address != sender_address
+
+    def sender_is_alternate_for_from():
+        alt_emails = user_alt_email_cache.get_for(from_address, sender_address)
+        return sender_address in alt_emails
+
+    # is sender or from_address a supersender?  they can post to any list
+    if on_behalf_of and from_address in super_senders:
+        if sender_is_alternate_for_from():
+            return parsed_from, None
+    elif sender_address in super_senders:
+        return parsed_sender, None
+
+    # is the mailing list open to everyone?
+    if ml.access_level == MailingList.ACCESS_LEVEL_EVERYONE:
+        if (
+            on_behalf_of
+            and list_addresses.is_staff_or_member(from_address)
+            and sender_is_alternate_for_from()
+        ):
+            return parsed_from, None
+        return parsed_sender, None
+
+    if ml.access_level == MailingList.ACCESS_LEVEL_STAFF:
+        if on_behalf_of and list_addresses.is_staff(from_address):
+            # check if email is being sent on behalf of a list member by an
+            # alternate email account
+            if sender_is_alternate_for_from():
+                return parsed_from, None
+            # the from address matches a teaching staff list member, but
+            # the sender address is not a valid communication channel
+            # for that member in Canvas
+            # * note that alternate emails are re-checked against
+            # Canvas before we get here, so changes to a user's
+            # alternate emails in Canvas are recognized immediately
+            logger.info(
+                "Sending mailing list bounce back email to sender for "
+                "mailing list %s because the sender address %s is not "
+                "one of the active email communication channels for "
+                "the list member matching the from address %s",
+                recipient,
+                sender_address,
+                from_address,
+            )
+            return None, "mailgun/email/bounce_back_no_comm_channel_match.html"
+        if list_addresses.is_staff(sender_address):
+            return parsed_sender, None
+        logger.info(
+            "Sending mailing list bounce back email to sender for "
+            "mailing list %s because neither the sender address %s "
+            "nor the from address %s was a staff member",
+            recipient,
+            sender_address,
+            from_address,
+        )
+        return None, "mailgun/email/bounce_back_access_denied.html"
+
+    # is sender or from_ a member of the list?
+    if on_behalf_of and list_addresses.is_staff_or_member(from_address):
+        # check if email is being sent on behalf of a list member by an
+        # alternate email account
+        if not sender_is_alternate_for_from():
+            # the from address matches a list member, but the sender address
+            # is not a valid communication channel for that member in Canvas
+            # * note that alternate emails are re-checked against Canvas
+            # before we get here, so changes to a user's alternate emails
+            # in Canvas are recognized immediately
+            logger.info(
+                "Sending mailing list bounce back email to sender for "
+                "mailing list %s because the sender address %s is not one "
+                "of the active email communication channels for the list "
+                "member matching the from address %s",
+                recipient,
+                sender_address,
+                from_address,
+            )
+            return None, "mailgun/email/bounce_back_no_comm_channel_match.html"
+        parsed_reply_to = parsed_from
+    elif list_addresses.is_staff_or_member(sender_address):
+        parsed_reply_to = parsed_sender
+    else:
+        # neither of the possible sender addresses matches a list member
+        logger.info(
+            "Sending mailing list bounce back email to sender for "
+            "mailing list %s because neither the sender address %s "
+            "nor the from address %s was a member",
+            recipient,
+            sender_address,
+            from_address,
+        )
+        return None, "mailgun/email/bounce_back_not_subscribed.html"
+
+    # members (unlike super senders) can't post to a readonly list.  this is
+    # checked last so that non-members get the more general bounce
+    if ml.access_level == MailingList.ACCESS_LEVEL_READONLY:
+        logger.info(
+            "Sending mailing list bounce back email to sender "
+            "address %s (from address %s) for mailing list %s because "
+            "the list is readonly",
+            sender_address,
+            from_address,
+            recipient,
+        )
+        return None, "mailgun/email/bounce_back_readonly_list.html"
+
+    return parsed_reply_to, None
+
+
+def _merge_deliveries(deliveries):
+    """
+    Collapses the per-list deliveries for a message into the fewest Mailgun
+    sends.  Deliveries with the same sender and subject, e.g. to a course
+    list and its section lists, are merged into a single send, so the
+    attachments are only uploaded once.  Each recipient's own list is kept in
+    recipient_list_addresses for its List-Id header.  An address that several
+    lists would deliver to only gets the message once, from the first list;
+    course lists go first since they're the superset.
+    """
+    ordered = sorted(
+        deliveries,
+        key=lambda d: d["mailing_list"].section_id is not None,
+    )
+    merged = {}
+    delivered = set()
+    for delivery in ordered:
+        key = (
+            delivery["sender_address"],
+            delivery["sender_display_name"],
+            delivery["subject"],
+        )
+        if key not in merged:
+            # the first (course-most) list's payload goes out for all of them
+            merged[key] = dict(
+                delivery,
+                member_addresses=set(),
+                list_addresses=set(),
+                recipient_list_addresses={},
+            )
+        send = merged[key]
+        send["list_addresses"].update(delivery["list_addresses"])
+        for address in delivery["member_addresses"]:
+            if address not in delivered:
+                delivered.add(address)
+                send["member_addresses"].add(address)
+                send["recipient_list_addresses"][address] = delivery[
+                    "mailing_list"
+                ].address
+    return list(merged.values())
+
+
+def _record_sent(delivery, addresses):
+    addresses_by_list = defaultdict(list)
+    for address in addresses:
+        addresses_by_list[delivery["recipient_list_addresses"][address]].append(address)
+    for list_address, list_addresses in addresses_by_list.items():
+        PartialDelivery.objects.record_sent(
+            delivery["message_id"], list_address, list_addresses
+        )
+
+
+def _send_delivery(delivery, record_sent=False):
+    """
+    Sends a (merged) delivery.  Recipients a partly failed earlier attempt at
+    the message already reached are skipped, and if this send partly fails,
+    the recipients it did reach are recorded for the retry.  With
+    record_sent, a successful send's recipients are recorded, too.
+    """
+    ml = delivery["mailing_list"]
+    message_id = delivery["message_id"]
+    list_addresses = ", ".join(sorted(delivery["list_addresses"]))
+    member_addresses = list(delivery["member_addresses"])
+    if message_id:
+        already_sent = PartialDelivery.objects.get_sent_addresses(message_id)
+        if already_sent:
+            logger.info(
+                "Message-Id %s was already sent to %d member(s) of its lists, "
+                "skipping them for %s",
+                message_id,
+                len(already_sent),
+                list_addresses,
+            )
+            member_addresses = [a for a in member_addresses if a not in already_sent]
+    if not member_addresses:
+        logger.info(
+            "Not sending to %s; all of the members were already sent this "
+            "message via another list",
+            list_addresses,
+        )
+        return
+
     logger.debug(
         "Mailgun router handler sending email to %s from %s, subject %s",
         member_addresses,
-        parsed_reply_to.full_spec(),
-        subject,
+        delivery["sender_full_spec"],
+        delivery["subject"],
     )
     try:
         ml.send_mail(
-            reply_to_display_name,
-            parsed_reply_to.address.lower(),
+            delivery["sender_display_name"],
+            delivery["sender_address"],
             member_addresses,
-            subject,
-            text=body_plain,
-            html=body_html,
-            original_to_address=original_to_list,
-            original_cc_address=original_cc_list,
-            attachments=attachments,
-            inlines=inlines,
-            encapsulated_msg_att=encapsulated_msg_att,
+            delivery["subject"],
+            text=delivery["text"],
+            html=delivery["html"],
+            original_to_address=delivery["original_to_address"],
+            original_cc_address=delivery["original_cc_address"],
+            attachments=delivery["attachments"],
+            inlines=delivery["inlines"],
+            encapsulated_msg_att=delivery["encapsulated_msg_att"],
             message_id=message_id,
+            recipient_list_addresses={
+                a: delivery["recipient_list_addresses"][a] for a in member_addresses
+            },
         )
+    except ListservBatchError as e:
+        if message_id and e.result.sent:
+            _record_sent(delivery, e.result.sent)
+        raise
     except RuntimeError:
         logger.exception(
             "Error attempting to send message from %s to %s, originally "
-            "sent to list %s, with subject %s",
-            parsed_reply_to.full_spec(),
+            "sent to list(s) %s, with subject %s",
+            delivery["sender_full_spec"],
             member_addresses,
-            ml.address,
-            subject,
+            list_addresses,
+            delivery["subject"],
         )
         raise
-
-    return JsonResponse({"success": True})
+    if message_id and record_sent:
+        _record_sent(delivery, member_addresses)
 
 
 def _get_attachments_inlines(
-    request, sender, recipient, subject, body_plain, body_html, message_id
+    request,
+    sender,
+    recipient,
+    subject,
+    body_plain,
+    body_html,
+    message_id,
+    spooled_files,
 ):
     attachments = []
     inlines = []
@@ -516,12 +814,23 @@ def _get_attachments_inlines(
             # name of file for sending
             name = attachment_name
             word = "Subject: "
-            if word in eml_content:
-                name = eml_content[eml_content.find(word) + len(word) :]
-                name = name[: name.find("\r")]
-            encapsulated_msg_att[attachment_name] = (name, eml_content)
-
-            attachments_size += sys.getsizeof(encapsulated_msg_att[attachment_name][1])
+            subject_start = eml_content.find(word)
+            if subject_start != -1:
+                subject_start += len(word)
+                name = eml_content[
+                    subject_start : eml_content.find("\r", subject_start)
+                ]
+            if attachment_name not in spooled_files:
+                # spool the message to disk, once for all of the message's
+                # lists, so it's streamed to Mailgun like the uploaded
+                # attachments are.  handle_message() closes these once the
+                # message is delivered.
+                eml_file = tempfile.TemporaryFile()
+                eml_file.write(eml_content.encode("utf-8"))
+                spooled_files[attachment_name] = (name, eml_file)
+            encapsulated_msg_att[attachment_name] = spooled_files[attachment_name]
+
+            attachments_size += spooled_files[attachment_name][1].seek(0, os.SEEK_END)
             continue
         elif request.FILES.get(attachment_name):
             file_ = request.FILES[attachment_name]
@@ -638,21 +947,42 @@ class CommChannelCache(object):
 
     def __init__(self):
         self._user_map = {}
+        self._rechecked = set()
 
-    def get_for(self, email_address):
+    def get_for(self, email_address, expected_address=None):
         """
         returns and caches a list of valid alternate emails for `email_address`.
         Find user via search in Canvas, and determine if user
+
+        The Canvas lookups may be answered from the short-lived shared cache
+        (see settings.CANVAS_COMM_CHANNELS_CACHE_TIMEOUT).  If
+        `expected_address` is given but isn't among them, they're fetched
+        again straight from Canvas before we'd bounce the message, in case
+        the user has just added it.
         """
         alt_emails = self._user_map.get(email_address)
         if alt_emails is None:
-            alt_emails = get_alternate_emails_for_user_email(email_address)
+            alt_emails = get_alternate_emails_for_user_email(
+                email_address, use_cache=True
+            )
             self._user_map[email_address] = alt_emails
             logger.debug(
                 "Caching valid alternate emails for user {}: {}".format(
                     email_address, alt_emails
                 )
             )
+        if (
+            expected_address is not None
+            and expected_address not in alt_emails
+            and email_address not in self._rechecked
+        ):
+            self._rechecked.add(email_address)
+            alt_emails = get_alternate_emails_for_user_email(email_address)
+            self._user_map[email_address] = alt_emails
+            logger.debug(
+                "Re-checked valid alternate emails for user {} against "
+                "Canvas: {}".format(email_address, alt_emails)
+            )
         return alt_emails
 
 
@@ -1,27 +1,63 @@
+import datetime
 import hashlib
 import hmac
 import json
+import os
+import shutil
+import tempfile
+import threading
 import time
 import uuid
-from io import StringIO
+from io import BytesIO, StringIO
 
+import requests
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.urls import reverse_lazy
 from django.http import JsonResponse
 from django.test import TestCase, RequestFactory
 from django.test.utils import override_settings
-from mock import MagicMock, call, patch
+from django.utils import timezone
+from mock import MagicMock, PropertyMock, call, patch
 
 from harvard_django_utils.utils import Bunch
 
 from mailing_list.models import MailingList
+from lti_emailer.exceptions import ListservApiError, ListservBatchError
+from mailgun.api_session import get_session
 from mailgun.decorators import authenticate
 from mailgun.exceptions import HttpResponseException
-from mailgun.route_handlers import CommChannelCache, handle_mailing_list_email_route
+from mailgun.listserv_client import BatchSendResult
+from mailgun.listserv_client import MailgunClient as ListservClient
+from mailgun.models import HandledMessage
+from mailgun.queues import DatabaseQueue, FileSystemQueue, get_route_queue
+from mailgun.route_handlers import (
+    CommChannelCache,
+    _merge_deliveries,
+    handle_mailing_list_email_route,
+    handle_mailing_list_email_route_async,
+)
+from mailgun.utils import MultipartStream
 
 
 @override_settings(LISTSERV_API_KEY=str(uuid.uuid4()))
+def _mock_mailing_list(**kwargs):
+    """
+    A mock MailingList whose single-address membership checks agree with its
+    members and teaching_staff_addresses
+    """
+    ml = MagicMock(**kwargs)
+    ml.is_teaching_staff_address.side_effect = (
+        lambda address: address in ml.teaching_staff_addresses
+    )
+    ml.is_member_address.side_effect = lambda address: address in {
+        m["address"].lower() for m in ml.members
+    }
+    return ml
+
+
 class RouteHandlerUnitTests(TestCase):
     longMessage = True
 
@@ -33,18 +69,17 @@ class RouteHandlerUnitTests(TestCase):
         self.user.first_name = "Unit"
         self.user.last_name = "Test"
 
-    @override_settings(CACHE_KEY_MESSAGE_HANDLED_BY_MESSAGE_ID_AND_RECIPIENT="%s:%s")
-    @patch("mailgun.route_handlers.cache.get")
+    @patch("mailgun.route_handlers.HandledMessage.objects.claim")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
     )
-    def test_duplicate_router_post(self, mock_ml_get, mock_ci_get, mock_cache_get):
+    def test_duplicate_router_post(self, mock_ml_get, mock_ci_get, mock_claim):
         """TLT-2039
-        Verifies that if a message-id is in the cache, we won't try to send
-        that email to the list again.
+        Verifies that if a message-id has already been handled for a list, we
+        won't try to send that email to the list again.
         """
         # only the message-id is needed
         post_body = {
@@ -54,8 +89,8 @@ class RouteHandlerUnitTests(TestCase):
         }
         post_body.update(generate_signature_dict())
 
-        # the message-id is in the cache
-        mock_cache_get.return_value = True
+        # the message-id has already been claimed for this list
+        mock_claim.return_value = False
 
         # prep the request
         request = self.factory.post("/", post_body)
@@ -65,15 +100,60 @@ class RouteHandlerUnitTests(TestCase):
         response = handle_mailing_list_email_route(request)
         self.assertEqual(response.status_code, 200)
 
-        # verify cache.get we're expecting, and other mocks unused
-        expected_cache_key = (
-            settings.CACHE_KEY_MESSAGE_HANDLED_BY_MESSAGE_ID_AND_RECIPIENT
-            % (post_body["Message-Id"], post_body["recipient"])
+        # verify the ledger lookup we're expecting, and other mocks unused
+        self.assertEqual(
+            mock_claim.call_args, call(post_body["Message-Id"], post_body["recipient"])
         )
-        self.assertEqual(mock_cache_get.call_args, call(expected_cache_key))
         self.assertEqual(mock_ml_get.call_count, 0)
         self.assertEqual(mock_ci_get.call_count, 0)
 
+    @patch("mailgun.route_handlers._handle_recipient")
+    def test_failed_delivery_releases_ledger_claim(self, mock_handle_recipient):
+        """
+        If delivery fails we return a 500 so Mailgun retries, and the retry
+        must not be treated as a duplicate.
+        """
+        mock_handle_recipient.side_effect = RuntimeError()
+        post_body = {
+            "Message-Id": uuid.uuid4().hex,
+            "recipient": "class-list@example.edu",
+            "sender": "Unit Test <unittest@example.edu>",
+        }
+        post_body.update(generate_signature_dict())
+        request = self.factory.post("/", post_body)
+        request.user = self.user
+
+        response = handle_mailing_list_email_route(request)
+        self.assertEqual(response.status_code, 500)
+
+        self.assertTrue(
+            HandledMessage.objects.claim(
+                post_body["Message-Id"], post_body["recipient"]
+            )
+        )
+
+    @patch("mailgun.route_handlers._handle_recipient")
+    def test_bounced_message_is_marked_done(self, mock_handle_recipient):
+        """
+        Once a list has been handled, its claim is no longer a lease a later
+        retry could take over.
+        """
+        mock_handle_recipient.return_value = None
+        post_body = {
+            "Message-Id": uuid.uuid4().hex,
+            "recipient": "class-list@example.edu",
+            "sender": "Unit Test <unittest@example.edu>",
+        }
+        post_body.update(generate_signature_dict())
+        request = self.factory.post("/", post_body)
+        request.user = self.user
+
+        response = handle_mailing_list_email_route(request)
+        self.assertEqual(response.status_code, 200)
+
+        handled = HandledMessage.objects.get(message_id=post_body["Message-Id"])
+        self.assertEqual(handled.status, HandledMessage.STATUS_DONE)
+
     @patch("mailgun.route_handlers.logger.exception")
     @patch("mailgun.route_handlers._handle_recipient")
     def test_unhandled_exception(self, mock_handle_recipient, mock_log_exc):
@@ -141,7 +221,7 @@ class RouteHandlerUnitTests(TestCase):
     @patch("mailgun.route_handlers.logger.exception")
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -154,7 +234,7 @@ class RouteHandlerUnitTests(TestCase):
         400 and log it.
         """
         # prep a MailingList mock
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses=set(),
@@ -258,7 +338,7 @@ class RouteHandlerAccessTests(TestCase):
         )
         self.mock_get_alt_emails.return_value = self.alt_emails
         self.mock_get_ci = self._create_patch(
-            "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+            "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
         )
         self.mock_get_ci.return_value = self.ci_mock
         self.mock_get_ml = self._create_patch(
@@ -290,7 +370,7 @@ class RouteHandlerAccessTests(TestCase):
         )
 
     def _get_ml_mock(self):
-        return MagicMock(
+        return _mock_mailing_list(
             address="class-list@example.edu",
             canvas_course_id=123,
             members=self.members,
@@ -563,6 +643,25 @@ class RouteHandlerStaffOnlyListTests(RouteHandlerAccessTests):
         self.assertEqual(sender_display_name, expected_display_name)
         self.assertEqual(sender_address, self.staff_member_address)
 
+    def test_staff_list_sender_is_not_staff(self):
+        """
+        non-staff senders to a staff-only list are bounced without looking up
+        the list's members
+        """
+        self.mock_get_ml.return_value.access_level = MailingList.ACCESS_LEVEL_STAFF
+        members = PropertyMock(return_value=self.members)
+        type(self.mock_get_ml.return_value).members = members
+
+        response = handle_mailing_list_email_route(self._get_post_request())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.mock_send_bounce.call_args[0][0],
+            "mailgun/email/bounce_back_access_denied.html",
+        )
+        self.assertEqual(members.call_count, 0)
+        self.assertEqual(self.mock_get_alt_emails.call_count, 0)
+
 
 class RouteHandlerMultipleRecipientAccessTests(RouteHandlerAccessTests):
     def test_multiple_recipient_lists_use_comm_channel_caching(self):
@@ -592,11 +691,75 @@ class RouteHandlerMultipleRecipientAccessTests(RouteHandlerAccessTests):
         response = handle_mailing_list_email_route(self._get_post_request())
         self.assertEqual(response.status_code, 200)
 
-        self.assertEqual(send_mail_mock.call_count, 2)  # once for each list
+        # both recipients resolve to the same list, so it's sent once
+        self.assertEqual(send_mail_mock.call_count, 1)
         # caching done behind this call, tested in CommChannelCacheTests
         self.assertEqual(self.mock_get_alt_emails.call_count, 2)
 
 
+class RouteHandlerPartialDeliveryTests(RouteHandlerAccessTests):
+    def test_retry_only_sends_to_failed_batches(self):
+        """
+        if some batches of a send fail, Mailgun's retry of the message should
+        only go to the recipients of the failed batches
+        """
+        self.mock_get_ml.return_value.access_level = MailingList.ACCESS_LEVEL_MEMBERS
+        self.post_body["Message-Id"] = uuid.uuid4().hex
+        send_mail_mock = self.mock_get_ml.return_value.send_mail
+
+        result = BatchSendResult()
+        result.sent = ["unittest@example.edu"]
+        result.failed = [([self.regular_member_address], ListservApiError("503"))]
+        send_mail_mock.side_effect = ListservBatchError("503", result)
+
+        response = handle_mailing_list_email_route(self._get_post_request())
+        self.assertEqual(response.status_code, 500)
+
+        send_mail_mock.side_effect = None
+        response = handle_mailing_list_email_route(self._get_post_request())
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(send_mail_mock.call_count, 2)
+        self.assertEqual(
+            send_mail_mock.call_args[0][2],
+            [self.regular_member_address],
+            "the retry shouldn't go to the batch that was already sent",
+        )
+
+
+class RouteHandlerEncapsulatedMessageTests(RouteHandlerAccessTests):
+    def test_spooled_message_is_closed_after_delivery(self):
+        self.mock_get_ml.return_value.access_level = MailingList.ACCESS_LEVEL_MEMBERS
+        self.post_body["attachment-count"] = "1"
+        self.post_body["attachment-1"] = "Subject: fwd\r\n\r\nlorem ipsum"
+        send_mail_mock = self.mock_get_ml.return_value.send_mail
+
+        response = handle_mailing_list_email_route(self._get_post_request())
+        self.assertEqual(response.status_code, 200)
+
+        encapsulated = send_mail_mock.call_args[1]["encapsulated_msg_att"]
+        name, eml_file = encapsulated["attachment-1"]
+        self.assertEqual(name, "fwd")
+        self.assertTrue(eml_file.closed)
+
+    @patch(
+        "mailgun.route_handlers.tempfile.TemporaryFile",
+        wraps=tempfile.TemporaryFile,
+    )
+    def test_message_is_spooled_once_for_all_lists(self, mock_temporary_file):
+        self.mock_get_ml.return_value.access_level = MailingList.ACCESS_LEVEL_MEMBERS
+        self.post_body["recipient"] = [
+            ",".join([self.ml_mock.address, "2@example.edu"])
+        ]
+        self.post_body["attachment-count"] = "1"
+        self.post_body["attachment-1"] = "Subject: fwd\r\n\r\nlorem ipsum"
+
+        response = handle_mailing_list_email_route(self._get_post_request())
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(mock_temporary_file.call_count, 1)
+
+
 class CommChannelCacheTests(TestCase):
     @patch("mailgun.route_handlers.get_alternate_emails_for_user_email")
     def test_comm_channel_caches_backend_calls(self, mock_get_alt_emails):
@@ -614,6 +777,41 @@ class CommChannelCacheTests(TestCase):
             self.assertEqual(result, expected_result)
         self.assertEqual(mock_get_alt_emails.call_count, unique_emails)
 
+    @patch("mailgun.route_handlers.get_alternate_emails_for_user_email")
+    def test_comm_channel_uses_shared_cache_when_sender_matches(
+        self, mock_get_alt_emails
+    ):
+        mock_get_alt_emails.return_value = ["alt@example.edu"]
+        ccc = CommChannelCache()
+
+        result = ccc.get_for("member@example.edu", "alt@example.edu")
+
+        self.assertEqual(result, ["alt@example.edu"])
+        mock_get_alt_emails.assert_called_once_with(
+            "member@example.edu", use_cache=True
+        )
+
+    @patch("mailgun.route_handlers.get_alternate_emails_for_user_email")
+    def test_comm_channel_rechecks_canvas_when_sender_does_not_match(
+        self, mock_get_alt_emails
+    ):
+        """
+        A sender missing from the cached channels (e.g. they've just added
+        the address in Canvas) is checked again against Canvas, once.
+        """
+        mock_get_alt_emails.side_effect = [["old@example.edu"], ["new@example.edu"]]
+        ccc = CommChannelCache()
+
+        result = ccc.get_for("member@example.edu", "new@example.edu")
+        self.assertEqual(result, ["new@example.edu"])
+        self.assertEqual(
+            mock_get_alt_emails.call_args_list[1][0], ("member@example.edu",)
+        )
+        self.assertEqual(mock_get_alt_emails.call_args_list[1][1], {})
+
+        ccc.get_for("member@example.edu", "other@example.edu")
+        self.assertEqual(mock_get_alt_emails.call_count, 2)
+
 
 @override_settings(LISTSERV_API_KEY=str(uuid.uuid4()))
 class RouteHandlerRegressionTests(TestCase):
@@ -629,7 +827,7 @@ class RouteHandlerRegressionTests(TestCase):
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -650,7 +848,7 @@ class RouteHandlerRegressionTests(TestCase):
         members = [
             {"address": a} for a in ["unittest@example.edu", "student@example.edu"]
         ]
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher@example.edu"},
@@ -694,7 +892,7 @@ class RouteHandlerRegressionTests(TestCase):
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -714,7 +912,7 @@ class RouteHandlerRegressionTests(TestCase):
             {"address": a} for a in ["unittest@example.edu", "student@example.edu"]
         ]
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher@example.edu"},
@@ -758,7 +956,7 @@ class RouteHandlerRegressionTests(TestCase):
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -778,7 +976,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         cs = MagicMock(always_mail_staff=False)
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher1@example.edu", "teacher2@example.edu"},
@@ -831,11 +1029,11 @@ class RouteHandlerRegressionTests(TestCase):
             original_to_address=["class-list@example.edu", "bogus@example.edu"],
             text="blah blah",
         )
-        ml.send_mail.assert_has_calls([send_mail_call, send_mail_call])
+        ml.send_mail.assert_has_calls([send_mail_call])
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -862,7 +1060,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         cs = MagicMock(always_mail_staff=False)
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=None,  # this signifies a full course list
             teaching_staff_addresses={"teacher1@example.edu"},
@@ -915,11 +1113,11 @@ class RouteHandlerRegressionTests(TestCase):
             original_to_address=["class-list@example.edu", "bogus@example.edu"],
             text="blah blah",
         )
-        ml.send_mail.assert_has_calls([send_mail_call, send_mail_call])
+        ml.send_mail.assert_has_calls([send_mail_call])
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -943,7 +1141,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         cs = MagicMock(always_mail_staff=True)
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher1@example.edu", "teacher2@example.edu"},
@@ -1001,11 +1199,11 @@ class RouteHandlerRegressionTests(TestCase):
             original_to_address=["class-list@example.edu", "bogus@example.edu"],
             text="blah blah",
         )
-        ml.send_mail.assert_has_calls([send_mail_call, send_mail_call])
+        ml.send_mail.assert_has_calls([send_mail_call])
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -1023,7 +1221,7 @@ class RouteHandlerRegressionTests(TestCase):
         ]
         cs = MagicMock(always_mail_staff=False)
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher1@example.edu", "teacher2@example.edu"},
@@ -1086,7 +1284,7 @@ class RouteHandlerRegressionTests(TestCase):
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -1112,7 +1310,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         cs = MagicMock(always_mail_staff=False)
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher1@example.edu", "teacher2@example.edu"},
@@ -1171,7 +1369,7 @@ class RouteHandlerRegressionTests(TestCase):
 
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -1192,7 +1390,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         cs = MagicMock(always_mail_staff=False)
 
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher1@example.edu", "teacher2@example.edu"},
@@ -1253,13 +1451,14 @@ class RouteHandlerRegressionTests(TestCase):
             ],
             text="blah blah",
         )
-        ml.send_mail.assert_has_calls([send_mail_call, send_mail_call])
-        self.assertEqual(ml.send_mail.call_count, 2)
+        ml.send_mail.assert_has_calls([send_mail_call])
+        # identical deliveries are merged into a single send
+        self.assertEqual(ml.send_mail.call_count, 1)
 
     @patch("mailgun.route_handlers._send_bounce")
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -1299,7 +1498,7 @@ class RouteHandlerRegressionTests(TestCase):
     @patch("mailgun.route_handlers.get_name_for_email")
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -1317,7 +1516,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         # prep a MailingList mock
         members = [{"address": a} for a in [self.user.email, "student@example.edu"]]
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher@example.edu"},
@@ -1369,7 +1568,7 @@ class RouteHandlerRegressionTests(TestCase):
     @patch("mailgun.route_handlers.get_name_for_email")
     @patch("mailgun.route_handlers.SuperSender.objects.filter")
     @patch(
-        "mailgun.route_handlers.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+        "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
     )
     @patch(
         "mailgun.route_handlers.MailingList.objects.get_or_create_or_delete_mailing_list_by_address"
@@ -1386,7 +1585,7 @@ class RouteHandlerRegressionTests(TestCase):
 
         # prep a MailingList mock
         members = [{"address": a} for a in [self.user.email, "student@example.edu"]]
-        ml = MagicMock(
+        ml = _mock_mailing_list(
             canvas_course_id=123,
             section_id=456,
             teaching_staff_addresses={"teacher@example.edu"},
@@ -1443,6 +1642,423 @@ class RouteHandlerRegressionTests(TestCase):
         )
 
 
+class MergeDeliveriesTests(TestCase):
+    longMessage = True
+
+    def _delivery(self, ml, members, subject="blah"):
+        return {
+            "mailing_list": ml,
+            "sender_address": "teacher@example.edu",
+            "sender_display_name": "Teacher via Canvas",
+            "subject": subject,
+            "member_addresses": set(members),
+            "list_addresses": {ml.address},
+        }
+
+    def test_identical_payloads_are_merged(self):
+        ml = MagicMock(address="canvas-1@example.edu", section_id=None)
+        deliveries = _merge_deliveries(
+            [
+                self._delivery(ml, ["a@example.edu"]),
+                self._delivery(ml, ["b@example.edu"]),
+            ]
+        )
+        self.assertEqual(len(deliveries), 1)
+        self.assertEqual(
+            deliveries[0]["member_addresses"], {"a@example.edu", "b@example.edu"}
+        )
+
+    def test_course_and_section_lists_are_sent_together(self):
+        section_ml = MagicMock(address="canvas-1-2@example.edu", section_id=2)
+        course_ml = MagicMock(address="canvas-1@example.edu", section_id=None)
+        deliveries = _merge_deliveries(
+            [
+                self._delivery(section_ml, ["a@example.edu", "c@example.edu"]),
+                self._delivery(course_ml, ["a@example.edu", "b@example.edu"]),
+            ]
+        )
+        self.assertEqual(len(deliveries), 1)
+        self.assertEqual(deliveries[0]["mailing_list"], course_ml)
+        self.assertEqual(
+            deliveries[0]["list_addresses"], {section_ml.address, course_ml.address}
+        )
+        # each recipient gets one copy, from the course list if they're on it
+        self.assertEqual(
+            deliveries[0]["recipient_list_addresses"],
+            {
+                "a@example.edu": course_ml.address,
+                "b@example.edu": course_ml.address,
+                "c@example.edu": section_ml.address,
+            },
+        )
+
+    def test_recipients_get_one_copy_across_sends(self):
+        ml_1 = MagicMock(address="canvas-1@example.edu", section_id=None)
+        ml_2 = MagicMock(address="canvas-2@example.edu", section_id=None)
+        deliveries = _merge_deliveries(
+            [
+                self._delivery(ml_1, ["a@example.edu"], subject="[ONE] blah"),
+                self._delivery(ml_2, ["a@example.edu", "b@example.edu"], "[TWO] blah"),
+            ]
+        )
+        self.assertEqual(len(deliveries), 2)
+        self.assertEqual(deliveries[0]["member_addresses"], {"a@example.edu"})
+        self.assertEqual(deliveries[1]["member_addresses"], {"b@example.edu"})
+
+
+class HandledMessageLedgerTests(TestCase):
+    def test_claim_is_only_granted_once_per_list(self):
+        message_id = uuid.uuid4().hex
+        self.assertTrue(HandledMessage.objects.claim(message_id, "a@example.edu"))
+        self.assertFalse(HandledMessage.objects.claim(message_id, "a@example.edu"))
+        # the same message to a different list is a separate delivery
+        self.assertTrue(HandledMessage.objects.claim(message_id, "b@example.edu"))
+
+    def test_released_claim_can_be_claimed_again(self):
+        message_id = uuid.uuid4().hex
+        HandledMessage.objects.claim(message_id, "a@example.edu")
+        HandledMessage.objects.release(message_id, "a@example.edu")
+        self.assertTrue(HandledMessage.objects.claim(message_id, "a@example.edu"))
+
+    def test_expired_claim_from_a_dead_claimant_is_taken_over(self):
+        message_id = uuid.uuid4().hex
+        self.assertTrue(HandledMessage.objects.claim(message_id, "a@example.edu"))
+        # the claimant was killed mid-send, so it never marked the message
+        # done or released it
+        HandledMessage.objects.filter(message_id=message_id).update(
+            date_leased=timezone.now()
+            - datetime.timedelta(seconds=settings.HANDLED_MESSAGE_LEASE + 1)
+        )
+
+        self.assertTrue(HandledMessage.objects.claim(message_id, "a@example.edu"))
+        # only one retry gets to take it over
+        self.assertFalse(HandledMessage.objects.claim(message_id, "a@example.edu"))
+
+    def test_done_claim_is_never_taken_over(self):
+        message_id = uuid.uuid4().hex
+        HandledMessage.objects.claim(message_id, "a@example.edu")
+        HandledMessage.objects.mark_done(message_id, "a@example.edu")
+        HandledMessage.objects.filter(message_id=message_id).update(
+            date_leased=timezone.now()
+            - datetime.timedelta(seconds=settings.HANDLED_MESSAGE_LEASE + 1)
+        )
+
+        self.assertFalse(HandledMessage.objects.claim(message_id, "a@example.edu"))
+
+
+@override_settings(LISTSERV_API_KEY=str(uuid.uuid4()))
+class RouteQueueTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.create_user(
+            email="unittest@example.edu", password="insecure", username="unittest"
+        )
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir, ignore_errors=True)
+        self.queue_settings = {
+            "BACKEND": "mailgun.queues.FileSystemQueue",
+            "OPTIONS": {"location": self.spool_dir, "max_attempts": 2},
+        }
+
+    def _get_post_request(self):
+        attachment_fp = StringIO("lorem ipsum")
+        attachment_fp.name = "lorem.txt"
+        attachment_fp.content_type = "text/plain"
+        post_body = {
+            "sender": "Unit Test <unittest@example.edu>",
+            "recipient": "class-list@example.edu",
+            "subject": "blah",
+            "body-plain": "blah blah",
+            "attachment-count": 1,
+            "attachment-1": attachment_fp,
+        }
+        post_body.update(generate_signature_dict())
+        request = self.factory.post("/", post_body)
+        request.user = self.user
+        return request
+
+    @patch("mailgun.route_handlers._handle_recipient")
+    def test_route_handler_enqueues_when_queue_configured(self, mock_handle_recipient):
+        """
+        With a route queue configured the webhook should spool the POST and
+        return without doing any delivery work.
+        """
+        with override_settings(MAILGUN_ROUTE_QUEUE=self.queue_settings):
+            response = handle_mailing_list_email_route(self._get_post_request())
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_handle_recipient.call_count, 0)
+
+            message = get_route_queue().claim()
+
+        self.assertIsNotNone(message)
+        self.assertEqual(message.POST["recipient"], "class-list@example.edu")
+        self.assertEqual(message.POST["subject"], "blah")
+        self.assertEqual(message.FILES["attachment-1"].name, "lorem.txt")
+        self.assertEqual(message.FILES["attachment-1"].read(), b"lorem ipsum")
+        self.assertEqual(message.attempts, 1)
+
+    def test_file_system_queue_ack_removes_message(self):
+        request = self._get_post_request()
+        route_queue = FileSystemQueue(self.spool_dir)
+        route_queue.enqueue(request.POST, request.FILES)
+
+        message = route_queue.claim()
+        self.assertIsNotNone(message)
+        # a claimed message isn't handed to another worker
+        self.assertIsNone(route_queue.claim())
+
+        route_queue.ack(message)
+        self.assertIsNone(route_queue.claim())
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, "cur")), [])
+
+    def test_file_system_queue_nack_retries_then_fails(self):
+        request = self._get_post_request()
+        route_queue = FileSystemQueue(self.spool_dir, max_attempts=2)
+        route_queue.enqueue(request.POST, request.FILES)
+
+        route_queue.nack(route_queue.claim())
+        message = route_queue.claim()
+        self.assertEqual(message.attempts, 2)
+
+        route_queue.nack(message)
+        self.assertIsNone(route_queue.claim())
+        self.assertEqual(len(os.listdir(os.path.join(self.spool_dir, "failed"))), 1)
+
+    def test_database_queue_spools_attachments_to_disk(self):
+        request = self._get_post_request()
+        route_queue = DatabaseQueue(self.spool_dir)
+        route_queue.enqueue(request.POST, request.FILES)
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+        message = route_queue.claim()
+        self.assertIsNotNone(message)
+        self.assertIsNone(route_queue.claim())
+        self.assertEqual(message.FILES["attachment-1"].name, "lorem.txt")
+        self.assertEqual(message.FILES["attachment-1"].read(), b"lorem ipsum")
+
+        route_queue.ack(message)
+        self.assertIsNone(route_queue.claim())
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    @patch("mailgun.management.commands.process_route_queue.handle_message")
+    def test_worker_drains_queue(self, mock_handle_message):
+        request = self._get_post_request()
+        with override_settings(MAILGUN_ROUTE_QUEUE=self.queue_settings):
+            get_route_queue().enqueue(request.POST, request.FILES)
+            call_command("process_route_queue", once=True)
+
+        self.assertEqual(mock_handle_message.call_count, 1)
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, "new")), [])
+        self.assertEqual(os.listdir(os.path.join(self.spool_dir, "cur")), [])
+
+
+class MultipartStreamTests(TestCase):
+    def test_length_matches_streamed_body(self):
+        attachment = BytesIO(b"lorem ipsum" * 10000)
+        stream = MultipartStream(
+            [("to", ["a@example.edu", "b@example.edu"]), ("subject", "caf\u00e9")],
+            [("attachment", ("lorem.txt", attachment, "text/plain"))],
+        )
+        body = b"".join(stream)
+        self.assertEqual(len(body), len(stream))
+        self.assertIn(b"caf\xc3\xa9", body)
+        self.assertIn(b'name="attachment"; filename="lorem.txt"', body)
+        self.assertTrue(body.endswith("--{}--\r\n".format(stream.boundary).encode()))
+
+    def test_files_are_rewound_for_each_send(self):
+        attachment = BytesIO(b"lorem ipsum")
+        stream = MultipartStream([], [("attachment", ("lorem.txt", attachment))])
+        self.assertEqual(b"".join(stream), b"".join(stream))
+
+
+@patch("mailgun.listserv_client.get_session")
+class ListservClientTests(TestCase):
+    def test_send_mail_streams_attachments(self, mock_get_session):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = MagicMock(status_code=200)
+        attachment = SimpleUploadedFile(
+            "lorem.txt", b"lorem ipsum", content_type="text/plain"
+        )
+
+        ListservClient().send_mail(
+            "class-list@example.edu",
+            "unittest@example.edu",
+            ["student@example.edu"],
+            subject="blah",
+            text="blah",
+            attachments=[attachment],
+            encapsulated_msg_att={"attachment-2": ("fwd", BytesIO(b"Subject: fwd"))},
+        )
+
+        body = mock_post.call_args[1]["data"]
+        self.assertIsInstance(body, MultipartStream)
+        self.assertEqual(
+            mock_post.call_args[1]["headers"], {"Content-Type": body.content_type}
+        )
+        content = b"".join(body)
+        self.assertIn(b"lorem ipsum", content)
+        self.assertIn(b'filename="fwd.eml"', content)
+
+
+    @override_settings(LISTSERV_BATCH_SIZE=2, LISTSERV_BATCH_CONCURRENCY=2)
+    def test_send_mail_chunks_large_lists(self, mock_get_session):
+        session_post = mock_get_session.return_value.post
+        session_post.return_value = MagicMock(status_code=200)
+        to_address = ["{}@example.edu".format(i) for i in range(5)]
+
+        result = ListservClient().send_mail(
+            "class-list@example.edu", "unittest@example.edu", to_address, text="blah"
+        )
+
+        self.assertEqual(session_post.call_count, 3)
+        batch_sizes = [
+            b"".join(c[1]["data"]).count(b'name="to"')
+            for c in session_post.call_args_list
+        ]
+        self.assertEqual(sorted(batch_sizes), [1, 2, 2])
+        self.assertTrue(result.ok)
+        self.assertEqual(sorted(result.sent), sorted(to_address))
+
+    def test_send_mail_sets_each_recipients_list_id(self, mock_get_session):
+        session_post = mock_get_session.return_value.post
+        session_post.return_value = MagicMock(status_code=200)
+
+        ListservClient().send_mail(
+            "class-list@example.edu",
+            "unittest@example.edu",
+            ["a@example.edu", "b@example.edu"],
+            text="blah",
+            recipient_list_addresses={
+                "a@example.edu": "class-list@example.edu",
+                "b@example.edu": "section-list@example.edu",
+            },
+        )
+
+        body = b"".join(session_post.call_args[1]["data"])
+        self.assertIn(b"<%recipient.list_address%>", body)
+        self.assertIn(b'"list_address": "section-list@example.edu"', body)
+
+    @override_settings(LISTSERV_BATCH_SIZE=2, LISTSERV_BATCH_CONCURRENCY=2)
+    def test_send_mail_reports_partial_failures(self, mock_get_session):
+        session_post = mock_get_session.return_value.post
+        session_post.side_effect = [
+            MagicMock(status_code=200),
+            MagicMock(status_code=500, text="oops"),
+        ]
+        to_address = ["{}@example.edu".format(i) for i in range(4)]
+
+        with self.assertRaises(ListservBatchError) as cm:
+            ListservClient().send_mail(
+                "class-list@example.edu",
+                "unittest@example.edu",
+                to_address,
+                text="blah",
+            )
+
+        result = cm.exception.result
+        self.assertFalse(result.ok)
+        self.assertEqual(len(result.sent), 2)
+        self.assertEqual(len(result.failed), 1)
+        self.assertEqual(len(result.failed[0][0]), 2)
+
+
+    def test_send_mail_applies_timeout(self, mock_get_session):
+        mock_post = mock_get_session.return_value.post
+        mock_post.return_value = MagicMock(status_code=200)
+
+        ListservClient().send_mail(
+            "class-list@example.edu", "unittest@example.edu", ["a@example.edu"]
+        )
+
+        self.assertEqual(
+            mock_post.call_args[1]["timeout"], settings.LISTSERV_API_TIMEOUT
+        )
+
+    def test_send_mail_wraps_connection_errors(self, mock_get_session):
+        mock_get_session.return_value.post.side_effect = (
+            requests.exceptions.ConnectionError("nope")
+        )
+        with self.assertRaises(ListservApiError):
+            ListservClient().send_mail(
+                "class-list@example.edu", "unittest@example.edu", ["a@example.edu"]
+            )
+
+
+class ApiSessionTests(TestCase):
+    def test_session_is_shared_and_retries(self):
+        session = get_session()
+        self.assertIs(get_session(), session)
+        retry = session.get_adapter("https://api.mailgun.net/").max_retries
+        self.assertEqual(retry.total, settings.LISTSERV_API_MAX_RETRIES)
+        self.assertIn(429, retry.status_forcelist)
+        self.assertIn(503, retry.status_forcelist)
+        self.assertTrue(retry.respect_retry_after_header)
+
+    def test_sends_are_not_retried_after_they_may_have_landed(self):
+        retry = get_session().get_adapter("https://api.mailgun.net/").max_retries
+        self.assertIn("POST", retry.allowed_methods)
+        self.assertEqual(retry.read, 0)
+        for status in (500, 502, 504):
+            self.assertFalse(retry.is_retry("POST", status), status)
+        self.assertTrue(retry.is_retry("POST", 503))
+
+
+@override_settings(LISTSERV_API_KEY=str(uuid.uuid4()))
+class AsyncRouteHandlerTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    @patch("mailgun.route_handlers.handle_message")
+    async def test_message_is_delivered_off_the_event_loop(self, mock_handle):
+        mock_handle.return_value = JsonResponse({"success": True})
+        request = self.factory.post("/", generate_signature_dict())
+
+        response = await handle_mailing_list_email_route_async(request)
+
+        self.assertEqual(response.status_code, 200)
+        mock_handle.assert_called_once_with(request)
+
+    @patch("mailgun.route_handlers.handle_message")
+    async def test_exceptions_ask_mailgun_to_retry(self, mock_handle):
+        mock_handle.side_effect = RuntimeError
+        request = self.factory.post("/", generate_signature_dict())
+
+        response = await handle_mailing_list_email_route_async(request)
+
+        self.assertEqual(response.status_code, 500)
+
+    @patch("mailgun.route_handlers.handle_message")
+    async def test_bad_signature_is_rejected(self, mock_handle):
+        post_body = generate_signature_dict()
+        post_body["signature"] = "bogus"
+        request = self.factory.post("/", post_body)
+
+        response = await handle_mailing_list_email_route_async(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(mock_handle.call_count, 0)
+
+    @patch("mailgun.route_handlers.handle_message")
+    async def test_signature_is_checked_off_the_event_loop(self, mock_handle):
+        mock_handle.return_value = JsonResponse({"success": True})
+        request = self.factory.post("/", generate_signature_dict())
+        checked_on = []
+
+        def check_signature(request, redirect_url):
+            checked_on.append(threading.current_thread())
+
+        with patch("mailgun.decorators._check_signature", check_signature):
+            response = await handle_mailing_list_email_route_async(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(checked_on), 1)
+        self.assertIsNot(checked_on[0], threading.current_thread())
+
+
 @override_settings(LISTSERV_API_KEY=str(uuid.uuid4()))
 class DecoratorTests(TestCase):
     longMessage = True
@@ -9,6 +9,11 @@ urlpatterns = [
         route_handlers.handle_mailing_list_email_route,
         name="handle_mailing_list_email_route",
     ),
+    re_path(
+        r"^handle_mailing_list_email_route_async/",
+        route_handlers.handle_mailing_list_email_route_async,
+        name="handle_mailing_list_email_route_async",
+    ),
     path("auth_error/", views.auth_error, name="auth_error"),
     re_path(r"^log_post_data/", views.log_post_data, name="log_post_data"),
 ]
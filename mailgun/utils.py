@@ -1,2 +1,95 @@
+import threading
+import uuid
+
+MULTIPART_CHUNK_SIZE = 64 * 1024
+
+# the same uploaded files are streamed by concurrent batch sends, so each
+# seek + read of a shared file object has to happen as a unit
+_file_lock = threading.Lock()
+
+
 def replace_non_ascii(s, replacement="_"):
     return "".join(i if ord(i) < 128 else replacement for i in s)
+
+
+class MultipartStream(object):
+    """
+    A multipart/form-data request body that is read from its fields and files
+    as it's sent, rather than being assembled in memory the way
+    requests.post(files=...) does.  Defines __len__ so requests can send it
+    with a Content-Length header.
+
+    `fields` is a list of (name, value) tuples, where value is a string or a
+    list of strings; `files` is a list of (name, (filename, fileobj,
+    content_type)) tuples, where content_type may be omitted.
+    """
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self._parts = []
+        for name, value in fields:
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for v in values:
+                self._parts.append(
+                    (self._part_header(name), str(v).encode("utf-8"), None)
+                )
+        for name, file_tuple in files:
+            filename, fileobj = file_tuple[0], file_tuple[1]
+            content_type = file_tuple[2] if len(file_tuple) > 2 else None
+            self._parts.append(
+                (
+                    self._part_header(name, filename, content_type),
+                    None,
+                    fileobj,
+                )
+            )
+        self._closing = "--{}--\r\n".format(self.boundary).encode("ascii")
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary={}".format(self.boundary)
+
+    def _part_header(self, name, filename=None, content_type=None):
+        disposition = 'form-data; name="{}"'.format(name)
+        if filename is not None:
+            disposition += '; filename="{}"'.format(filename.replace('"', '\\"'))
+        header = "--{}\r\nContent-Disposition: {}\r\n".format(
+            self.boundary, disposition
+        )
+        if content_type:
+            header += "Content-Type: {}\r\n".format(content_type)
+        return (header + "\r\n").encode("utf-8")
+
+    @staticmethod
+    def _file_size(fileobj):
+        with _file_lock:
+            fileobj.seek(0, 2)
+            return fileobj.tell()
+
+    def __len__(self):
+        length = len(self._closing)
+        for header, data, fileobj in self._parts:
+            length += len(header) + 2  # trailing \r\n
+            length += len(data) if fileobj is None else self._file_size(fileobj)
+        return length
+
+    def __iter__(self):
+        for header, data, fileobj in self._parts:
+            yield header
+            if fileobj is None:
+                yield data
+            else:
+                # the same file may be sent to several lists or batches, so
+                # always start from the beginning, and keep track of our own
+                # position in case another stream is reading it too
+                position = 0
+                while True:
+                    with _file_lock:
+                        fileobj.seek(position)
+                        chunk = fileobj.read(MULTIPART_CHUNK_SIZE)
+                        position = fileobj.tell()
+                    if not chunk:
+                        break
+                    yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+            yield b"\r\n"
+        yield self._closing
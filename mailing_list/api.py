@@ -4,7 +4,6 @@ import logging
 import lti_school_permissions.constants as constants
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.http import JsonResponse
 from django.views.decorators.http import require_http_methods
@@ -36,7 +35,7 @@ def lists(request):
             "canvas_user_loginid"
         )
 
-        mailing_lists = MailingList.objects.get_or_create_or_delete_mailing_lists_for_canvas_course_id(
+        mailing_lists = MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(
             canvas_course_id,
             defaults={
                 "created_by": logged_in_user_id,
@@ -84,8 +83,8 @@ def set_access_level(request, mailing_list_id):
         mailing_list.access_level = access_level
         mailing_list.save()
 
-        cache.delete(
-            settings.CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID % mailing_list.canvas_course_id
+        MailingList.objects.invalidate_cached_mailing_lists(
+            mailing_list.canvas_course_id
         )
 
         result = {
@@ -132,9 +131,7 @@ def get_or_create_course_settings(request):
                 course_settings.always_mail_staff = always_mail_staff_flag
             course_settings.modified_by = logged_in_user_id
             course_settings.save()
-            cache.delete(
-                settings.CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID % canvas_course_id
-            )
+            MailingList.objects.invalidate_cached_mailing_lists(canvas_course_id)
     except Exception:
         message = (
             "Failed to get_or_create CourseSettings for course %s" % canvas_course_id
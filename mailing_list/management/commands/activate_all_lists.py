@@ -1,11 +1,16 @@
+import json
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from operator import itemgetter
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
 import csv
 
 from lti_emailer.canvas_api_client import get_courses_for_account_in_term
+from lti_emailer.canvas_throttle import canvas_throttle
 from mailing_list.models import MailingList
 from canvas_sdk.exceptions import CanvasAPIError
 
@@ -34,8 +39,31 @@ class Command(BaseCommand):
         parser.add_argument(
             "--output-file", help="File to output mailing list details to"
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of courses to process at once (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--resume-file",
+            help="File to record finished courses in.  If it already exists, "
+            "the courses recorded in it are skipped, so an interrupted run "
+            "can be resumed by running the command again with the same file",
+        )
+        parser.add_argument(
+            "--progress-interval",
+            type=int,
+            default=50,
+            help="Report progress every N courses (default: %(default)s)",
+        )
 
     def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        # give way to the webhook when the Canvas quota gets low
+        canvas_throttle.set_background()
+
         courses = []
         for term_id in options["enrollment_term_id"]:
             try:
@@ -49,34 +77,45 @@ class Command(BaseCommand):
             except RuntimeError as e:
                 raise CommandError(str(e))
 
-        course_lists, failures = {}, {}
-        num_lists = 0
-        defaults = {"access_level": MailingList.ACCESS_LEVEL_MEMBERS}
-        for course in courses:
-            try:
-                lists = MailingList.objects.get_or_create_or_delete_mailing_lists_for_canvas_course_id(
-                    course["id"], defaults=defaults
+        course_lists = self.load_resume_file(options.get("resume_file"))
+        pending = sorted({c["id"] for c in courses if c["id"] not in course_lists})
+        if course_lists:
+            self.stdout.write(
+                "Resuming; skipping {} course(s) already done".format(
+                    len(course_lists)
                 )
-            except RuntimeError as e:
-                failures[course["id"]] = str(e)
-                continue
-
-            # the "is it the primary list" logic varies depending on whether or
-            # not the list is crosslisted.  figure out which logic to use
-            # before bucketing the lists.
-            if any([l["is_course_list"] for l in lists]):
-                is_primary = itemgetter("is_course_list")
-            else:
-                is_primary = itemgetter("is_primary")
+            )
 
-            primary, secondary = [], []
-            for ml in lists:
-                num_lists += 1
-                if is_primary(ml):
-                    primary.append(ml)
+        failures = {}
+        defaults = {"access_level": MailingList.ACCESS_LEVEL_MEMBERS}
+        resume_file = (
+            open(options["resume_file"], "a") if options.get("resume_file") else None
+        )
+        try:
+            results = self.process_courses(pending, defaults, options["workers"])
+            for i, (course_id, lists, error) in enumerate(results, start=1):
+                if error is not None:
+                    failures[course_id] = error
                 else:
-                    secondary.append(ml)
-            course_lists[course["id"]] = {"primary": primary, "secondary": secondary}
+                    course_lists[course_id] = lists
+                    if resume_file:
+                        resume_file.write(
+                            json.dumps(dict(lists, course_id=course_id)) + "\n"
+                        )
+                        resume_file.flush()
+                if i % options["progress_interval"] == 0 or i == len(pending):
+                    self.stdout.write(
+                        "Processed {}/{} course(s), {} failure(s)".format(
+                            i, len(pending), len(failures)
+                        )
+                    )
+        finally:
+            if resume_file:
+                resume_file.close()
+
+        num_lists = sum(
+            len(l["primary"]) + len(l["secondary"]) for l in course_lists.values()
+        )
 
         if failures:
             for course_id, error_message in failures.items():
@@ -107,14 +146,10 @@ class Command(BaseCommand):
                     "secondary_lists",
                 )
             )
-            for course_id in sorted(course_lists):
+            for course_id in sorted(set(course_lists) & set(courses_by_id)):
                 course = courses_by_id[course_id]
-                primary = ";".join(
-                    [l["address"] for l in course_lists[course_id]["primary"]]
-                )
-                secondary = ";".join(
-                    [l["address"] for l in course_lists[course_id]["secondary"]]
-                )
+                primary = ";".join(course_lists[course_id]["primary"])
+                secondary = ";".join(course_lists[course_id]["secondary"])
                 row = (
                     str(course_id),
                     str(course["sis_course_id"]),
@@ -124,3 +159,80 @@ class Command(BaseCommand):
                     secondary,
                 )
                 writer.writerow(row)
+
+    def load_resume_file(self, path):
+        """
+        :return: dict of course id to the primary and secondary list
+            addresses of each course recorded in the resume file
+        """
+        course_lists = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        course_lists[record.pop("course_id")] = record
+        return course_lists
+
+    def process_courses(self, course_ids, defaults, workers):
+        """
+        Yields (course id, lists, error message or None) as each course is
+        finished, processing up to `workers` courses at once.  A failure only
+        affects its own course.
+        """
+        if workers == 1:
+            for course_id in course_ids:
+                yield self.process_course_isolated(course_id, defaults)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self.process_course_in_thread, course_id, defaults)
+                for course_id in course_ids
+            ]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def process_course_in_thread(self, course_id, defaults):
+        try:
+            return self.process_course_isolated(course_id, defaults)
+        finally:
+            # pool threads don't get Django's request cleanup
+            connections.close_all()
+
+    def process_course_isolated(self, course_id, defaults):
+        try:
+            return course_id, self.process_course(course_id, defaults), None
+        except Exception as e:
+            return course_id, None, str(e)
+
+    def process_course(self, course_id, defaults):
+        """
+        :return: dict of the primary and secondary list addresses of the course
+        """
+        canvas_throttle.wait()
+        try:
+            lists = MailingList.objects.get_or_create_or_delete_mailing_lists_for_canvas_course_id(
+                course_id, defaults=defaults
+            )
+        except CanvasAPIError as e:
+            if getattr(e, "status_code", None) == 403:
+                # most likely the rate limit; give Canvas a breather
+                canvas_throttle.backoff()
+            raise
+
+        # the "is it the primary list" logic varies depending on whether or
+        # not the list is crosslisted.  figure out which logic to use
+        # before bucketing the lists.
+        if any([l["is_course_list"] for l in lists]):
+            is_primary = itemgetter("is_course_list")
+        else:
+            is_primary = itemgetter("is_primary")
+
+        primary, secondary = [], []
+        for ml in lists:
+            if is_primary(ml):
+                primary.append(ml["address"])
+            else:
+                secondary.append(ml["address"])
+        return {"primary": primary, "secondary": secondary}
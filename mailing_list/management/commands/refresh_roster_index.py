@@ -0,0 +1,54 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from lti_emailer.canvas_throttle import canvas_throttle
+from mailing_list.models import CourseRosterIndex
+from mailing_list.tasks import course_sync_listserv
+
+
+class Command(BaseCommand):
+    help = (
+        "Refreshes the locally stored course rosters from Canvas, so the route "
+        "handler can answer list membership without a Canvas round trip"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "canvas_course_ids",
+            nargs="*",
+            type=int,
+            help="Canvas course ids to refresh (default: every stored roster "
+            "older than half of ROSTER_INDEX_MAX_AGE)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of courses to fetch from Canvas at once (default: %(default)s)",
+        )
+
+    def handle(self, *args, **options):
+        if not CourseRosterIndex.objects.is_enabled():
+            raise CommandError("ROSTER_INDEX_MAX_AGE is not set")
+        # give way to the webhook when the Canvas quota gets low
+        canvas_throttle.set_background()
+
+        canvas_course_ids = options["canvas_course_ids"]
+        if not canvas_course_ids:
+            cutoff = timezone.now() - datetime.timedelta(
+                seconds=settings.ROSTER_INDEX_MAX_AGE / 2
+            )
+            canvas_course_ids = list(
+                CourseRosterIndex.objects.filter(
+                    date_refreshed__lt=cutoff
+                ).values_list("canvas_course_id", flat=True)
+            )
+
+        run = course_sync_listserv(canvas_course_ids, workers=options["workers"])
+
+        if run.courses_failed:
+            self.stderr.write("Failed to refresh {} roster(s)".format(run.courses_failed))
+        self.stdout.write("Refreshed {} roster(s)".format(run.courses_synced))
@@ -1,7 +1,9 @@
 import logging
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
+from lti_emailer.canvas_throttle import canvas_throttle
+from mailing_list.models import CourseRosterIndex
 from mailing_list.tasks import course_sync_listserv
 
 
@@ -9,8 +11,56 @@ logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    help = "Synchronizes mailing lists created for canvas courses with the enrollment list for each course"
+    help = (
+        "Synchronizes the stored roster of each course with mailing lists with "
+        "the course's enrollments in Canvas, so list membership is warm before "
+        "mail is sent"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "canvas_course_ids",
+            nargs="*",
+            type=int,
+            help="Canvas course ids to sync (default: every course with mailing lists)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of courses to fetch from Canvas at once (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="Pick up the last unfinished run, skipping the courses it synced",
+        )
 
     def handle(self, *args, **options):
-        logger.info("Beginning sync_listserv job for canvas_course_ids %s", args)
-        course_sync_listserv(args or None)
+        if not CourseRosterIndex.objects.is_enabled():
+            raise CommandError("ROSTER_INDEX_MAX_AGE is not set")
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        # give way to the webhook when the Canvas quota gets low
+        canvas_throttle.set_background()
+
+        canvas_course_ids = options["canvas_course_ids"] or None
+        logger.info(
+            "Beginning sync_listserv job for canvas_course_ids %s", canvas_course_ids
+        )
+        run = course_sync_listserv(
+            canvas_course_ids, workers=options["workers"], resume=options["resume"]
+        )
+
+        if run.courses_failed:
+            self.stderr.write("Failed to sync {} course(s)".format(run.courses_failed))
+        self.stdout.write(
+            "Synced {} of {} course(s): {} added, {} changed, {} removed".format(
+                run.courses_synced,
+                run.courses_total,
+                run.emails_added,
+                run.emails_changed,
+                run.emails_removed,
+            )
+        )
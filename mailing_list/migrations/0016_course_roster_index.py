@@ -0,0 +1,53 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailing_list", "0015_alter_mailinglist_access_level"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CourseRosterIndex",
+            fields=[
+                (
+                    "canvas_course_id",
+                    models.IntegerField(primary_key=True, serialize=False),
+                ),
+                ("date_refreshed", models.DateTimeField()),
+            ],
+            options={
+                "db_table": "ml_course_roster_index",
+            },
+        ),
+        migrations.CreateModel(
+            name="CourseRosterEmail",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("email", models.CharField(max_length=254)),
+                ("section_id", models.IntegerField()),
+                ("is_teaching_staff", models.BooleanField(default=False)),
+                (
+                    "roster_index",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="emails",
+                        to="mailing_list.courserosterindex",
+                    ),
+                ),
+            ],
+            options={
+                "db_table": "ml_course_roster_email",
+                "unique_together": {("roster_index", "email", "section_id")},
+            },
+        ),
+    ]
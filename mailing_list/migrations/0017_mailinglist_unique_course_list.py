@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+def delete_duplicate_course_lists(apps, schema_editor):
+    """
+    Concurrent launches could create more than one course list (section_id
+    NULL) for a course; keep the oldest.
+    """
+    MailingList = apps.get_model("mailing_list", "MailingList")
+    seen = set()
+    duplicate_ids = []
+    for ml in MailingList.objects.filter(section_id__isnull=True).order_by("id"):
+        if ml.canvas_course_id in seen:
+            duplicate_ids.append(ml.id)
+        seen.add(ml.canvas_course_id)
+    MailingList.objects.filter(id__in=duplicate_ids).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailing_list", "0016_course_roster_index"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            delete_duplicate_course_lists, reverse_code=migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name="mailinglist",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(section_id__isnull=True),
+                fields=("canvas_course_id",),
+                name="ml_mailing_list_unique_course_list",
+            ),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailing_list", "0017_mailinglist_unique_course_list"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RosterSyncRun",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date_started", models.DateTimeField(auto_now_add=True)),
+                ("date_finished", models.DateTimeField(null=True)),
+                ("courses_total", models.IntegerField(default=0)),
+                ("courses_synced", models.IntegerField(default=0)),
+                ("courses_failed", models.IntegerField(default=0)),
+                ("emails_added", models.IntegerField(default=0)),
+                ("emails_changed", models.IntegerField(default=0)),
+                ("emails_removed", models.IntegerField(default=0)),
+            ],
+            options={
+                "db_table": "ml_roster_sync_run",
+            },
+        ),
+    ]
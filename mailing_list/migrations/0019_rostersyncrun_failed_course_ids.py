@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("mailing_list", "0018_rostersyncrun"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="rostersyncrun",
+            name="failed_course_ids",
+            field=models.JSONField(default=list),
+        ),
+    ]
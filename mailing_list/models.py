@@ -1,15 +1,22 @@
+import datetime
 import logging
 import re
+import threading
+import time
+import uuid
 from timeit import default_timer as timer
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from flanker.addresslib import address as addresslib_address
 from lti_emailer import canvas_api_client
 from mailgun.listserv_client import MailgunClient as ListservClient
 
-from mailing_list.utils import get_section_sis_enrollment_status
+from mailing_list.utils import get_section_sis_enrollment_statuses
 
 logger = logging.getLogger(__name__)
 
@@ -101,68 +108,42 @@ class MailingListManager(models.Manager):
         canvas_sections = canvas_api_client.get_sections(
             canvas_course_id, fetch_enrollments=False
         )
-        mailing_lists_by_section_id = self._get_mailing_lists_by_section_id(
-            canvas_course_id
+        # cs_class_type is used to determine if the section
+        # is an enrollment section or a non-enrollment section.
+        # if it's null for a section with a real sis section id, we
+        # should consider it an enrollment section.
+        cs_class_types = get_section_sis_enrollment_statuses(
+            s["sis_section_id"]
+            for s in canvas_sections
+            if s["sis_section_id"] and s["sis_section_id"].isdigit()
         )
 
-        overrides = kwargs.get("defaults", {})
-        result = []
+        mailing_lists_by_section_id = self._reconcile_mailing_lists(
+            canvas_course_id,
+            [s["id"] for s in canvas_sections],
+            kwargs.get("defaults", {}),
+        )
 
-        try:
-            # Check if there is a  Course list(Meta mailing list)
-            course_list = mailing_lists_by_section_id.pop(None)
-        except KeyError:
-            course_list = None
-
-        if not course_list:
-            create_kwargs = {"canvas_course_id": canvas_course_id, "section_id": None}
-            create_kwargs.update(overrides)
-            course_list = MailingList(**create_kwargs)
-            course_list.save()
-
-        # if there is a course_list, add it to the result list so
-        # it can be used by the template.
-        if course_list:
-            result.append(
-                {
-                    "id": course_list.id,
-                    "canvas_course_id": course_list.canvas_course_id,
-                    "sis_section_id": None,
-                    "section_id": course_list.section_id,
-                    "name": "Course Mailing List",
-                    "address": course_list.address,
-                    "access_level": course_list.access_level,
-                    "is_course_list": True,
-                    "cs_class_type": None,
-                    "is_primary": False,
-                }
-            )
+        # add the course list (Meta mailing list) first so it can be used by
+        # the template.
+        course_list = mailing_lists_by_section_id[None]
+        result = [
+            {
+                "id": course_list.id,
+                "canvas_course_id": course_list.canvas_course_id,
+                "sis_section_id": None,
+                "section_id": course_list.section_id,
+                "name": "Course Mailing List",
+                "address": course_list.address,
+                "access_level": course_list.access_level,
+                "is_course_list": True,
+                "cs_class_type": None,
+                "is_primary": False,
+            }
+        ]
 
         for s in canvas_sections:
-            section_id = s["id"]
-            try:
-                mailing_list = mailing_lists_by_section_id.pop(section_id)
-            except KeyError:
-                mailing_list = None
-
-            if not mailing_list:
-                create_kwargs = {
-                    "canvas_course_id": canvas_course_id,
-                    "section_id": section_id,
-                }
-                create_kwargs.update(overrides)
-                mailing_list = MailingList(**create_kwargs)
-                mailing_list.save()
-
-            # cs_class_type is used to determine if the section
-            # is an enrollment section or a non-enrollment section.
-            # if it's null for a section with a real sis section id, we
-            # should consider it an enrollment section.
-            cs_class_type = None
-            if s["sis_section_id"] and s["sis_section_id"].isdigit():
-                logger.debug("Looking up section id %s" % s["sis_section_id"])
-                cs_class_type = get_section_sis_enrollment_status(s["sis_section_id"])
-
+            mailing_list = mailing_lists_by_section_id[s["id"]]
             result.append(
                 {
                     "id": mailing_list.id,
@@ -173,17 +154,145 @@ class MailingListManager(models.Manager):
                     "address": mailing_list.address,
                     "access_level": mailing_list.access_level,
                     "is_course_list": False,
-                    "cs_class_type": cs_class_type,
+                    "cs_class_type": cs_class_types.get(s["sis_section_id"]),
                     "is_primary": s["sis_section_id"] == sis_course_id,
                 }
             )
 
-        # Delete existing mailing lists who's section no longer exists
-        for section_id, mailing_list in mailing_lists_by_section_id.items():
-            mailing_list.delete()
-
         return result
 
+    def get_cached_mailing_lists_for_canvas_course_id(self, canvas_course_id, **kwargs):
+        """
+        Read-through cache of get_or_create_or_delete_mailing_lists_for_canvas_course_id,
+        with stale-while-revalidate: for settings.LISTS_CACHE_TIMEOUT seconds
+        the cached lists are returned as-is; for LISTS_CACHE_STALE_TIMEOUT
+        seconds after that they're still returned, but recomputed in a
+        background thread.  Call invalidate_cached_mailing_lists() to force a
+        recompute.
+
+        :param canvas_course_id:
+        :param kwargs: passed on to get_or_create_or_delete_mailing_lists_for_canvas_course_id
+        :return: List of mailing list dictionaries for the given canvas_course_id
+        """
+        cache_key = settings.CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID % canvas_course_id
+        generation_key = settings.CACHE_KEY_LISTS_GENERATION % canvas_course_id
+        values = cache.get_many([cache_key, generation_key])
+        cached = values.get(cache_key)
+        # lists cached before the last invalidation don't count, in case a
+        # refresh that started before it wrote them after it
+        if cached is None or cached.get("generation", 0) != values.get(
+            generation_key, 0
+        ):
+            return self._refresh_cached_mailing_lists(canvas_course_id, **kwargs)
+
+        if cached["fresh_until"] < time.time() and cache.add(
+            settings.CACHE_KEY_LISTS_REFRESH_LOCK % canvas_course_id,
+            True,
+            timeout=settings.LISTS_CACHE_TIMEOUT,
+        ):
+            # only one process gets the lock and refreshes
+            threading.Thread(
+                target=self._refresh_cached_mailing_lists_in_background,
+                args=(canvas_course_id,),
+                kwargs=kwargs,
+                daemon=True,
+            ).start()
+        return cached["lists"]
+
+    def invalidate_cached_mailing_lists(self, canvas_course_id):
+        """
+        Forces the next get_cached_mailing_lists_for_canvas_course_id() for
+        the course to recompute its lists.  Bumps the course's generation
+        rather than just deleting the cached lists, so a refresh already in
+        flight can't put its older lists back.
+        """
+        generation_key = settings.CACHE_KEY_LISTS_GENERATION % canvas_course_id
+        cache.add(generation_key, 0, timeout=None)
+        try:
+            cache.incr(generation_key)
+        except ValueError:
+            # evicted between the add and the incr
+            cache.set(generation_key, 1, timeout=None)
+        cache.delete(settings.CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID % canvas_course_id)
+
+    def _refresh_cached_mailing_lists(self, canvas_course_id, **kwargs):
+        generation = cache.get(
+            settings.CACHE_KEY_LISTS_GENERATION % canvas_course_id, 0
+        )
+        lists = self.get_or_create_or_delete_mailing_lists_for_canvas_course_id(
+            canvas_course_id, **kwargs
+        )
+        cache.set(
+            settings.CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID % canvas_course_id,
+            {
+                "lists": lists,
+                "fresh_until": time.time() + settings.LISTS_CACHE_TIMEOUT,
+                "generation": generation,
+            },
+            timeout=settings.LISTS_CACHE_TIMEOUT + settings.LISTS_CACHE_STALE_TIMEOUT,
+        )
+        return lists
+
+    def _refresh_cached_mailing_lists_in_background(self, canvas_course_id, **kwargs):
+        try:
+            self._refresh_cached_mailing_lists(canvas_course_id, **kwargs)
+        except Exception:
+            # the stale lists stay in the cache until they expire
+            logger.exception(
+                "Failed to refresh the cached mailing lists for canvas course id %s",
+                canvas_course_id,
+            )
+        finally:
+            cache.delete(settings.CACHE_KEY_LISTS_REFRESH_LOCK % canvas_course_id)
+            connections.close_all()
+
+    def _reconcile_mailing_lists(self, canvas_course_id, section_ids, overrides):
+        """
+        Makes the course's MailingLists match its Canvas sections (plus the
+        course list, whose section_id is None): lists for new sections are
+        bulk created, and lists whose section no longer exists are deleted,
+        all in one transaction.  Lists a concurrent launch created first are
+        kept, thanks to the unique constraints.
+
+        :return: dict of section_id to MailingList for the course
+        """
+        wanted = [None] + list(section_ids)
+        with transaction.atomic():
+            existing = self._get_mailing_lists_by_section_id(canvas_course_id)
+
+            missing = [
+                section_id for section_id in wanted if section_id not in existing
+            ]
+            if missing:
+                self.bulk_create(
+                    [
+                        MailingList(
+                            **dict(
+                                {
+                                    "canvas_course_id": canvas_course_id,
+                                    "section_id": section_id,
+                                },
+                                **overrides,
+                            )
+                        )
+                        for section_id in missing
+                    ],
+                    ignore_conflicts=True,
+                )
+
+            # Delete existing mailing lists who's section no longer exists
+            vanished = set(existing) - set(wanted)
+            if vanished:
+                self.filter(
+                    canvas_course_id=canvas_course_id, section_id__in=vanished
+                ).delete()
+
+            if not missing:
+                return existing
+            # bulk_create(ignore_conflicts=True) doesn't give us the new
+            # ids, so read the lists back
+            return self._get_mailing_lists_by_section_id(canvas_course_id)
+
 
 class CourseSettings(models.Model):
     canvas_course_id = models.IntegerField(primary_key=True)
@@ -223,6 +332,15 @@ class MailingList(models.Model):
     class Meta:
         db_table = "ml_mailing_list"
         unique_together = ("canvas_course_id", "section_id")
+        constraints = [
+            # unique_together doesn't cover the course list, since NULL
+            # section_ids never conflict
+            models.UniqueConstraint(
+                fields=["canvas_course_id"],
+                condition=models.Q(section_id__isnull=True),
+                name="ml_mailing_list_unique_course_list",
+            ),
+        ]
 
     def __unicode__(self):
         return "canvas_course_id: {}, section_id: {}".format(
@@ -234,23 +352,82 @@ class MailingList(models.Model):
         When we add enrollment emails to the mailing list, check if this is a whole course list
         by checking if the section_id is 0. If it is we want to add all the enrollments that exist
         in the course. If not, we build the mailing with the enrollments for the specified section.
+
+        Answered from the CourseRosterIndex when it's fresh enough, otherwise
+        from Canvas (refreshing the index on the way).
         """
-        return {
-            e["email"].lower()
-            for e in canvas_api_client.get_enrollments(
-                self.canvas_course_id, self.section_id
-            )
-            if e.get("email") is not None
-        }
+        emails = CourseRosterIndex.objects.get_member_email_set(
+            self.canvas_course_id, self.section_id
+        )
+        if emails is None:
+            roster = self._get_live_roster()
+            emails = {
+                e["email"].lower()
+                for e in roster.get_enrollments(self.section_id)
+                if e.get("email") is not None
+            }
+        return emails
 
     def _get_enrolled_teaching_staff_email_set(self):
-        return {
-            e["email"].lower()
-            for e in canvas_api_client.get_teaching_staff_enrollments(
-                self.canvas_course_id
+        emails = CourseRosterIndex.objects.get_teaching_staff_email_set(
+            self.canvas_course_id
+        )
+        if emails is None:
+            roster = self._get_live_roster()
+            emails = {
+                e["email"].lower()
+                for e in roster.get_teaching_staff_enrollments()
+                if e["email"] is not None
+            }
+        return emails
+
+    def is_member_address(self, address):
+        """
+        Whether `address` (lowercased) is one of self.members, without
+        fetching the course's whole roster from Canvas if it isn't stored
+        locally.
+        """
+        emails = CourseRosterIndex.objects.get_member_email_set(
+            self.canvas_course_id, self.section_id
+        )
+        if emails is None:
+            emails = {
+                address
+                for e in canvas_api_client.get_enrollments_for_email(
+                    self.canvas_course_id, address
+                )
+                if not self.section_id
+                or e["course_section_id"] == int(self.section_id)
+            }
+        if address not in emails:
+            return False
+        if not getattr(settings, "IGNORE_WHITELIST", False):
+            return address in self._get_whitelist_email_set()
+        return True
+
+    def is_teaching_staff_address(self, address):
+        """
+        Whether `address` (lowercased) is one of
+        self.teaching_staff_addresses, without fetching the course's whole
+        roster from Canvas if it isn't stored locally.
+        """
+        emails = CourseRosterIndex.objects.get_teaching_staff_email_set(
+            self.canvas_course_id
+        )
+        if emails is not None:
+            return address in emails
+        return any(
+            canvas_api_client.is_teaching_staff_role(self.canvas_course_id, e["role"])
+            for e in canvas_api_client.get_enrollments_for_email(
+                self.canvas_course_id, address
             )
-            if e["email"] is not None
-        }
+        )
+
+    def _get_live_roster(self):
+        roster = canvas_api_client.get_course_roster(self.canvas_course_id)
+        if CourseRosterIndex.objects.is_enabled():
+            CourseRosterIndex.objects.refresh_from_roster(roster)
+        return roster
 
     def get_alternate_emails_for_user_email(self, sender_from):
         emails = canvas_api_client.get_alternate_emails_for_user_email(
@@ -259,7 +436,7 @@ class MailingList(models.Model):
         return emails
 
     def _get_whitelist_email_set(self):
-        return {x.email.lower() for x in EmailWhitelist.objects.all()}
+        return EmailWhitelist.objects.get_email_set()
 
     @property
     def address(self):
@@ -302,6 +479,7 @@ class MailingList(models.Model):
         inlines=None,
         encapsulated_msg_att=None,
         message_id=None,
+        recipient_list_addresses=None,
     ):
         logger.debug(
             "in send_mail: sender_address=%s, to_address=%s, mailing_list.address=%s ",
@@ -325,12 +503,239 @@ class MailingList(models.Model):
             inlines,
             encapsulated_msg_att,
             message_id,
+            recipient_list_addresses,
         )
-        cache_key = settings.CACHE_KEY_MESSAGE_HANDLED_BY_MESSAGE_ID_AND_RECIPIENT % (
-            message_id,
-            to_address,
+
+
+class CourseRosterIndexManager(models.Manager):
+    """
+    Custom Manager for the locally stored course rosters, which let the route
+    handler answer "who is on this list" with a database query instead of a
+    Canvas round trip.  Lookups return None when a course's roster is missing
+    or older than settings.ROSTER_INDEX_MAX_AGE, so callers fall back to
+    Canvas.
+    """
+
+    def is_enabled(self):
+        return bool(getattr(settings, "ROSTER_INDEX_MAX_AGE", None))
+
+    def _is_fresh(self, canvas_course_id):
+        if not self.is_enabled():
+            return False
+        cutoff = timezone.now() - datetime.timedelta(
+            seconds=settings.ROSTER_INDEX_MAX_AGE
+        )
+        return self.filter(
+            canvas_course_id=canvas_course_id, date_refreshed__gte=cutoff
+        ).exists()
+
+    def get_member_email_set(self, canvas_course_id, section_id=None):
+        if not self._is_fresh(canvas_course_id):
+            return None
+        query = CourseRosterEmail.objects.filter(roster_index_id=canvas_course_id)
+        if section_id:
+            query = query.filter(section_id=section_id)
+        return set(query.values_list("email", flat=True))
+
+    def get_teaching_staff_email_set(self, canvas_course_id):
+        if not self._is_fresh(canvas_course_id):
+            return None
+        return set(
+            CourseRosterEmail.objects.filter(
+                roster_index_id=canvas_course_id, is_teaching_staff=True
+            ).values_list("email", flat=True)
+        )
+
+    def refresh_from_roster(self, roster):
+        """
+        Brings the stored roster for roster.canvas_course_id in line with the
+        given canvas_api_client.CourseRoster, only writing the rows that
+        changed.
+
+        :return: (number of rows added, number changed, number removed)
+        """
+        staff_keys = {
+            (e["email"].lower(), e["course_section_id"])
+            for e in roster.get_teaching_staff_enrollments()
+            if e.get("email")
+        }
+        current = {}
+        for section_id in roster.get_section_ids():
+            for e in roster.get_enrollments(section_id):
+                if e.get("email"):
+                    key = (e["email"].lower(), section_id)
+                    current[key] = key in staff_keys
+
+        with transaction.atomic():
+            index, created = self.select_for_update().get_or_create(
+                canvas_course_id=roster.canvas_course_id,
+                defaults={"date_refreshed": timezone.now()},
+            )
+            stored = {(e.email, e.section_id): e for e in index.emails.all()}
+
+            removed_ids = [e.id for key, e in stored.items() if key not in current]
+            changed = []
+            for key, e in stored.items():
+                if key in current and e.is_teaching_staff != current[key]:
+                    e.is_teaching_staff = current[key]
+                    changed.append(e)
+            added = [
+                CourseRosterEmail(
+                    roster_index=index,
+                    email=email,
+                    section_id=section_id,
+                    is_teaching_staff=is_teaching_staff,
+                )
+                for (email, section_id), is_teaching_staff in current.items()
+                if (email, section_id) not in stored
+            ]
+
+            if removed_ids:
+                CourseRosterEmail.objects.filter(id__in=removed_ids).delete()
+            if changed:
+                CourseRosterEmail.objects.bulk_update(changed, ["is_teaching_staff"])
+            if added:
+                CourseRosterEmail.objects.bulk_create(added)
+            if not created:
+                index.date_refreshed = timezone.now()
+                index.save(update_fields=["date_refreshed"])
+
+        logger.debug(
+            "Refreshed roster index for canvas course %s: %d added, %d changed, "
+            "%d removed",
+            roster.canvas_course_id,
+            len(added),
+            len(changed),
+            len(removed_ids),
+        )
+        return len(added), len(changed), len(removed_ids)
+
+
+class CourseRosterIndex(models.Model):
+    """
+    Tracks when the locally stored roster for a Canvas course was last
+    refreshed from Canvas.
+    """
+
+    canvas_course_id = models.IntegerField(primary_key=True)
+    date_refreshed = models.DateTimeField()
+
+    objects = CourseRosterIndexManager()
+
+    class Meta:
+        db_table = "ml_course_roster_index"
+
+    def __unicode__(self):
+        return "canvas_course_id: {}, date_refreshed: {}".format(
+            self.canvas_course_id, self.date_refreshed
+        )
+
+
+class CourseRosterEmail(models.Model):
+    """
+    A normalized (lowercased) email address enrolled in a section of a
+    Canvas course, flagged if any of the enrollments behind it is a teaching
+    staff role.
+    """
+
+    roster_index = models.ForeignKey(
+        CourseRosterIndex, related_name="emails", on_delete=models.CASCADE
+    )
+    email = models.CharField(max_length=254)
+    section_id = models.IntegerField()
+    is_teaching_staff = models.BooleanField(default=False)
+
+    class Meta:
+        db_table = "ml_course_roster_email"
+        unique_together = ("roster_index", "email", "section_id")
+
+    def __unicode__(self):
+        return "canvas_course_id: {}, section_id: {}, email: {}".format(
+            self.roster_index_id, self.section_id, self.email
+        )
+
+
+class RosterSyncRun(models.Model):
+    """
+    A run of the roster sync engine (mailing_list.tasks.course_sync_listserv).
+    Courses whose roster index was refreshed after date_started are done, so
+    an unfinished run can be resumed from there.  The ones that failed are
+    kept in failed_course_ids, and retried when the run is resumed.
+    """
+
+    date_started = models.DateTimeField(auto_now_add=True)
+    date_finished = models.DateTimeField(null=True)
+    courses_total = models.IntegerField(default=0)
+    courses_synced = models.IntegerField(default=0)
+    courses_failed = models.IntegerField(default=0)
+    failed_course_ids = models.JSONField(default=list)
+    emails_added = models.IntegerField(default=0)
+    emails_changed = models.IntegerField(default=0)
+    emails_removed = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = "ml_roster_sync_run"
+
+    def record_failure(self, canvas_course_id):
+        if canvas_course_id not in self.failed_course_ids:
+            self.failed_course_ids.append(canvas_course_id)
+        self.courses_failed = len(self.failed_course_ids)
+
+    def record_success(self, canvas_course_id):
+        # a course that failed earlier in the run may succeed on resume
+        if canvas_course_id in self.failed_course_ids:
+            self.failed_course_ids.remove(canvas_course_id)
+        self.courses_failed = len(self.failed_course_ids)
+        self.courses_synced += 1
+
+    def __unicode__(self):
+        return "started: {}, finished: {}, synced: {}/{}".format(
+            self.date_started,
+            self.date_finished,
+            self.courses_synced,
+            self.courses_total,
+        )
+
+
+class EmailWhitelistManager(models.Manager):
+    """
+    Custom Manager for EmailWhitelist, keeping the lowercased addresses in a
+    process-local frozenset.  Saves and deletes stamp a new version in the
+    cache, which tells every process to reload it.
+    """
+
+    _lock = threading.Lock()
+    _email_set = None
+    _email_set_version = None
+
+    def _get_version(self):
+        version = cache.get(settings.CACHE_KEY_EMAIL_WHITELIST_VERSION)
+        if version is None:
+            cache.add(
+                settings.CACHE_KEY_EMAIL_WHITELIST_VERSION, uuid.uuid4().hex, None
+            )
+            version = cache.get(settings.CACHE_KEY_EMAIL_WHITELIST_VERSION)
+        return version
+
+    def get_email_set(self):
+        """
+        :return: frozenset of the lowercased whitelisted addresses
+        """
+        cls = EmailWhitelistManager
+        version = self._get_version()
+        with cls._lock:
+            if version is not None and version == cls._email_set_version:
+                return cls._email_set
+        emails = frozenset(
+            e.lower() for e in self.get_queryset().values_list("email", flat=True)
         )
-        cache.set(cache_key, True, timeout=settings.CACHE_KEY_MESSAGE_HANDLED_TIMEOUT)
+        with cls._lock:
+            cls._email_set = emails
+            cls._email_set_version = version
+        return emails
+
+    def invalidate(self):
+        cache.set(settings.CACHE_KEY_EMAIL_WHITELIST_VERSION, uuid.uuid4().hex, None)
 
 
 class EmailWhitelist(models.Model):
@@ -341,6 +746,8 @@ class EmailWhitelist(models.Model):
 
     email = models.EmailField()
 
+    objects = EmailWhitelistManager()
+
     class Meta:
         db_table = "ml_email_whitelist"
 
@@ -348,6 +755,34 @@ class EmailWhitelist(models.Model):
         return "email: {}".format(self.email)
 
 
+class SuperSenderManager(models.Manager):
+    """
+    Custom Manager for SuperSender, caching each school's super senders.
+    The cache is cleared whenever a SuperSender is saved or deleted.
+    """
+
+    def _cache_key(self, school_id):
+        return settings.CACHE_KEY_SUPER_SENDERS_BY_SCHOOL_ID % school_id.lower()
+
+    def get_email_set_for_school(self, school_id):
+        """
+        :return: the lowercased super sender addresses for school_id
+        """
+        cache_key = self._cache_key(school_id)
+        emails = cache.get(cache_key)
+        if emails is None:
+            # use iexact here to be able to match on COLGSAS or colgsas
+            query = self.filter(school_id__iexact=school_id)
+            emails = {addr.lower() for addr in query.values_list("email", flat=True)}
+            cache.set(
+                cache_key, emails, timeout=settings.CACHE_KEY_SUPER_SENDERS_TIMEOUT
+            )
+        return set(emails)
+
+    def invalidate_school(self, school_id):
+        cache.delete(self._cache_key(school_id))
+
+
 class SuperSender(models.Model):
     """
     This model stores email addresses that can send mail to any mailing list
@@ -357,8 +792,26 @@ class SuperSender(models.Model):
     email = models.EmailField()
     school_id = models.CharField(max_length=16)
 
+    objects = SuperSenderManager()
+
     class Meta:
         db_table = "ml_super_sender"
 
     def __unicode__(self):
         return "email: {}, school: {}".format(self.email, self.school_id)
+
+
+@receiver(post_save, sender=EmailWhitelist)
+@receiver(post_delete, sender=EmailWhitelist)
+def invalidate_email_whitelist_cache(sender, instance, **kwargs):
+    # note that queryset.update() doesn't send signals, so processes won't
+    # see changes made that way until the next save or delete
+    EmailWhitelist.objects.invalidate()
+
+
+@receiver(post_save, sender=SuperSender)
+@receiver(post_delete, sender=SuperSender)
+def invalidate_super_sender_cache(sender, instance, **kwargs):
+    # note that queryset.update() doesn't send signals, so cached super
+    # senders will be stale until they expire if it's used
+    SuperSender.objects.invalidate_school(instance.school_id)
@@ -0,0 +1,156 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from timeit import default_timer as timer
+
+from django.db import connections
+from django.utils import timezone
+
+from lti_emailer import canvas_api_client
+from mailing_list.models import CourseRosterIndex, MailingList, RosterSyncRun
+
+logger = logging.getLogger(__name__)
+
+# how often, in courses, a run's progress is saved
+CHECKPOINT_INTERVAL = 25
+
+
+def get_active_canvas_course_ids():
+    """
+    :return: the canvas course ids that have mailing lists, i.e. the courses
+        that have used the emailer
+    """
+    return sorted(
+        MailingList.objects.values_list("canvas_course_id", flat=True).distinct()
+    )
+
+
+def sync_course_roster(canvas_course_id):
+    """
+    Fetches a course's roster from Canvas and stores the changes to it in the
+    CourseRosterIndex.
+    :return: ((added, changed, removed), seconds taken)
+    """
+    start_time = timer()
+    roster = canvas_api_client.get_course_roster(canvas_course_id)
+    changes = CourseRosterIndex.objects.refresh_from_roster(roster)
+    return changes, timer() - start_time
+
+
+def _sync_course_roster_in_thread(canvas_course_id):
+    try:
+        return sync_course_roster(canvas_course_id)
+    finally:
+        # pool threads don't get Django's request cleanup
+        connections.close_all()
+
+
+def _sync_course_rosters(canvas_course_ids, workers):
+    """
+    Yields (canvas_course_id, result, exception or None) as each course
+    finishes, running up to `workers` of them at once.  Any exception is
+    caught, so one bad course doesn't end the run.
+    """
+    if workers == 1:
+        for canvas_course_id in canvas_course_ids:
+            try:
+                yield canvas_course_id, sync_course_roster(canvas_course_id), None
+            except Exception as e:
+                yield canvas_course_id, None, e
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_sync_course_roster_in_thread, canvas_course_id): (
+                canvas_course_id
+            )
+            for canvas_course_id in canvas_course_ids
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
+def course_sync_listserv(canvas_course_ids=None, workers=4, resume=False):
+    """
+    Syncs the stored rosters of the given courses (default: every course with
+    mailing lists) with Canvas, fetching up to `workers` courses at a time.
+
+    With resume=True, the most recent unfinished run is picked up again, and
+    courses it already synced are skipped.
+
+    :return: the RosterSyncRun
+    """
+    run = None
+    if resume:
+        run = (
+            RosterSyncRun.objects.filter(date_finished__isnull=True)
+            .order_by("-date_started")
+            .first()
+        )
+        if run is None:
+            logger.info("No unfinished roster sync run to resume, starting a new one")
+    if run is None:
+        run = RosterSyncRun.objects.create()
+
+    if canvas_course_ids is None:
+        canvas_course_ids = get_active_canvas_course_ids()
+    canvas_course_ids = list(canvas_course_ids)
+    run.courses_total = len(canvas_course_ids)
+
+    done = set(
+        CourseRosterIndex.objects.filter(
+            canvas_course_id__in=canvas_course_ids,
+            date_refreshed__gte=run.date_started,
+        ).values_list("canvas_course_id", flat=True)
+    )
+    pending = [c for c in canvas_course_ids if c not in done]
+    logger.info(
+        "Roster sync run %s: syncing %d of %d course(s) with %d worker(s)",
+        run.id,
+        len(pending),
+        len(canvas_course_ids),
+        workers,
+    )
+
+    results = _sync_course_rosters(pending, workers)
+    for i, (canvas_course_id, result, error) in enumerate(results, start=1):
+        if error is not None:
+            logger.error(
+                "Roster sync run %s: unable to sync canvas course id %s",
+                run.id,
+                canvas_course_id,
+                exc_info=error,
+            )
+            run.record_failure(canvas_course_id)
+        else:
+            (added, changed, removed), elapsed = result
+            logger.info(
+                "Roster sync run %s: synced canvas course id %s in %.2fs: "
+                "%d added, %d changed, %d removed",
+                run.id,
+                canvas_course_id,
+                elapsed,
+                added,
+                changed,
+                removed,
+            )
+            run.record_success(canvas_course_id)
+            run.emails_added += added
+            run.emails_changed += changed
+            run.emails_removed += removed
+
+        if i % CHECKPOINT_INTERVAL == 0:
+            run.save()
+
+    run.date_finished = timezone.now()
+    run.save()
+    logger.info(
+        "Roster sync run %s finished: %d synced, %d failed of %d course(s)",
+        run.id,
+        run.courses_synced,
+        run.courses_failed,
+        run.courses_total,
+    )
+    return run
@@ -0,0 +1,75 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from canvas_sdk.exceptions import CanvasAPIError
+from django.core.management import call_command
+from django.test import TestCase
+from mock import patch
+
+COURSES = [
+    {"id": i, "sis_course_id": str(i), "name": "Course", "course_code": "C"}
+    for i in (1, 2, 3)
+]
+
+
+def _get_lists(course_id, defaults=None):
+    if course_id == 2:
+        raise CanvasAPIError()
+    return [
+        {"address": "canvas-{}@example.edu".format(course_id), "is_course_list": True}
+    ]
+
+
+@patch("mailing_list.management.commands.activate_all_lists.canvas_throttle")
+@patch(
+    "mailing_list.management.commands.activate_all_lists.MailingList.objects."
+    "get_or_create_or_delete_mailing_lists_for_canvas_course_id",
+    side_effect=_get_lists,
+)
+@patch(
+    "mailing_list.management.commands.activate_all_lists.get_courses_for_account_in_term",
+    return_value=COURSES,
+)
+class ActivateAllListsTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        fd, self.resume_file = tempfile.mkstemp()
+        os.close(fd)
+        os.unlink(self.resume_file)
+
+    def tearDown(self):
+        if os.path.exists(self.resume_file):
+            os.unlink(self.resume_file)
+
+    def _call(self):
+        stdout, stderr = StringIO(), StringIO()
+        call_command(
+            "activate_all_lists",
+            account_id="1",
+            enrollment_term_id=["1"],
+            resume_file=self.resume_file,
+            stdout=stdout,
+            stderr=stderr,
+        )
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_failures_are_isolated_and_recorded(self, mock_courses, mock_lists, _):
+        stdout, stderr = self._call()
+
+        self.assertIn("Total of 2 list(s) for 3 course(s)", stdout)
+        self.assertIn("Failed to get/create lists for 1 courses", stderr)
+        with open(self.resume_file) as f:
+            done = [json.loads(line)["course_id"] for line in f]
+        self.assertEqual(sorted(done), [1, 3])
+
+    def test_resume_skips_finished_courses(self, mock_courses, mock_lists, _):
+        self._call()
+        mock_lists.reset_mock()
+
+        stdout, _ = self._call()
+
+        self.assertEqual([c[0][0] for c in mock_lists.call_args_list], [2])
+        self.assertIn("skipping 2 course(s)", stdout)
@@ -1,9 +1,13 @@
+import time
+
 from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from mock import patch
 
-from mailing_list.models import MailingList
+from mailing_list.models import EmailWhitelist, MailingList, SuperSender
 
 
 class MailingListModelTests(TestCase):
@@ -24,7 +28,7 @@ class MailingListModelTests(TestCase):
             },
         ]
 
-    @patch("mailing_list.models.get_section_sis_enrollment_status")
+    @patch("mailing_list.models.get_section_sis_enrollment_statuses")
     @patch("mailing_list.models.is_course_crosslisted")
     @patch("mailing_list.models.canvas_api_client.get_course")
     @patch("mailing_list.models.canvas_api_client.get_enrollments")
@@ -39,7 +43,7 @@ class MailingListModelTests(TestCase):
     ):
         mock_get_course.return_value = {"sis_course_id": "786534"}
         mock_xlisted.return_value = False
-        mock_get_sis_enroll_stat.return_value = None
+        mock_get_sis_enroll_stat.return_value = {}
 
         mock_get_sections.return_value = self.sections
         mock_get_enrollments.return_value = []
@@ -102,7 +106,7 @@ class MailingListModelTests(TestCase):
             ],
         )
 
-    @patch("mailing_list.models.get_section_sis_enrollment_status")
+    @patch("mailing_list.models.get_section_sis_enrollment_statuses")
     @patch("mailing_list.models.is_course_crosslisted")
     @patch("mailing_list.models.canvas_api_client.get_course")
     @patch("mailing_list.models.canvas_api_client.get_enrollments")
@@ -117,7 +121,7 @@ class MailingListModelTests(TestCase):
     ):
         mock_get_course.return_value = {"sis_course_id": "786534"}
         mock_xlisted.return_value = False
-        mock_get_sis_enroll_stat.return_value = "E"
+        mock_get_sis_enroll_stat.side_effect = lambda ids: {i: "E" for i in ids}
 
         sections = list(self.sections)
         sections.append({"id": 1584, "name": "section name 3", "sis_section_id": None})
@@ -198,7 +202,7 @@ class MailingListModelTests(TestCase):
             result,
         )
 
-    @patch("mailing_list.models.get_section_sis_enrollment_status")
+    @patch("mailing_list.models.get_section_sis_enrollment_statuses")
     @patch("mailing_list.models.is_course_crosslisted")
     @patch("mailing_list.models.canvas_api_client.get_course")
     @patch("mailing_list.models.canvas_api_client.get_enrollments")
@@ -213,7 +217,7 @@ class MailingListModelTests(TestCase):
     ):
         mock_get_course.return_value = {"sis_course_id": "786534"}
         mock_xlisted.return_value = False
-        mock_get_sis_enroll_stat.return_value = None
+        mock_get_sis_enroll_stat.return_value = {}
         sections = list(self.sections)
         del sections[1]
         mock_get_sections.return_value = sections
@@ -261,7 +265,7 @@ class MailingListModelTests(TestCase):
             result,
         )
 
-    @patch("mailing_list.models.get_section_sis_enrollment_status")
+    @patch("mailing_list.models.get_section_sis_enrollment_statuses")
     @patch("mailing_list.models.is_course_crosslisted")
     @patch("mailing_list.models.MailingList.objects.get")
     @patch("mailing_list.models.canvas_api_client.get_course")
@@ -281,7 +285,7 @@ class MailingListModelTests(TestCase):
         should contain only the course id and the newly created list should have a section id of 'None'.
         """
         mock_xlisted.return_value = True
-        mock_get_sis_enroll_stat.return_value = "E"
+        mock_get_sis_enroll_stat.side_effect = lambda ids: {i: "E" for i in ids}
         mock_get_mailinglist.side_effect = MailingList.DoesNotExist
 
         sections = list(self.sections)
@@ -322,7 +326,7 @@ class MailingListModelTests(TestCase):
             result[0],
         )
 
-    @patch("mailing_list.models.get_section_sis_enrollment_status")
+    @patch("mailing_list.models.get_section_sis_enrollment_statuses")
     @patch("mailing_list.models.is_course_crosslisted")
     @patch("mailing_list.models.MailingList.objects.get")
     @patch("mailing_list.models.canvas_api_client.get_course")
@@ -342,7 +346,7 @@ class MailingListModelTests(TestCase):
         list should contain only the course id and the newly created list should have a section id of 'None'.
         """
         mock_xlisted.return_value = False
-        mock_get_sis_enroll_stat.return_value = "E"
+        mock_get_sis_enroll_stat.side_effect = lambda ids: {i: "E" for i in ids}
         mock_get_mailinglist.side_effect = MailingList.DoesNotExist
 
         sections = list(self.sections)
@@ -450,3 +454,213 @@ class MailingListModelTests(TestCase):
         mock_get_mailing_list.assert_called_with(
             canvas_course_id=3716, section_id__isnull=True
         )
+
+
+class MailingListReconciliationTests(TestCase):
+    longMessage = True
+
+    def test_reconcile_creates_and_deletes_in_bulk(self):
+        MailingList.objects.create(canvas_course_id=42, section_id=1)
+        MailingList.objects.create(canvas_course_id=42, section_id=2)
+
+        lists = MailingList.objects._reconcile_mailing_lists(
+            42, [2, 3, 4], {"access_level": MailingList.ACCESS_LEVEL_STAFF}
+        )
+
+        self.assertEqual(sorted(lists, key=str), sorted([None, 2, 3, 4], key=str))
+        self.assertEqual(lists[3].access_level, MailingList.ACCESS_LEVEL_STAFF)
+        self.assertFalse(
+            MailingList.objects.filter(canvas_course_id=42, section_id=1).exists()
+        )
+
+    def test_reconcile_keeps_existing_course_list(self):
+        first = MailingList.objects._reconcile_mailing_lists(42, [1], {})
+        second = MailingList.objects._reconcile_mailing_lists(42, [1], {})
+
+        self.assertEqual(first[None].id, second[None].id)
+        self.assertEqual(
+            MailingList.objects.filter(
+                canvas_course_id=42, section_id__isnull=True
+            ).count(),
+            1,
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    LISTS_CACHE_TIMEOUT=60,
+)
+@patch(
+    "mailing_list.models.MailingListManager.get_or_create_or_delete_mailing_lists_for_canvas_course_id"
+)
+class CachedMailingListsTests(TestCase):
+    longMessage = True
+
+    def test_fresh_lists_come_from_the_cache(self, mock_get_lists):
+        mock_get_lists.return_value = [{"id": 1}]
+        for _ in range(2):
+            self.assertEqual(
+                MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42),
+                [{"id": 1}],
+            )
+        self.assertEqual(mock_get_lists.call_count, 1)
+
+    def test_invalidation_forces_a_recompute(self, mock_get_lists):
+        mock_get_lists.return_value = [{"id": 1}]
+        MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42)
+        MailingList.objects.invalidate_cached_mailing_lists(42)
+        MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42)
+        self.assertEqual(mock_get_lists.call_count, 2)
+
+    def test_refresh_racing_an_invalidation_is_discarded(self, mock_get_lists):
+        def get_lists_then_invalidate(canvas_course_id, **kwargs):
+            # e.g. an access level change saved while this refresh was
+            # still reading the old lists
+            MailingList.objects.invalidate_cached_mailing_lists(canvas_course_id)
+            return [{"id": "old"}]
+
+        mock_get_lists.side_effect = get_lists_then_invalidate
+        MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42)
+
+        mock_get_lists.side_effect = None
+        mock_get_lists.return_value = [{"id": "new"}]
+        self.assertEqual(
+            MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42),
+            [{"id": "new"}],
+        )
+
+    @patch("mailing_list.models.threading.Thread")
+    def test_stale_lists_are_served_while_refreshing(self, mock_thread, mock_get_lists):
+        cache.set(
+            settings.CACHE_KEY_LISTS_BY_CANVAS_COURSE_ID % 42,
+            {"lists": [{"id": "stale"}], "fresh_until": time.time() - 1},
+        )
+
+        lists = MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42)
+        MailingList.objects.get_cached_mailing_lists_for_canvas_course_id(42)
+
+        self.assertEqual(lists, [{"id": "stale"}])
+        self.assertEqual(mock_get_lists.call_count, 0)
+        # only the first caller starts a refresh
+        self.assertEqual(mock_thread.return_value.start.call_count, 1)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class SuperSenderCacheTests(TestCase):
+    longMessage = True
+
+    def test_saves_and_deletes_invalidate_the_school(self):
+        SuperSender.objects.create(email="Dean@example.edu", school_id="colgsas")
+        self.assertEqual(
+            SuperSender.objects.get_email_set_for_school("COLGSAS"),
+            {"dean@example.edu"},
+        )
+
+        provost = SuperSender.objects.create(
+            email="provost@example.edu", school_id="colgsas"
+        )
+        self.assertEqual(
+            SuperSender.objects.get_email_set_for_school("colgsas"),
+            {"dean@example.edu", "provost@example.edu"},
+        )
+
+        provost.delete()
+        self.assertEqual(
+            SuperSender.objects.get_email_set_for_school("colgsas"),
+            {"dean@example.edu"},
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class EmailWhitelistCacheTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        cache.clear()
+
+    def test_whitelist_is_kept_in_memory(self):
+        EmailWhitelist.objects.create(email="Tester@example.edu")
+        emails = EmailWhitelist.objects.get_email_set()
+        self.assertIsInstance(emails, frozenset)
+        self.assertIn("tester@example.edu", emails)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(EmailWhitelist.objects.get_email_set(), emails)
+
+    def test_saves_and_deletes_invalidate_the_whitelist(self):
+        tester = EmailWhitelist.objects.create(email="tester@example.edu")
+        EmailWhitelist.objects.get_email_set()
+
+        EmailWhitelist.objects.create(email="qa@example.edu")
+        emails = EmailWhitelist.objects.get_email_set()
+        self.assertIn("tester@example.edu", emails)
+        self.assertIn("qa@example.edu", emails)
+
+        tester.delete()
+        emails = EmailWhitelist.objects.get_email_set()
+        self.assertNotIn("tester@example.edu", emails)
+        self.assertIn("qa@example.edu", emails)
+
+
+@override_settings(ROSTER_INDEX_MAX_AGE=0, IGNORE_WHITELIST=True)
+@patch("mailing_list.models.canvas_api_client.get_course_roster")
+@patch("mailing_list.models.canvas_api_client.get_enrollments_for_email")
+class SenderMembershipProbeTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.enrollments = [
+            {"course_section_id": 2, "role": "StudentEnrollment"},
+            {"course_section_id": 3, "role": "TaEnrollment"},
+        ]
+
+    def test_course_list_member(self, mock_get_enrollments, mock_get_roster):
+        mock_get_enrollments.return_value = self.enrollments
+        ml = MailingList(canvas_course_id=1)
+
+        self.assertTrue(ml.is_member_address("student@example.edu"))
+        mock_get_enrollments.assert_called_once_with(1, "student@example.edu")
+        self.assertEqual(
+            mock_get_roster.call_count, 0, "the full roster shouldn't be fetched"
+        )
+
+    def test_section_list_member(self, mock_get_enrollments, mock_get_roster):
+        mock_get_enrollments.return_value = self.enrollments
+
+        self.assertTrue(
+            MailingList(canvas_course_id=1, section_id=2).is_member_address(
+                "student@example.edu"
+            )
+        )
+        self.assertFalse(
+            MailingList(canvas_course_id=1, section_id=4).is_member_address(
+                "student@example.edu"
+            )
+        )
+        self.assertEqual(mock_get_roster.call_count, 0)
+
+    def test_not_enrolled(self, mock_get_enrollments, mock_get_roster):
+        mock_get_enrollments.return_value = []
+        ml = MailingList(canvas_course_id=1)
+
+        self.assertFalse(ml.is_member_address("nobody@example.edu"))
+        self.assertFalse(ml.is_teaching_staff_address("nobody@example.edu"))
+        self.assertEqual(mock_get_roster.call_count, 0)
+
+    @patch("mailing_list.models.canvas_api_client.is_teaching_staff_role")
+    def test_teaching_staff(
+        self, mock_is_staff_role, mock_get_enrollments, mock_get_roster
+    ):
+        mock_get_enrollments.return_value = self.enrollments
+        mock_is_staff_role.side_effect = lambda course_id, role: role == "TaEnrollment"
+
+        self.assertTrue(
+            MailingList(canvas_course_id=1).is_teaching_staff_address(
+                "ta@example.edu"
+            )
+        )
+        self.assertEqual(mock_get_roster.call_count, 0)
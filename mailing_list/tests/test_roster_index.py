@@ -0,0 +1,196 @@
+import datetime
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import patch
+
+from canvas_sdk.exceptions import CanvasAPIError
+
+from lti_emailer.canvas_api_client import CourseRoster
+from mailing_list.models import CourseRosterIndex, MailingList, RosterSyncRun
+from mailing_list.tasks import course_sync_listserv
+
+
+def _make_user(email, *enrollments):
+    return {
+        "email": email,
+        "name": email,
+        "sortable_name": email,
+        "enrollments": [
+            {"course_section_id": section_id, "role": role}
+            for section_id, role in enrollments
+        ],
+    }
+
+
+@override_settings(ROSTER_INDEX_MAX_AGE=60 * 15)
+@patch(
+    "lti_emailer.canvas_api_client.is_allowed",
+    new=lambda roles, *args: roles == ["TeacherEnrollment"],
+)
+class CourseRosterIndexTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        self.canvas_course_id = 123
+        self.users = [
+            _make_user("Student@example.edu", (1, "StudentEnrollment")),
+            _make_user(
+                "teacher@example.edu",
+                (1, "TeacherEnrollment"),
+                (2, "TeacherEnrollment"),
+            ),
+        ]
+
+    def _refresh(self, users):
+        return CourseRosterIndex.objects.refresh_from_roster(
+            CourseRoster(self.canvas_course_id, users)
+        )
+
+    def test_missing_roster_is_a_miss(self):
+        self.assertIsNone(
+            CourseRosterIndex.objects.get_member_email_set(self.canvas_course_id)
+        )
+
+    def test_lookups_after_refresh(self):
+        self._refresh(self.users)
+
+        self.assertEqual(
+            CourseRosterIndex.objects.get_member_email_set(self.canvas_course_id),
+            {"student@example.edu", "teacher@example.edu"},
+        )
+        self.assertEqual(
+            CourseRosterIndex.objects.get_member_email_set(self.canvas_course_id, 2),
+            {"teacher@example.edu"},
+        )
+        self.assertEqual(
+            CourseRosterIndex.objects.get_teaching_staff_email_set(
+                self.canvas_course_id
+            ),
+            {"teacher@example.edu"},
+        )
+
+    def test_stale_roster_is_a_miss(self):
+        self._refresh(self.users)
+        CourseRosterIndex.objects.filter(canvas_course_id=self.canvas_course_id).update(
+            date_refreshed=timezone.now() - datetime.timedelta(hours=1)
+        )
+
+        self.assertIsNone(
+            CourseRosterIndex.objects.get_member_email_set(self.canvas_course_id)
+        )
+        self.assertIsNone(
+            CourseRosterIndex.objects.get_teaching_staff_email_set(
+                self.canvas_course_id
+            )
+        )
+
+    def test_refresh_only_writes_changes(self):
+        self._refresh(self.users)
+
+        # the student drops, and a new student joins section 2
+        users = [
+            self.users[1],
+            _make_user("new@example.edu", (2, "StudentEnrollment")),
+        ]
+        added, changed, removed = self._refresh(users)
+
+        self.assertEqual((added, changed, removed), (1, 0, 1))
+        self.assertEqual(
+            CourseRosterIndex.objects.get_member_email_set(self.canvas_course_id, 2),
+            {"teacher@example.edu", "new@example.edu"},
+        )
+
+    @patch("mailing_list.models.canvas_api_client.get_course_roster")
+    def test_members_use_fresh_roster_without_canvas(self, mock_get_roster):
+        self._refresh(self.users)
+        ml = MailingList(canvas_course_id=self.canvas_course_id, section_id=1)
+
+        self.assertEqual(
+            ml._get_enrolled_email_set(),
+            {"student@example.edu", "teacher@example.edu"},
+        )
+        self.assertEqual(mock_get_roster.call_count, 0)
+
+    @patch("mailing_list.models.canvas_api_client.get_course_roster")
+    def test_members_fall_back_to_canvas_and_refresh(self, mock_get_roster):
+        mock_get_roster.return_value = CourseRoster(self.canvas_course_id, self.users)
+        ml = MailingList(canvas_course_id=self.canvas_course_id, section_id=2)
+
+        self.assertEqual(ml._get_enrolled_email_set(), {"teacher@example.edu"})
+        self.assertEqual(mock_get_roster.call_count, 1)
+        self.assertEqual(
+            CourseRosterIndex.objects.get_member_email_set(self.canvas_course_id, 2),
+            {"teacher@example.edu"},
+        )
+
+
+@patch("mailing_list.tasks.canvas_api_client.get_course_roster")
+class CourseSyncListservTests(TestCase):
+    longMessage = True
+
+    def setUp(self):
+        for canvas_course_id in (1, 2, 3):
+            MailingList.objects.create(canvas_course_id=canvas_course_id)
+
+    def _roster(self, canvas_course_id):
+        if canvas_course_id == 2:
+            raise CanvasAPIError()
+        return CourseRoster(
+            canvas_course_id,
+            [_make_user("student@example.edu", (10, "StudentEnrollment"))],
+        )
+
+    def test_syncs_active_courses_and_isolates_failures(self, mock_get_roster):
+        mock_get_roster.side_effect = self._roster
+
+        run = course_sync_listserv(workers=1)
+
+        self.assertEqual(
+            (run.courses_total, run.courses_synced, run.courses_failed), (3, 2, 1)
+        )
+        self.assertEqual(run.failed_course_ids, [2])
+        self.assertEqual(run.emails_added, 2)
+        self.assertIsNotNone(run.date_finished)
+        self.assertEqual(
+            set(CourseRosterIndex.objects.values_list("canvas_course_id", flat=True)),
+            {1, 3},
+        )
+
+    def test_resume_skips_courses_already_synced(self, mock_get_roster):
+        mock_get_roster.side_effect = self._roster
+        run = RosterSyncRun.objects.create()
+        CourseRosterIndex.objects.refresh_from_roster(self._roster(1))
+
+        resumed = course_sync_listserv(workers=1, resume=True)
+
+        self.assertEqual(resumed.id, run.id)
+        self.assertEqual(
+            [c[0][0] for c in mock_get_roster.call_args_list], [2, 3]
+        )
+
+    def test_unexpected_errors_only_fail_their_course(self, mock_get_roster):
+        def roster(canvas_course_id):
+            if canvas_course_id == 3:
+                raise ValueError("unexpected roster data")
+            return self._roster(canvas_course_id)
+
+        mock_get_roster.side_effect = roster
+
+        run = course_sync_listserv(workers=2)
+
+        self.assertEqual(run.courses_synced, 1)
+        self.assertEqual(sorted(run.failed_course_ids), [2, 3])
+        self.assertEqual(run.courses_failed, 2)
+        self.assertIsNotNone(run.date_finished)
+
+    def test_resume_clears_courses_that_now_sync(self, mock_get_roster):
+        mock_get_roster.side_effect = self._roster
+        run = RosterSyncRun.objects.create(failed_course_ids=[3], courses_failed=1)
+
+        resumed = course_sync_listserv(workers=1, resume=True)
+
+        self.assertEqual(resumed.id, run.id)
+        self.assertEqual(resumed.failed_course_ids, [2])
+        self.assertEqual(resumed.courses_failed, 1)
@@ -1,8 +1,14 @@
 from django.test import TestCase
+from django.test.utils import override_settings
 
-from mock import patch
+from mock import MagicMock, patch
 
-from mailing_list.utils import get_section_sis_enrollment_status, is_course_crosslisted
+from mailing_list.utils import (
+    get_primary_course_info,
+    get_section_sis_enrollment_status,
+    get_section_sis_enrollment_statuses,
+    is_course_crosslisted,
+)
 from coursemanager.models import CourseInstance
 
 
@@ -69,6 +75,21 @@ class MailingListUtilsTests(TestCase):
         result = get_section_sis_enrollment_status(self.section["sis_section_id"])
         self.assertEqual(result, "N")
 
+    @patch("mailing_list.utils.ORACLE_IN_CLAUSE_LIMIT", 2)
+    @patch("mailing_list.utils.CourseInstance.objects.filter")
+    def test_get_section_sis_enrollment_statuses_chunks_ids(self, mock_filter):
+        """Test that the bulk method queries in chunks and skips missing sections"""
+        mock_filter.return_value.values_list.side_effect = [
+            [(1, None), (2, "N")],
+            [(3, "E")],
+        ]
+        result = get_section_sis_enrollment_statuses(["1", "2", "3", "4"])
+        self.assertEqual(result, {"1": "E", "2": "N", "3": "E"})
+        self.assertEqual(
+            [c[1]["course_instance_id__in"] for c in mock_filter.call_args_list],
+            [[1, 2], [3, 4]],
+        )
+
     @patch("mailing_list.utils.XlistMap.objects.filter")
     def test_is_course_crosslisted_when_there_is_no_xlist_record(self, mock_get_xref):
         """Test that the method returns False when there is not a xlist record"""
@@ -82,3 +103,27 @@ class MailingListUtilsTests(TestCase):
         mock_get_xref.return_value.count.return_value = 2
         result = is_course_crosslisted(self.course_instance_id)
         self.assertEqual(result, True)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+@patch(
+    "mailing_list.utils.CourseInstance.objects.get_primary_course_by_canvas_course_id"
+)
+class PrimaryCourseInfoTests(TestCase):
+    longMessage = True
+
+    def test_primary_course_is_cached(self, mock_get_primary):
+        mock_get_primary.return_value = MagicMock(
+            short_title="Lorem", course=MagicMock(school_id="colgsas")
+        )
+        self.assertEqual(get_primary_course_info(123), ("Lorem", "colgsas"))
+        self.assertEqual(get_primary_course_info(123), ("Lorem", "colgsas"))
+        self.assertEqual(mock_get_primary.call_count, 1)
+
+    def test_missing_primary_course_is_cached(self, mock_get_primary):
+        mock_get_primary.return_value = None
+        self.assertIsNone(get_primary_course_info(456))
+        self.assertIsNone(get_primary_course_info(456))
+        self.assertEqual(mock_get_primary.call_count, 1)
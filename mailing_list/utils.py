@@ -1,10 +1,17 @@
 import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
 from lti_tool.types import LtiLaunch
 
 from coursemanager.models import CourseInstance, XlistMap
 
 logger = logging.getLogger(__name__)
 
+# Oracle allows at most 1,000 expressions in an IN list
+ORACLE_IN_CLAUSE_LIMIT = 999
+
 
 def is_course_crosslisted(course_instance_id):
     """
@@ -21,6 +28,43 @@ def is_course_crosslisted(course_instance_id):
     return False
 
 
+def get_primary_course_info(canvas_course_id):
+    """
+    Read-through cache of the primary course instance for a Canvas course,
+    so hot courses don't need a coursemanager query for every message.
+    :param canvas_course_id:
+    :return (short_title, school_id), or None if there's no primary course:
+    """
+    cache_key = settings.CACHE_KEY_PRIMARY_COURSE_BY_CANVAS_COURSE_ID % canvas_course_id
+    cached = cache.get(cache_key)
+    if cached is not None:
+        # an empty tuple records that there was no primary course
+        return tuple(cached) or None
+
+    ci = CourseInstance.objects.get_primary_course_by_canvas_course_id(
+        canvas_course_id
+    )
+    if ci:
+        info = (ci.short_title, ci.course.school_id)
+        cache.set(cache_key, info, timeout=settings.CACHE_KEY_PRIMARY_COURSE_TIMEOUT)
+        return info
+
+    cache.set(
+        cache_key, (), timeout=settings.CACHE_KEY_PRIMARY_COURSE_MISSING_TIMEOUT
+    )
+    return None
+
+
+def _sis_enrollment_status(cs_class_type):
+    # if there is a course instance but there is no cs_class_type
+    # we should assume this is an enrollment type so return 'E'
+    if not cs_class_type or cs_class_type in "E":
+        return "E"
+    else:
+        # the only other option is 'N' so just return it
+        return "N"
+
+
 def get_section_sis_enrollment_status(sis_section_id):
     """
     Check to see if the section was fed by the SIS. If it was, it will have a field set
@@ -36,19 +80,37 @@ def get_section_sis_enrollment_status(sis_section_id):
     """
     try:
         ci = CourseInstance.objects.get(course_instance_id=int(sis_section_id))
-        # if there is a course instance but there is no cs_class_type
-        # we should assume this is an enrollment type so return 'E'
-        if not ci.cs_class_type or ci.cs_class_type in "E":
-            return "E"
-        else:
-            # the only other option is 'N' so just return it
-            return "N"
-
+        return _sis_enrollment_status(ci.cs_class_type)
     except CourseInstance.DoesNotExist:
         # there was no record for this id, so return None
         return None
 
 
+def get_section_sis_enrollment_statuses(sis_section_ids):
+    """
+    Bulk version of get_section_sis_enrollment_status, which looks up all of
+    the sections with one query per ORACLE_IN_CLAUSE_LIMIT ids.
+
+    :param sis_section_ids: iterable of (numeric) sis_section_id strings
+    :return dict of sis_section_id to 'N' or 'E'; ids without a
+        CourseInstance are left out:
+    """
+    ids_by_course_instance_id = defaultdict(list)
+    for sis_section_id in sis_section_ids:
+        ids_by_course_instance_id[int(sis_section_id)].append(sis_section_id)
+    course_instance_ids = list(ids_by_course_instance_id)
+    statuses = {}
+    for i in range(0, len(course_instance_ids), ORACLE_IN_CLAUSE_LIMIT):
+        chunk = course_instance_ids[i : i + ORACLE_IN_CLAUSE_LIMIT]
+        query = CourseInstance.objects.filter(course_instance_id__in=chunk)
+        for course_instance_id, cs_class_type in query.values_list(
+            "course_instance_id", "cs_class_type"
+        ):
+            for sis_section_id in ids_by_course_instance_id[course_instance_id]:
+                statuses[sis_section_id] = _sis_enrollment_status(cs_class_type)
+    return statuses
+
+
 def get_custom_data_from_request(request):
     """
     Get the custom data from the request object.
@@ -4,13 +4,14 @@ import lti_school_permissions.constants as constants
 from canvas_api.helpers import enrollments as canvas_api_helpers_enrollments
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render
 from django.views.decorators.http import require_http_methods
 from lti_school_permissions.decorators import lti_permission_required, lti_role_required
 from lti_tool.decorators import lti_launch_required
 
 from lti_emailer.canvas_api_client import get_course, get_enrollments, get_section
+from lti_emailer.concurrency import DeadlineExceeded, call_concurrently
 from mailing_list.models import MailingList
 from mailing_list.utils import get_custom_data_from_request
 
@@ -75,13 +76,32 @@ def list_members(request, section_id=None):
             MailingList, canvas_course_id=canvas_course_id, section_id__isnull=True
         )
 
-    enrollments = get_enrollments(canvas_course_id, section_id)
+    # these are independent, so fetch them at the same time.  the course is
+    # only needed for its name when this is the course-wide list.
+    calls = {
+        "enrollments": (get_enrollments, canvas_course_id, section_id),
+        "section": (get_section, canvas_course_id, section_id),
+    }
+    if not section_id:
+        calls["course"] = (get_course, canvas_course_id)
+    try:
+        results = call_concurrently(calls)
+    except DeadlineExceeded:
+        logger.exception(
+            "Timed out fetching canvas course %s section %s for list_members",
+            canvas_course_id,
+            section_id,
+        )
+        return HttpResponse("Timed out waiting for Canvas", status=504)
+
+    enrollments = results["enrollments"]
     canvas_api_helpers_enrollments.add_role_labels_to_enrollments(enrollments)
     enrollments.sort(key=lambda x: x["sortable_name"])
-    section = get_section(canvas_course_id, section_id)
+    section = results["section"]
 
     if not section:
-        course_code = get_course(canvas_course_id)["course_code"]
+        course = results.get("course") or get_course(canvas_course_id)
+        course_code = course["course_code"]
         section = {
             "id": 0,
             "name": course_code,